@@ -0,0 +1,85 @@
+"""
+Compare keeping all device data in SQLite against archiving old data to the
+columnar cold tier (:mod:`medops.models.archive`).
+
+The same readings are stored twice. In the second copy everything but the
+last ``--recent-days`` is archived and the database is vacuumed. The sizes
+on disk, which include the rollups kept in the database, and the latency of
+reading a patient's month, a time window across patients and a patient's
+statistics are reported for both.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_archive --rows 200000 --users 20
+"""
+import argparse
+import os
+import shutil
+from datetime import datetime, timedelta
+
+from medops.models import stats
+from medops.models.archive import ColdArchive, archive_data
+from medops.models.device_models import DataStorage, GlucometerDatum
+
+from .common import report, synthetic_data, temporary_db_filename, timer
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="Number of readings to store.")
+    parser.add_argument("--users", type=int, default=20, help="Number of patients the readings are spread over.")
+    parser.add_argument("--step", type=float, default=60, help="Seconds between readings.")
+    parser.add_argument("--recent-days", type=float, default=7, help="Days of data kept in SQLite.")
+    args = parser.parse_args()
+
+    start = datetime(2022, 1, 1)
+    step = timedelta(seconds=args.step)
+    end = start + step * args.rows
+    data = synthetic_data(args.rows, n_users=args.users, start=start, step=step)
+    month = dict(assigned_user=0, since=start, until=start + timedelta(days=30))
+    window = dict(since=start + (end - start) / 4, until=start + (end - start) / 2)
+
+    sizes = {}
+    month_reads, window_reads, stats_reads = {}, {}, {}
+    n_month = n_window = 0
+    with temporary_db_filename() as filename:
+        archive_dir = filename + ".archive"
+        for name in ["sqlite", "archive"]:
+            storage = DataStorage(filename)
+            storage.bulk_create(data)
+            if name == "archive":
+                storage.archive = ColdArchive(archive_dir)
+                archive_data(storage, storage.archive, end - timedelta(days=args.recent_days))
+            storage.database.execute_sql("VACUUM")
+            sizes[name] = (os.path.getsize(filename), directory_size(archive_dir))
+
+            with timer(month_reads, name):
+                n_month = sum(1 for _ in storage.iter_query(**month))
+            with timer(window_reads, name):
+                n_window = sum(1 for _ in storage.iter_query(**window))
+            with timer(stats_reads, name):
+                stats.compute_stats(storage, GlucometerDatum, assigned_user=0)
+
+            storage.deinit()
+            os.unlink(filename)
+            shutil.rmtree(archive_dir, ignore_errors=True)
+
+    print(f"Size on disk of {args.rows:,} readings")
+    for name, (db_size, archive_size) in sizes.items():
+        size = db_size + archive_size
+        print(f"  {name:<30} {size / 1e6:10.2f} MB  {size / args.rows:10.1f} bytes/reading"
+              f"  (database {db_size / 1e6:.2f} MB, archive {archive_size / 1e6:.2f} MB)")
+    report(f"Reading one patient's first month ({n_month:,} readings)", n_month, month_reads)
+    report(f"Reading a time window across patients ({n_window:,} readings)", n_window, window_reads)
+    report("Glucose statistics of one patient", 1, stats_reads, unit="queries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compare ``POST /data`` with JSON bodies against the binary format of
+:mod:`medops.models.binary_format` at the same volume of pulse oximeter
+readings (pulse and blood saturation).
+
+Two measurements are made:
+
+* decoding only: ``json.loads`` plus ``parse_datum`` per data point against
+  ``binary_format.decode``;
+* end to end, posting the bodies through the Flask test client into an
+  empty SQLite database.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_binary_ingest --rows 5000 --requests 20
+"""
+import argparse
+import json
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from medops import apis, models
+from medops.apis.data import BINARY_MIMETYPE, parse_datum
+from medops.models import binary_format
+from medops.models.device_models import BloodSaturationDatum, PulseDatum
+
+from .common import report, temporary_db_filename, timer
+
+
+def request_bodies(n_requests: int, n_rows: int) -> tuple[list, list]:
+    """Build the JSON and binary bodies of the same readings. Each request
+    holds n_rows readings from one device, half pulse and half saturation."""
+    json_bodies = []
+    binary_bodies = []
+    start = datetime(2022, 1, 1)
+    half = n_rows // 2
+    for device_id in range(n_requests):
+        times = [start + timedelta(seconds=i) for i in range(half)]
+        bpm = [60 + i % 40 for i in range(half)]
+        percentage = [95 + (i % 50) / 10 for i in range(half)]
+
+        points = []
+        for t, b, p in zip(times, bpm, percentage):
+            common = dict(device_id=device_id, assigned_user=device_id, collection_time=t.isoformat())
+            points.append(dict(common, data_type="heart_rate", data=dict(bpm=b)))
+            points.append(dict(common, data_type="oxygen_saturation", data=dict(percentage=p)))
+        json_bodies.append(json.dumps(dict(data=points)).encode())
+
+        binary_bodies.append(b"".join([
+            binary_format.encode_block(PulseDatum, device_id, times, dict(bpm=bpm), assigned_user=device_id),
+            binary_format.encode_block(BloodSaturationDatum, device_id, times, dict(percentage=percentage),
+                                       assigned_user=device_id),
+        ]))
+    return json_bodies, binary_bodies
+
+
+def decode_json(body: bytes) -> list:
+    return [parse_datum(i, payload)[0] for i, payload in enumerate(json.loads(body)["data"])]
+
+
+def post_all(bodies: list, content_type: str):
+    with temporary_db_filename() as filename:
+        app = Flask(__name__)
+        app.register_blueprint(apis.DATA_API_BLUEPRINT, url_prefix="/data")
+        models.init_db(app, {"DATA_DB_FILENAME": filename})
+        with app.test_client() as client:
+            for body in bodies:
+                resp = client.post("/data", data=body, content_type=content_type)
+                assert resp.status_code == 201, resp.get_data()
+        models.deinit(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000,
+                        help="Number of readings per request.")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="Number of requests to post.")
+    args = parser.parse_args()
+
+    json_bodies, binary_bodies = request_bodies(args.requests, args.rows)
+    n_rows = args.requests * (args.rows // 2) * 2
+    for name, bodies in [("JSON", json_bodies), ("binary", binary_bodies)]:
+        size = sum(len(body) for body in bodies)
+        print(f"{name:<8} {size:12,} bytes  {size / n_rows:6.1f} bytes/reading")
+
+    results = {}
+    with timer(results, "json.loads() + parse_datum()"):
+        for body in json_bodies:
+            decode_json(body)
+    with timer(results, "binary_format.decode()"):
+        for body in binary_bodies:
+            binary_format.decode(body)
+    report(f"Decoding {args.requests} x {args.rows} readings", n_rows, results, unit="readings")
+
+    results = {}
+    with timer(results, "POST /data JSON"):
+        post_all(json_bodies, "application/json")
+    with timer(results, "POST /data binary"):
+        post_all(binary_bodies, BINARY_MIMETYPE)
+    report(f"Ingesting {args.requests} x {args.rows} readings", n_rows, results, unit="readings")
+
+
+if __name__ == "__main__":
+    main()
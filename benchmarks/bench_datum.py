@@ -0,0 +1,112 @@
+"""
+Measure the cost of datum objects and of converting stored rows into them.
+
+Three measurements are made on ``--rows`` pulse readings:
+
+* the memory per datum of the slotted datum classes against the same class
+  without slots, measured with :mod:`tracemalloc`;
+* conversion of model instances, comparing the previous ``to_dataclass``
+  (a scan of ``DATUM_TO_MODEL`` and a kwargs dict built from the fields)
+  against the precomputed :class:`~medops.models.device_models.DatumConverter`,
+  and conversion straight from row tuples;
+* end to end, ``DataStorage.query`` on ``--db-rows`` stored readings.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_datum --rows 1000000 --db-rows 200000
+"""
+import argparse
+import gc
+import tracemalloc
+from datetime import datetime
+from typing import Optional
+
+import attr
+
+from medops.models.device_models import (
+    DATUM_TO_MODEL,
+    DataStorage,
+    PulseDatum,
+    PulseDatumModel
+)
+
+from .common import report, synthetic_data, temporary_db_filename, timer
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class UnslottedPulseDatum:
+    """PulseDatum as it was defined before the datum classes had slots."""
+    device_id: int
+    assigned_user: int
+    received_time: datetime
+    collection_time: datetime
+    datum_id: Optional[int] = None
+    bpm: int
+
+
+def previous_to_dataclass(model):
+    """The conversion used before the converters were precomputed."""
+    DatumClass = None
+    for data_cls, model_cls in DATUM_TO_MODEL.items():
+        if isinstance(model, model_cls):
+            DatumClass = data_cls
+
+    attrs = {}
+    for field in model._meta.sorted_fields:
+        attrs[field.name] = getattr(model, field.name)
+    return DatumClass(**attrs)
+
+
+def bytes_per_datum(datum_cls, rows: list) -> float:
+    """The memory allocated per datum, including its slot in a list."""
+    names = [field.name for field in PulseDatumModel._meta.sorted_fields]
+    gc.collect()
+    tracemalloc.start()
+    data = [datum_cls(**dict(zip(names, row))) for row in rows]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000,
+                        help="Number of in-memory readings for the memory and conversion benchmarks.")
+    parser.add_argument("--db-rows", type=int, default=200_000,
+                        help="Number of stored readings for the end to end benchmark.")
+    args = parser.parse_args()
+
+    now = datetime.now()
+    rows = [(i, i % 100, i % 1000, now, now, 60 + i % 100) for i in range(args.rows)]
+
+    print(f"Memory of {args.rows:,} pulse readings")
+    for name, datum_cls in [("without slots", UnslottedPulseDatum), ("slotted", PulseDatum)]:
+        print(f"  {name:<30} {bytes_per_datum(datum_cls, rows):10.1f} bytes/datum")
+
+    names = [field.name for field in PulseDatumModel._meta.sorted_fields]
+    models = [PulseDatumModel(**dict(zip(names, row))) for row in rows]
+    converter = PulseDatumModel.converter()
+    results = {}
+    with timer(results, "previous to_dataclass()"):
+        expected = [previous_to_dataclass(m) for m in models]
+    with timer(results, "to_dataclass()"):
+        converted = [m.to_dataclass() for m in models]
+    with timer(results, "DatumConverter.from_row()"):
+        from_rows = [converter.from_row(row) for row in rows]
+    assert expected == converted == from_rows
+    del models, expected, converted, from_rows
+    report(f"Conversion of {args.rows:,} pulse readings", args.rows, results, unit="objects")
+
+    with temporary_db_filename() as filename:
+        storage = DataStorage(filename)
+        storage.bulk_create(synthetic_data(args.db_rows, types=[PulseDatum]), run_hooks=False)
+        results = {}
+        with timer(results, "query()"):
+            storage.query(types=[PulseDatum])
+        storage.deinit()
+    report(f"Query of {args.db_rows:,} stored pulse readings", args.db_rows, results, unit="objects")
+
+
+if __name__ == "__main__":
+    main()
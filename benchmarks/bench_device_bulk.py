@@ -0,0 +1,73 @@
+"""
+Measure registering a ward's devices one ``POST /devices`` request at a time
+against a single ``POST /devices/bulk`` request with a JSON array or CSV.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_device_bulk --devices 5000
+"""
+import argparse
+import csv
+import io
+
+from flask import Flask
+
+from medops import apis, models
+
+from .common import report, temporary_db_filename, timer
+
+
+def device_rows(n_devices: int) -> list[dict]:
+    return [dict(name=f"Device-{i:06d}",
+                 serial_number=f"SN{i:09d}",
+                 mac_address=f"02:00:00:{i >> 16 & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}",
+                 current_firmware_version="1.0.0",
+                 date_of_purchase="2022-01-01")
+            for i in range(n_devices)]
+
+
+def to_csv(rows: list[dict]) -> str:
+    body = io.StringIO()
+    writer = csv.DictWriter(body, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return body.getvalue()
+
+
+def register(rows: list[dict], mode: str):
+    with temporary_db_filename() as filename:
+        app = Flask(__name__)
+        app.register_blueprint(apis.DEVICES_API_BLUEPRINT, url_prefix="/devices")
+        models.init_db(app, {"DEVICES_FILENAME": filename})
+        with app.test_client() as client:
+            if mode == "single":
+                for row in rows:
+                    resp = client.post("/devices", json=row)
+                    assert resp.status_code == 200, resp.get_data()
+            elif mode == "json":
+                resp = client.post("/devices/bulk", json=rows)
+                assert resp.status_code == 200, resp.get_data()
+            else:
+                resp = client.post("/devices/bulk", data=to_csv(rows), content_type="text/csv")
+                assert resp.status_code == 200, resp.get_data()
+        models.deinit(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=5000,
+                        help="Number of devices registered.")
+    args = parser.parse_args()
+
+    rows = device_rows(args.devices)
+    results = {}
+    for name, mode in [("POST /devices per device", "single"),
+                       ("POST /devices/bulk JSON", "json"),
+                       ("POST /devices/bulk CSV", "csv")]:
+        with timer(results, name):
+            register(rows, mode)
+    report(f"Registering {args.devices:,} devices", args.devices, results, unit="devices")
+
+
+if __name__ == "__main__":
+    main()
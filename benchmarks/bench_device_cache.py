@@ -0,0 +1,76 @@
+"""
+Measure the latency of ``GET /devices/<id>`` with the device cache of
+``DeviceStorage`` disabled and enabled.
+
+The devices are read at random, with a share of the reads going to a small
+set of busy devices, as when gateways upload often. The cache is large
+enough to hold every device unless ``--cache-size`` is given.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_device_cache --devices 1000 --requests 20000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from flask import Flask
+
+from medops import apis, models
+from medops.models.device_models import DEVICE_CACHE_TTL
+
+from .common import temporary_db_filename
+
+
+def read_devices(n_devices: int, n_requests: int, cache_size: int, seed: int = 0) -> list[float]:
+    """Create devices, then read them through the API. Returns the latency
+    of each read in seconds."""
+    rng = random.Random(seed)
+    with temporary_db_filename() as filename:
+        app = Flask(__name__)
+        app.register_blueprint(apis.DEVICES_API_BLUEPRINT, url_prefix="/devices")
+        models.init_db(app, {"DEVICES_FILENAME": filename,
+                             "DEVICES_CACHE_SIZE": cache_size,
+                             "DEVICES_CACHE_TTL": DEVICE_CACHE_TTL})
+        latencies = []
+        with app.test_client() as client:
+            device_ids = []
+            for i in range(n_devices):
+                resp = client.post("/devices", json=dict(name=f"Device-{i:05d}", serial_number=f"SN{i:08d}"))
+                assert resp.status_code == 200, resp.get_data()
+                device_ids.append(resp.json["device_id"])
+
+            busy = device_ids[:max(1, n_devices // 20)]
+            for _ in range(n_requests):
+                device_id = rng.choice(busy if rng.random() < 0.8 else device_ids)
+                start = time.perf_counter()
+                resp = client.get(f"/devices/{device_id}")
+                latencies.append(time.perf_counter() - start)
+                assert resp.status_code == 200
+        models.deinit(app)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=1000,
+                        help="Number of devices created.")
+    parser.add_argument("--requests", type=int, default=20_000,
+                        help="Number of GET requests.")
+    parser.add_argument("--cache-size", type=int, default=None,
+                        help="Number of cached devices. Defaults to the number of devices.")
+    args = parser.parse_args()
+
+    cache_size = args.cache_size or args.devices
+    print(f"GET /devices/<id> x {args.requests:,} over {args.devices:,} devices")
+    for name, size in [("cache off", 0), (f"cache of {cache_size:,}", cache_size)]:
+        latencies = read_devices(args.devices, args.requests, size)
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"  {name:<20} mean {statistics.fmean(latencies) * 1e6:8.1f} us"
+              f"  p50 {percentiles[49] * 1e6:8.1f} us  p99 {percentiles[98] * 1e6:8.1f} us"
+              f"  {len(latencies) / sum(latencies):10,.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure looking a device up by serial number, the way gateways resolve
+their ``device_id``: listing the whole fleet and scanning it, against the
+indexed ``DeviceStorage.query(serial_number=...)``. Also times paging
+through the devices running one firmware version.
+
+The device cache is disabled so that every lookup reads the database.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_device_lookup --devices 100000 --lookups 20
+"""
+import argparse
+import random
+
+from peewee import chunked
+
+from medops.models.device_models import DeviceModel, DeviceStorage
+
+from .common import report, temporary_db_filename, timer
+
+FIRMWARE_VERSIONS = ["1.0.0", "1.1.0", "1.2.0", "2.0.0"]
+
+
+def create_devices(n_devices: int):
+    rows = [dict(name=f"Device-{i:07d}",
+                 serial_number=f"SN{i:09d}",
+                 mac_address=f"02:00:{i >> 24 & 255:02x}:{i >> 16 & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}",
+                 current_firmware_version=FIRMWARE_VERSIONS[i % len(FIRMWARE_VERSIONS)])
+            for i in range(n_devices)]
+    with DeviceModel._meta.database.atomic():
+        for batch in chunked(rows, 100):
+            DeviceModel.insert_many(batch).execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=100_000,
+                        help="Number of devices in the fleet.")
+    parser.add_argument("--lookups", type=int, default=20,
+                        help="Number of lookups by serial number.")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="Number of devices per page.")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    serial_numbers = [f"SN{rng.randrange(args.devices):09d}" for _ in range(args.lookups)]
+    with temporary_db_filename() as filename:
+        storage = DeviceStorage(filename, cache_size=0)
+        create_devices(args.devices)
+
+        results = {}
+        with timer(results, "query() + scan"):
+            for serial_number in serial_numbers:
+                found = [d for d in storage.query() if d.serial_number == serial_number]
+                assert len(found) == 1
+        with timer(results, "query(serial_number=...)"):
+            for serial_number in serial_numbers:
+                assert len(storage.query(serial_number=serial_number)) == 1
+        report(f"Looking up {args.lookups} devices among {args.devices:,}", args.lookups, results,
+               unit="lookups")
+
+        results = {}
+        with timer(results, f"pages of {args.page_size:,}"):
+            n_devices = 0
+            after = None
+            while True:
+                page = storage.query(current_firmware_version=FIRMWARE_VERSIONS[0],
+                                     limit=args.page_size, after=after)
+                n_devices += len(page)
+                if len(page) < args.page_size:
+                    break
+                after = page[-1].device_id
+        report(f"Paging through {n_devices:,} devices of one firmware version", n_devices, results,
+               unit="devices")
+        storage.deinit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Compare ingestion throughput of :func:`store_data` using one
+``DataStorage.create`` call per datum against ``DataStorage.bulk_create``.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_ingest --rows 2000 --requests 10
+"""
+import argparse
+
+from medops.models.device_models import DataStorage
+
+from .common import report, synthetic_data, temporary_db_filename, timer
+
+
+def per_row(storage: DataStorage, batches):
+    for batch in batches:
+        for datum in batch:
+            storage.create(datum)
+
+
+def bulk(storage: DataStorage, batches):
+    for batch in batches:
+        storage.bulk_create(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2000,
+                        help="Number of readings per request.")
+    parser.add_argument("--requests", type=int, default=5,
+                        help="Number of requests (batches) to ingest.")
+    args = parser.parse_args()
+
+    batches = [synthetic_data(args.rows) for _ in range(args.requests)]
+    results = {}
+    for name, func in [("create() per datum", per_row), ("bulk_create()", bulk)]:
+        with temporary_db_filename() as filename:
+            storage = DataStorage(filename)
+            with timer(results, name):
+                func(storage, batches)
+            storage.deinit()
+
+    report(f"Ingesting {args.requests} x {args.rows} readings", args.rows * args.requests, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare the per-type tables layout (``DataStorage``), the single wide
+table layout (``WideDataStorage``) and the monthly partitioned layout
+(``PartitionedDataStorage``) for ingestion, for reading a patient's timeline
+across all datum types and for reading a time window.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_layouts --rows 200000 --users 50 --step 60
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from medops.models.device_models import DataStorage
+from medops.models.partitioned_storage import PartitionedDataStorage
+from medops.models.wide_storage import WideDataStorage
+
+from .common import report, synthetic_data, temporary_db_filename, timer
+
+LAYOUTS = {
+    "tables": DataStorage,
+    "wide": WideDataStorage,
+    "monthly": PartitionedDataStorage,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="Number of readings to store.")
+    parser.add_argument("--users", type=int, default=50, help="Number of patients the readings are spread over.")
+    parser.add_argument("--batch", type=int, default=2000, help="Number of readings per ingestion batch.")
+    parser.add_argument("--step", type=float, default=60,
+                        help="Seconds between readings. The default spreads 200,000 readings over several months.")
+    args = parser.parse_args()
+
+    start = datetime(2022, 1, 1)
+    step = timedelta(seconds=args.step)
+    data = synthetic_data(args.rows, n_users=args.users, start=start, step=step)
+    batches = [data[i:i + args.batch] for i in range(0, len(data), args.batch)]
+    window = (start + step * (args.rows // 4), start + step * (args.rows // 2))
+
+    ingest, timeline, window_reads = {}, {}, {}
+    n_timeline = n_window = 0
+    for name, Storage in LAYOUTS.items():
+        with temporary_db_filename() as filename:
+            storage = Storage(filename)
+            with timer(ingest, name):
+                for batch in batches:
+                    storage.bulk_create(batch)
+
+            with timer(timeline, name):
+                n_timeline = sum(1 for _ in storage.iter_query(assigned_user=0))
+
+            with timer(window_reads, name):
+                n_window = sum(1 for _ in storage.iter_query(since=window[0], until=window[1]))
+            storage.deinit()
+
+    report(f"Ingesting {args.rows:,} readings in batches of {args.batch}", args.rows, ingest)
+    report(f"Reading one patient's timeline ({n_timeline:,} readings)", n_timeline, timeline)
+    report(f"Reading a time window across patients ({n_window:,} readings)", n_window, window_reads)
+
+
+if __name__ == "__main__":
+    main()
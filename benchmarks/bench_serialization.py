@@ -0,0 +1,75 @@
+"""
+Measure the serialization of large ``/data`` and ``/users`` responses.
+
+The previous path, ``to_dict``/``to_json`` followed by ``flask.jsonify``, is
+compared against the compiled encoders of
+:mod:`medops.models.serialization` with the standard library and, when it is
+installed, the orjson backend. Only serialization is timed, the data are
+generated in memory.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_serialization --rows 200000 --users 20000
+"""
+import argparse
+from datetime import date
+
+from flask import Flask, jsonify
+
+from medops.apis.users import USER_ENCODER
+from medops.models import serialization
+from medops.models.user_models import User, UserRole
+
+from .common import report, synthetic_data, timer
+
+
+def synthetic_users(n_users: int) -> list:
+    """Users with a role and two related patients each, like the
+    responses of ``GET /users``."""
+    roles = [UserRole(role_id=1, role_name="nurse")]
+
+    def user(user_id, patients=()):
+        return User(user_id=user_id,
+                    dob=date(1980, 1 + user_id % 12, 1 + user_id % 28),
+                    first_name=f"First{user_id}",
+                    last_name=f"Last{user_id}",
+                    email=f"user{user_id}@example.com",
+                    password="0" * 64,
+                    roles=roles,
+                    patients=list(patients))
+
+    return [user(i, [user(n_users + 2 * i), user(n_users + 2 * i + 1)]) for i in range(n_users)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000,
+                        help="Number of data in the /data response.")
+    parser.add_argument("--users", type=int, default=20_000,
+                        help="Number of users in the /users response.")
+    args = parser.parse_args()
+
+    backends = ["json"] if serialization.orjson is None else ["json", "orjson"]
+    app = Flask(__name__)
+    with app.app_context():
+        data = synthetic_data(args.rows)
+        results = {}
+        with timer(results, "to_dict() + jsonify"):
+            jsonify(data=[d.to_dict() for d in data], next_cursor=None).get_data()
+        for backend in backends:
+            with timer(results, f"encoders + {backend}"):
+                serialization.dumps(dict(data=[serialization.encode(d) for d in data], next_cursor=None), backend)
+        report(f"Serializing {args.rows:,} data", args.rows, results, unit="data")
+
+        users = synthetic_users(args.users)
+        results = {}
+        with timer(results, "to_json() + jsonify"):
+            jsonify(users=[u.to_json() for u in users]).get_data()
+        for backend in backends:
+            with timer(results, f"encoders + {backend}"):
+                serialization.dumps(dict(users=[USER_ENCODER(u) for u in users]), backend)
+        report(f"Serializing {args.users:,} users", args.users, results, unit="users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Measure concurrent ingestion into one SQLite file against the same data
+spread over several shards with
+:class:`medops.models.sharding.ShardedDataStorage`.
+
+Several processes, like the workers of a server, each store the readings of
+their own patients in small batches of one patient, one transaction per
+batch, as gateways posting to ``/data`` would. With one file every commit waits for the single
+write lock, with shards only commits to the same shard do.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_sharding --workers 4 --shards 4 --batches 200
+"""
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta
+
+from medops.models.device_models import DataStorage
+from medops.models.sharding import ShardedDataStorage
+
+from .common import report, synthetic_data, temporary_db_filename, timer
+
+
+def ingest(args: tuple):
+    """Store the batches of one worker's patients."""
+    filename, n_shards, worker, n_workers, n_batches, batch_size = args
+    storage = DataStorage(filename) if n_shards == 1 else ShardedDataStorage(filename, n_shards)
+    data = synthetic_data(n_batches * batch_size, start=datetime(2022, 1, 1) + timedelta(milliseconds=worker))
+    for i, datum in enumerate(data):
+        # Each batch holds the readings of one patient, and the patients of
+        # the workers differ.
+        datum.assigned_user = (i // batch_size % 10) * n_workers + worker
+    try:
+        for i in range(n_batches):
+            storage.bulk_create(data[i * batch_size:(i + 1) * batch_size])
+    finally:
+        storage.deinit()
+
+
+def run(n_shards: int, n_workers: int, n_batches: int, batch_size: int):
+    with temporary_db_filename() as filename:
+        # Create the tables before the workers start.
+        (DataStorage(filename) if n_shards == 1 else ShardedDataStorage(filename, n_shards)).deinit()
+        jobs = [(filename, n_shards, worker, n_workers, n_batches, batch_size) for worker in range(n_workers)]
+        with multiprocessing.Pool(n_workers) as pool:
+            pool.map(ingest, jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of processes storing data.")
+    parser.add_argument("--shards", type=int, default=4,
+                        help="Number of shards to compare with a single file.")
+    parser.add_argument("--batches", type=int, default=200,
+                        help="Number of batches stored by each process.")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Number of readings per batch.")
+    args = parser.parse_args()
+
+    results = {}
+    for n_shards in [1, args.shards]:
+        with timer(results, f"{n_shards} shard(s)"):
+            run(n_shards, args.workers, args.batches, args.batch_size)
+
+    n_rows = args.workers * args.batches * args.batch_size
+    report(f"{args.workers} processes storing {n_rows:,} readings in batches of {args.batch_size}",
+           n_rows, results, unit="readings")
+
+
+if __name__ == "__main__":
+    main()
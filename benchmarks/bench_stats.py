@@ -0,0 +1,87 @@
+"""
+Compare the NumPy statistics in :mod:`medops.models.stats` against a pure
+Python implementation.
+
+Two measurements are made:
+
+* compute only, on ``--rows`` synthetic glucose readings held in memory
+  (a Python list vs a NumPy array);
+* end to end, on ``--db-rows`` readings stored in SQLite, comparing
+  ``DataStorage.query`` plus Python statistics against ``compute_stats``.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_stats --rows 10000000 --db-rows 200000
+"""
+import argparse
+import random
+import statistics
+
+import numpy as np
+
+from medops.models import stats
+from medops.models.device_models import DataStorage, GlucometerDatum
+
+from .common import report, synthetic_data, temporary_db_filename, timer
+
+
+def python_percentile(ordered: list, p: float) -> float:
+    """Linear interpolation percentile, matching numpy's default."""
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def python_stats(values: list) -> dict:
+    ordered = sorted(values)
+    low, high = stats.GLUCOSE_TARGET_RANGE
+    return dict(
+        count=len(values),
+        mean=statistics.fmean(values),
+        std=statistics.pstdev(values),
+        min=ordered[0],
+        max=ordered[-1],
+        percentiles={p: python_percentile(ordered, p) for p in stats.DEFAULT_PERCENTILES},
+        time_in_range=sum(1 for v in values if low <= v <= high) / len(values),
+    )
+
+
+def numpy_stats(values: np.ndarray) -> dict:
+    summary = stats.summarize(values)
+    summary["time_in_range"] = stats.fraction_in_range(values, *stats.GLUCOSE_TARGET_RANGE)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000,
+                        help="Number of in-memory readings for the compute only benchmark.")
+    parser.add_argument("--db-rows", type=int, default=200_000,
+                        help="Number of stored readings for the end to end benchmark.")
+    args = parser.parse_args()
+
+    values = [float(random.randint(40, 300)) for _ in range(args.rows)]
+    array = np.array(values)
+    results = {}
+    with timer(results, "pure Python"):
+        expected = python_stats(values)
+    with timer(results, "NumPy"):
+        computed = numpy_stats(array)
+    assert abs(expected["mean"] - computed["mean"]) < 1e-6
+    report(f"Statistics of {args.rows:,} in-memory readings", args.rows, results, unit="readings")
+
+    with temporary_db_filename() as filename:
+        storage = DataStorage(filename)
+        storage.bulk_create(synthetic_data(args.db_rows, types=[GlucometerDatum]))
+        results = {}
+        with timer(results, "query() + pure Python"):
+            python_stats([d.mg_dl for d in storage.query(types=[GlucometerDatum])])
+        with timer(results, "compute_stats()"):
+            stats.compute_stats(storage, GlucometerDatum)
+        storage.deinit()
+    report(f"Statistics of {args.db_rows:,} stored readings", args.db_rows, results, unit="readings")
+
+
+if __name__ == "__main__":
+    main()
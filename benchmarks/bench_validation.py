@@ -0,0 +1,75 @@
+"""
+Measure the validation of posted data points, one at a time with
+``parse_datum`` against the batch validation of ``parse_data``, which checks
+each data type a column at a time.
+
+The batches mix all data types, and optionally a share of invalid data
+points to show the cost of falling back to ``parse_datum`` for them. Only
+validation is timed, the JSON is decoded beforehand.
+
+Run from the root of the repository::
+
+    python -m benchmarks.bench_validation --rows 100000 --invalid 0.01
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from medops.apis.data import parse_data, parse_datum
+
+from .common import report, timer
+
+VALUES = {
+    "temperature": lambda rng: dict(deg_c=round(rng.uniform(35, 40), 1)),
+    "blood_pressure": lambda rng: dict(systolic=rng.randint(90, 160), diastolic=rng.randint(50, 100)),
+    "glucose_level": lambda rng: dict(mg_dl=rng.randint(60, 250)),
+    "heart_rate": lambda rng: dict(bpm=rng.randint(50, 120)),
+    "weight": lambda rng: dict(grams=rng.randint(40000, 120000)),
+    "oxygen_saturation": lambda rng: dict(percentage=round(rng.uniform(90, 100), 1)),
+}
+
+
+def datapoints(n_rows: int, invalid: float, seed: int = 0) -> list:
+    """Posted data points of all types. A share of them have an
+    out of range value."""
+    rng = random.Random(seed)
+    start = datetime(2022, 1, 1)
+    data_types = list(VALUES)
+    points = []
+    for i in range(n_rows):
+        data_type = data_types[i % len(data_types)]
+        data = VALUES[data_type](rng)
+        if rng.random() < invalid:
+            data = {field: -1 for field in data}
+        points.append(dict(device_id=i % 50,
+                           assigned_user=i % 50,
+                           collection_time=(start + timedelta(seconds=i)).isoformat(),
+                           data_type=data_type,
+                           data=data))
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000,
+                        help="Number of data points to validate.")
+    parser.add_argument("--invalid", type=float, default=0.0,
+                        help="Share of data points with an out of range value.")
+    args = parser.parse_args()
+
+    points = datapoints(args.rows, args.invalid)
+    results = {}
+    # Both keep the data, like the endpoint does, so that garbage collection
+    # costs the same.
+    with timer(results, "parse_datum() per data point"):
+        parsed = [parse_datum(i, p) for i, p in enumerate(points)]
+    errors = [error for _, error in parsed if error]
+    del parsed
+    with timer(results, "parse_data() per batch"):
+        _, batch_errors = parse_data(points)
+    assert [error for _, error in batch_errors] == errors
+    report(f"Validating {args.rows:,} data points, {len(errors):,} invalid", args.rows, results, unit="data points")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from medops.models import device_models
+
+# Value generators for each datum type, roughly in physiological ranges.
+VALUE_GENERATORS = {
+    device_models.TemperatureDatum: lambda: dict(deg_c=random.uniform(35.5, 39.0)),
+    device_models.BloodPressureDatum: lambda: dict(systolic=random.uniform(90, 160),
+                                                   diastolic=random.uniform(50, 100)),
+    device_models.GlucometerDatum: lambda: dict(mg_dl=random.randint(50, 250)),
+    device_models.PulseDatum: lambda: dict(bpm=random.randint(45, 160)),
+    device_models.WeightDatum: lambda: dict(grams=random.randint(40000, 120000)),
+    device_models.BloodSaturationDatum: lambda: dict(percentage=random.uniform(85, 100)),
+}
+
+
+def synthetic_data(n_rows: int, n_users: int = 10, n_devices: int = 10,
+                   types=None, start: datetime = None, step: timedelta = timedelta(seconds=1)):
+    """Generate a list of random datum instances.
+
+    Parameters
+    ----------
+    n_rows : int
+        The number of data to generate.
+    n_users : int
+        Data are spread across this many assigned users.
+    n_devices : int
+        Data are spread across this many devices.
+    types : Optional[list]
+        The datum classes to draw from. Defaults to all of them.
+    start : Optional[datetime]
+        The collection time of the first datum.
+    step : timedelta
+        The time between consecutive data.
+
+    Returns
+    -------
+    A list of DeviceDatum instances ordered by collection time.
+    """
+    types = types or list(VALUE_GENERATORS)
+    start = start or datetime(2022, 1, 1)
+    now = datetime.now()
+    data = []
+    for i in range(n_rows):
+        datum_cls = types[i % len(types)]
+        data.append(datum_cls(device_id=i % n_devices,
+                              assigned_user=i % n_users,
+                              received_time=now,
+                              collection_time=start + i * step,
+                              **VALUE_GENERATORS[datum_cls]()))
+    return data
+
+
+@contextmanager
+def temporary_db_filename():
+    """Yield the name of a database file in a temporary directory that is
+    removed afterwards."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yield os.path.join(tmpdir, "benchmark.db")
+
+
+@contextmanager
+def timer(results: dict, name: str):
+    """Record the elapsed wall time of the block in `results[name]`."""
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
+
+
+def report(title: str, n_items: int, results: dict, unit: str = "rows"):
+    """Print the throughput for each timed result."""
+    print(title)
+    for name, elapsed in results.items():
+        rate = n_items / elapsed if elapsed else float("inf")
+        print(f"  {name:<30} {elapsed:10.3f} s  {rate:14,.0f} {unit}/s")
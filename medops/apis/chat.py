@@ -12,13 +12,13 @@ from typing import (
 
 from flask import (
     Blueprint,
-    jsonify,
     request
 )
 
-from .common import error_response
+from .common import error_response, json_response
 from .. import models
 from ..models import chat_model
+from ..models.serialization import encode
 
 MESSAGES_API_BLUEPRINT = Blueprint("messages", __name__)
 
@@ -76,7 +76,7 @@ class MessageEndpoints:
             attachments=attachments,
         )
         models.get_storage("messages").log_message(req.recipient_ids, message)
-        return jsonify(message.to_dict())
+        return json_response(encode(message))
 
 
 class MessagesQueryEndpoint:
@@ -103,13 +103,13 @@ class MessagesQueryEndpoint:
             query.until
         )
 
-        data = [m.to_dict() for m in data]
+        data = [encode(m) for m in data]
         resp_data = {
             "messages": data,
             "count": len(data)
         }
 
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
 
 @MESSAGES_API_BLUEPRINT.route("", methods=["POST"])
@@ -8,5 +8,18 @@ from flask import (
     jsonify
 )
 
+from ..models.serialization import dumps
+
+
+def json_response(*args, **kwargs) -> Response:
+    """Create a JSON response like ``flask.jsonify``, from either a single
+    positional value or keyword arguments. The payload should be built with
+    the encoders of :mod:`medops.models.serialization`. It is serialized by
+    :func:`~medops.models.serialization.dumps`, so it is compact and keys
+    are not sorted."""
+    payload = args[0] if args else kwargs
+    return Response(dumps(payload), mimetype="application/json")
+
+
 def error_response(errors: list[str], status_code=422) -> Tuple[Response, int]:
     return jsonify(errors=errors, count=len(errors)), status_code
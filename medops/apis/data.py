@@ -3,18 +3,30 @@ This module provides the APIs for storing and retrieving
 data from the system.
 """
 
+import base64
+import json
+from collections import Counter
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Optional
 
+import numpy as np
 from flask import (
     Blueprint,
+    Response,
+    current_app,
     request,
-    jsonify
+    jsonify,
+    stream_with_context
 )
 
-from .common import error_response
-from ..models import device_models, get_storage
+from .common import error_response, json_response
+from ..models import binary_format, device_models, get_storage, latest, rollups, stats, waveforms
+from ..models.sharding import ShardedDataStorage
+from ..models.serialization import dumps, encode
+from ..models.admission import retry_after
+from ..models.assignments import UNASSIGNED_USER
+from ..models.ingest_writer import QueueFullError, WriteFailedError
 
 DATA_API_BLUEPRINT = Blueprint("data", __name__)
 
@@ -26,6 +38,57 @@ MODEL_TYPE_NAMES = {
     "heart_rate": device_models.PulseDatum,
     "weight": device_models.WeightDatum
 }
+# Maps datum class names, as used by rollups, to the names used by the API.
+TYPE_NAMES = {datum_cls.__name__: name for name, datum_cls in MODEL_TYPE_NAMES.items()}
+
+# The number of data returned per page when the request does not set a limit.
+DEFAULT_PAGE_SIZE = 1000
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Data packed in the binary format of medops.models.binary_format.
+BINARY_MIMETYPE = "application/vnd.medops.readings"
+
+# The sample types of posted waveforms.
+SAMPLE_TYPES = {
+    "int16": "<i2",
+    "int32": "<i4",
+    "float32": "<f4",
+    "float64": "<f8",
+}
+
+# The number of serialized data written to the response at a time when
+# streaming. Writing in chunks avoids a tiny socket write per datum.
+STREAM_CHUNK_SIZE = 500
+
+# The number of data stored at a time when ingesting newline delimited JSON.
+NDJSON_BATCH_SIZE = 1000
+
+
+def encode_cursor(key: tuple) -> str:
+    """Encode a datum sort key as an opaque, URL safe cursor string. The key
+    of sharded data also holds the shard index, see
+    :meth:`ShardedDataStorage.sort_key`."""
+    collection_time, *rest = key
+    raw = json.dumps([collection_time.isoformat(), *rest])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor created by :func:`encode_cursor`.
+
+    Raises
+    ------
+    ValueError if the cursor is malformed.
+    """
+    try:
+        collection_time, type_name, *ids = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(ids) not in (1, 2):
+            raise ValueError(cursor)
+        return (datetime.fromisoformat(collection_time), str(type_name), *map(int, ids))
+    except (TypeError, ValueError, UnicodeDecodeError) as err:
+        raise ValueError(f"Invalid cursor: {cursor}") from err
+
 
 @dataclass
 class JSONDatum:
@@ -36,15 +99,384 @@ class JSONDatum:
     assigned_user: Optional[int] = None
 
 
+# The keys of a posted data point, see JSONDatum.
+REQUIRED_KEYS = frozenset(["device_id", "collection_time", "data_type", "data"])
+ALLOWED_KEYS = REQUIRED_KEYS | {"assigned_user"}
+
+# The measurement fields posted in `data` for each data type.
+VALUE_FIELDS = {
+    name: frozenset(device_models.datum_value_fields(datum_cls)) for name, datum_cls in MODEL_TYPE_NAMES.items()
+}
+
+NUMBER_TYPES = frozenset(device_models.NUMBER_TYPES)
+
+
+def parse_query_args(args) -> tuple[dict, list[str]]:
+    """Parse the filters for querying data from the request's query
+    string parameters.
+
+    Parameters
+    ----------
+    args : werkzeug.datastructures.MultiDict
+        The request's query string arguments.
+
+    Returns
+    -------
+    A tuple of the keyword arguments for :meth:`DataStorage.query` and a
+    list of error messages.
+    """
+    kwargs = {}
+    errors = []
+    for name in ["assigned_user", "device_id", "limit"]:
+        if name in args:
+            try:
+                kwargs[name] = int(args[name])
+            except ValueError:
+                errors.append(f"{name} must be an integer.")
+
+    if kwargs.get("limit", 1) < 1:
+        errors.append("limit must be greater than zero.")
+
+    for name in ["since", "until"]:
+        if name in args:
+            try:
+                # Times are stored as naive UTC.
+                kwargs[name] = device_models.naive_utc(datetime.fromisoformat(args[name]))
+            except ValueError:
+                errors.append(f"{name} must be an ISO-8601 date-time string.")
+
+    if "types" in args:
+        kwargs["types"] = []
+        for data_type in args["types"].split(","):
+            if data_type not in MODEL_TYPE_NAMES:
+                errors.append(f"Invalid data type: {data_type}")
+            else:
+                kwargs["types"].append(MODEL_TYPE_NAMES[data_type])
+
+    if "cursor" in args:
+        try:
+            kwargs["after"] = decode_cursor(args["cursor"])
+        except ValueError as err:
+            errors.append(str(err))
+
+    return kwargs, errors
+
+
+def wants_stream() -> bool:
+    """Whether the client asked for data to be streamed as newline
+    delimited JSON, either with ?stream=1 or the Accept header."""
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return True
+
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def stream_ndjson(data):
+    """Serialize data one JSON object per line as they are read.
+
+    Parameters
+    ----------
+    data : Iterator[DeviceDatum]
+        The data to serialize.
+
+    Returns
+    -------
+    A generator of response body chunks.
+    """
+    chunk = []
+    for datum in data:
+        chunk.append(dumps(encode(datum)))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def parse_datum(index: int, payload: dict) -> tuple[Optional[device_models.DeviceDatum], Optional[str]]:
+    """Validate a single posted data point and convert it into a datum.
+
+    Parameters
+    ----------
+    index : int
+        The position of the data point in the request, used in error messages.
+    payload : dict
+        The posted data point. See :class:`JSONDatum`.
+
+    Returns
+    -------
+    A tuple of the datum and an error message. Exactly one of them is None.
+    """
+    try:
+        posted = JSONDatum(**payload)
+        data_type = posted.data_type
+        if data_type not in MODEL_TYPE_NAMES:
+            return None, f"Invalid data type: {data_type}"
+
+        received_time = datetime.now()
+        data = posted.data
+        # Data without an assigned user are tagged later by assign_users.
+        datum = MODEL_TYPE_NAMES[data_type](
+            device_id=posted.device_id,
+            assigned_user=posted.assigned_user,
+            received_time=received_time,
+            collection_time=datetime.fromisoformat(posted.collection_time),
+            **data
+        )
+        error = device_models.invalid_value(datum)
+        if error:
+            return None, f"Error processing data point {index}: {error}"
+        return datum, None
+    except (TypeError, ValueError) as err:
+        return None, f"Error processing data point {index}: {err}"
+
+
+def _fromisoformat(timestamp: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_data(datapoints: list, indices: Optional[list] = None) -> tuple[list, list[tuple[int, str]]]:
+    """Validate a batch of posted data points and convert them into data.
+
+    The data points are grouped by `data_type` and each group is checked a
+    column at a time: the collection times are parsed in one pass and the
+    measurement values are type checked and compared to
+    :data:`~medops.models.device_models.VALUE_RANGES` with NumPy over the
+    whole column. Data points that fail a check, or that are not shaped like
+    a :class:`JSONDatum`, are validated again with :func:`parse_datum`, so
+    the error messages are the same as validating one data point at a time.
+
+    Parameters
+    ----------
+    datapoints : list
+        The posted data points.
+    indices : Optional[list]
+        The index of each data point used in error messages. Defaults to
+        the position of the data point in `datapoints`.
+
+    Returns
+    -------
+    A tuple of the valid data and a list of ``(index, error message)``
+    tuples, both in the order of the data points.
+    """
+    if indices is None:
+        indices = range(len(datapoints))
+
+    received_time = datetime.now()
+    results = [None] * len(datapoints)
+    slow = []
+    groups = {}
+    for position, payload in enumerate(datapoints):
+        # Anything but a dict of the keys of a JSONDatum, with the
+        # measurement fields of a known data type, is validated one at a time.
+        try:
+            data_type = payload["data_type"]
+            keys = payload.keys()
+            if (keys == ALLOWED_KEYS or keys == REQUIRED_KEYS) and payload["data"].keys() == VALUE_FIELDS[data_type]:
+                groups.setdefault(data_type, []).append(position)
+                continue
+        except (AttributeError, KeyError, TypeError):
+            pass
+        slow.append(position)
+
+    for data_type, positions in groups.items():
+        datum_cls = MODEL_TYPE_NAMES[data_type]
+        payloads = [datapoints[position] for position in positions]
+        timestamps = [payload["collection_time"] for payload in payloads]
+        try:
+            collection_times = list(map(datetime.fromisoformat, timestamps))
+            valid = np.ones(len(positions), dtype=bool)
+        except (TypeError, ValueError):
+            collection_times = list(map(_fromisoformat, timestamps))
+            valid = np.array([t is not None for t in collection_times], dtype=bool)
+
+        for field, (low, high) in device_models.VALUE_RANGES[datum_cls].items():
+            column = [payload["data"][field] for payload in payloads]
+            if not set(map(type, column)) <= NUMBER_TYPES:
+                # NaN fails the range check below.
+                column = [value if type(value) in NUMBER_TYPES else np.nan for value in column]
+            try:
+                values = np.array(column, dtype=float)
+            except OverflowError:
+                valid[:] = False
+                break
+            valid &= (values >= low) & (values <= high)
+
+        for payload, position, collection_time, ok in zip(payloads, positions, collection_times, valid.tolist()):
+            if ok:
+                results[position] = datum_cls(
+                    device_id=payload["device_id"],
+                    assigned_user=payload.get("assigned_user"),
+                    received_time=received_time,
+                    collection_time=collection_time,
+                    **payload["data"]
+                )
+            else:
+                slow.append(position)
+
+    errors = []
+    for position in sorted(slow):
+        datum, error = parse_datum(indices[position], datapoints[position])
+        if error:
+            errors.append((indices[position], error))
+        results[position] = datum
+
+    return [datum for datum in results if datum is not None], errors
+
+
+def parse_waveform(payload: dict) -> tuple[Optional[waveforms.WaveformDatum], Optional[str]]:
+    """Validate a posted waveform segment and convert it into a datum.
+
+    Parameters
+    ----------
+    payload : dict
+        The posted segment with the `device_id`, the optional
+        `assigned_user`, the `waveform` type, the `collection_time` of the
+        first sample, the `sample_rate` in Hz, the list of `samples` and
+        optionally their `sample_type`, one of :data:`SAMPLE_TYPES`. By
+        default integer samples are stored as int16 if they fit and other
+        samples as float64.
+
+    Returns
+    -------
+    A tuple of the datum and an error message. Exactly one of them is None.
+    """
+    try:
+        for name in ["device_id", "waveform", "collection_time", "sample_rate", "samples"]:
+            if name not in payload:
+                return None, f"Missing required field: {name}"
+
+        if payload["waveform"] not in waveforms.WAVEFORM_TYPES:
+            return None, f"Invalid waveform type: {payload['waveform']}"
+
+        sample_rate = float(payload["sample_rate"])
+        if not sample_rate > 0:
+            return None, "sample_rate must be greater than zero."
+
+        samples = np.asarray(payload["samples"])
+        if samples.ndim != 1 or samples.dtype.kind not in "iuf":
+            return None, "samples must be a list of numbers."
+
+        sample_type = payload.get("sample_type")
+        if sample_type is None:
+            fits_int16 = samples.size == 0 or (samples.min() >= -2**15 and samples.max() < 2**15)
+            sample_type = "float64" if samples.dtype.kind == "f" else "int16" if fits_int16 else "int32"
+        if sample_type not in SAMPLE_TYPES:
+            return None, f"Invalid sample_type: {sample_type}"
+
+        dtype = np.dtype(SAMPLE_TYPES[sample_type])
+        if dtype.kind == "i" and samples.size:
+            if samples.dtype.kind == "f" or samples.min() < np.iinfo(dtype).min or samples.max() > np.iinfo(dtype).max:
+                return None, f"samples do not fit in {sample_type}."
+
+        datum = waveforms.WaveformDatum(
+            device_id=int(payload["device_id"]),
+            assigned_user=payload.get("assigned_user"),
+            received_time=datetime.now(),
+            collection_time=datetime.fromisoformat(payload["collection_time"]),
+            waveform=payload["waveform"],
+            sample_rate=sample_rate,
+            samples=samples.astype(dtype)
+        )
+        return datum, None
+    except (TypeError, ValueError) as err:
+        return None, f"Error processing waveform: {err}"
+
+
+def assign_users(data: list):
+    """Tag the data of a batch that have no assigned user with the patient
+    their device was assigned to at collection time. The assignment index is
+    consulted once for the whole batch. Without an assignment storage, or
+    when the device was not assigned, data are tagged with
+    :data:`~medops.models.assignments.UNASSIGNED_USER`."""
+    assignments = current_app.config["STORAGE"].get("assignments")
+    if assignments is not None:
+        assignments.assign_users(data)
+        return
+
+    for datum in data:
+        if datum.assigned_user is None:
+            datum.assigned_user = UNASSIGNED_USER
+
+
+def too_many_requests(message: str, wait: float):
+    """Create a 429 response telling the client when to retry."""
+    response, status_code = error_response([message], status_code=429)
+    response.headers["Retry-After"] = retry_after(wait)
+    return response, status_code
+
+
 class Endpoints:
 
     @staticmethod
     def get():
-        data = get_storage("data").query()
-        return jsonify(data=[d.to_dict() for d in data])
+        kwargs, errors = parse_query_args(request.args)
+        if errors:
+            return error_response(errors)
+
+        # Datum ids are only unique within a shard, so the cursors of sharded
+        # data also hold the shard index.
+        storage = get_storage("data")
+        sort_key = device_models.datum_sort_key
+        if isinstance(storage, ShardedDataStorage):
+            sort_key = storage.sort_key
+        elif len(kwargs.get("after", ())) == 4:
+            collection_time, type_name, _, datum_id = kwargs["after"]
+            kwargs["after"] = (collection_time, type_name, datum_id)
+
+        if wants_stream():
+            # Streams are not paginated, every matching datum is written.
+            data = storage.iter_query(**kwargs)
+            return Response(stream_with_context(stream_ndjson(data)), mimetype=NDJSON_MIMETYPE)
+
+        # Read one extra datum to find out if there is another page.
+        page_size = kwargs.pop("limit", DEFAULT_PAGE_SIZE)
+        data = storage.query(**kwargs, limit=page_size + 1)
+        next_cursor = None
+        if len(data) > page_size:
+            data = data[:page_size]
+            next_cursor = encode_cursor(sort_key(data[-1]))
+
+        return json_response(data=[encode(d) for d in data], next_cursor=next_cursor)
 
     @staticmethod
     def post():
+        """Ingest data, unless too many uploads are already being handled."""
+        admission = current_app.config["STORAGE"].get("admission")
+        if admission is None:
+            return Endpoints.ingest()
+
+        if not admission.enter():
+            return too_many_requests("Too many data uploads in progress.", 1)
+        try:
+            return Endpoints.ingest()
+        finally:
+            admission.leave()
+
+    @staticmethod
+    def admit(data: list) -> Optional[float]:
+        """Check a batch of data against the ingestion rate limits. Returns
+        the number of seconds to wait before retrying if it is not
+        admitted."""
+        admission = current_app.config["STORAGE"].get("admission")
+        if admission is None:
+            return None
+
+        return admission.admit(Counter(datum.device_id for datum in data)) or None
+
+    @staticmethod
+    def ingest():
+        if request.mimetype == NDJSON_MIMETYPE:
+            return Endpoints.post_ndjson()
+
+        if request.mimetype == BINARY_MIMETYPE:
+            return Endpoints.post_binary()
+
         if not request.headers['Content-Type'] == "application/json":
             return "Unsupported content type.", 422
 
@@ -56,41 +488,340 @@ class Endpoints:
         if not isinstance(datapoints, list):
             return error_response(["\"data\" must be a list of data points."])
 
+        to_store, errors = parse_data(datapoints)
+        if errors:
+            return error_response(errors=[error for _, error in errors])
+
+        return Endpoints.store(to_store)
+
+    @staticmethod
+    def write(to_store: list) -> int:
+        """Store admitted data, through the background writer if it is
+        enabled, and wait until they are durable.
+
+        Returns
+        -------
+        The number of data stored, excluding the skipped duplicates.
+
+        Raises
+        ------
+        QueueFullError or WriteFailedError from the background writer.
+        """
+        writer = current_app.config["STORAGE"].get("data_writer")
+        if writer is None:
+            return device_models.store_data(to_store, get_storage("data"))
+        return writer.write(to_store)
+
+    @staticmethod
+    def store(to_store: list):
+        """Store validated data, through the background writer if it is
+        enabled, and create the response."""
+        wait = Endpoints.admit(to_store)
+        if wait:
+            return too_many_requests("Too many readings, retry later.", wait)
+
+        assign_users(to_store)
+        writer = current_app.config["STORAGE"].get("data_writer")
+        try:
+            if writer is not None and request.args.get("ack") == "async":
+                # The client opted out of waiting until the data are durable,
+                # so which of them are duplicates is not known yet.
+                writer.submit(to_store)
+                return jsonify(queued=len(to_store)), 202
+            n_stored = Endpoints.write(to_store)
+        except QueueFullError as err:
+            return too_many_requests(str(err), 1)
+        except WriteFailedError as err:
+            return error_response([str(err)], status_code=503)
+
+        # Readings that were already stored, e.g. on a retry, are skipped.
+        return jsonify(stored=n_stored, duplicates=len(to_store) - n_stored), 201
+
+    @staticmethod
+    def post_binary():
+        """Ingest data packed in the binary format described in
+        :mod:`medops.models.binary_format`. The records are decoded in bulk
+        and stored like posted JSON data."""
+        try:
+            to_store = binary_format.decode(request.get_data(cache=False))
+        except ValueError as err:
+            return error_response([str(err)])
+
+        return Endpoints.store(to_store)
+
+    @staticmethod
+    def post_ndjson():
+        """Ingest data sent as newline delimited JSON, one data point per
+        line. Lines are parsed as they are read from the request stream and
+        stored in batches, so the whole upload is never held in memory. Lines
+        that fail validation are reported but do not stop the upload. If a
+        batch exceeds the ingestion rate limits, the upload stops there with
+        a 429 response and can be sent again: the stored readings are then
+        skipped as duplicates. The batches go through the background writer
+        when it is enabled, so its queue limit applies, and each batch is
+        acknowledged once durable to count the duplicates."""
         errors = []
-        to_store = []
-        for i, payload in enumerate(datapoints):
+        n_accepted = 0
+        n_stored = 0
+        batch = []
+        batch_indices = []
+        batch_errors = []
+
+        def flush() -> Optional[float]:
+            nonlocal n_accepted, n_stored
+            to_store, parse_errors = parse_data(batch, batch_indices)
+            errors.extend(error for _, error in sorted(batch_errors + parse_errors))
+            batch.clear()
+            batch_indices.clear()
+            batch_errors.clear()
+            if not to_store:
+                return None
+
+            wait = Endpoints.admit(to_store)
+            if wait:
+                return wait
+
+            assign_users(to_store)
             try:
-                posted = JSONDatum(**payload)
-                data_type = posted.data_type
-                if data_type not in MODEL_TYPE_NAMES:
-                    errors.append(f"Invalid data type: {data_type}")
+                n_stored += Endpoints.write(to_store)
+            except QueueFullError:
+                return 1.0
+            n_accepted += len(to_store)
+            return None
+
+        def read_lines() -> Optional[float]:
+            for i, line in enumerate(request.stream):
+                if not line.strip():
                     continue
 
-                received_time = datetime.now()
-                assigned_user = posted.assigned_user
-                if assigned_user is None:
-                    # TODO: Get look for assigned user via assignments
-                    # currently just defaulting to a backup
-                    assigned_user = -1
-
-                data = posted.data
-                datum = MODEL_TYPE_NAMES[data_type](
-                    device_id=posted.device_id,
-                    assigned_user=assigned_user,
-                    received_time=received_time,
-                    collection_time=datetime.fromisoformat(posted.collection_time),
-                    **data
-                )
+                try:
+                    batch.append(json.loads(line))
+                    batch_indices.append(i)
+                except ValueError as err:
+                    batch_errors.append((i, f"Error processing data point {i}: {err}"))
+                    continue
 
-                to_store.append(datum)
-            except (TypeError, ValueError) as err:
-                errors.append(f"Error processing data point {i}: {err}")
+                if len(batch) == NDJSON_BATCH_SIZE:
+                    wait = flush()
+                    if wait:
+                        return wait
+            return flush()
 
-        if errors:
+        try:
+            wait = read_lines()
+        except WriteFailedError as err:
+            return error_response([f"{err} {n_stored} data were stored."], status_code=503)
+
+        if wait:
+            return too_many_requests(f"Too many readings, retry later. {n_stored} data were stored.", wait)
+
+        # A retry of a partly stored upload only holds duplicates, which are
+        # accepted like stored data.
+        if errors and not n_accepted:
             return error_response(errors=errors)
 
-        device_models.store_data(to_store, get_storage("data"))
-        return "", 201
+        return jsonify(stored=n_stored, duplicates=n_accepted - n_stored, errors=errors, count=len(errors)), 201
+
+
+class RollupEndpoints:
+
+    @staticmethod
+    def get():
+        kwargs, errors = parse_query_args(request.args)
+        if "assigned_user" not in request.args:
+            errors.append("Missing required parameter: assigned_user")
+
+        granularity = request.args.get("granularity", "hour")
+        if granularity not in rollups.BUCKET_FORMATS:
+            errors.append(f"Invalid granularity: {granularity}")
+
+        if errors:
+            return error_response(errors)
+
+        # The rollups of a patient are stored in their shard.
+        storage = get_storage("data")
+        query_rollups = storage.query_rollups if isinstance(storage, ShardedDataStorage) else rollups.query_rollups
+        results = query_rollups(
+            kwargs["assigned_user"],
+            types=kwargs.get("types"),
+            granularity=granularity,
+            since=kwargs.get("since"),
+            until=kwargs.get("until")
+        )
+
+        data = []
+        for rollup in results:
+            as_json = rollup.to_json()
+            as_json["datum_type"] = TYPE_NAMES[rollup.datum_type]
+            data.append(as_json)
+
+        return jsonify(rollups=data, count=len(data))
+
+
+class StatsEndpoints:
+
+    @staticmethod
+    def get():
+        kwargs, errors = parse_query_args(request.args)
+        kwargs.pop("limit", None)
+        kwargs.pop("after", None)
+        types = kwargs.pop("types", list(MODEL_TYPE_NAMES.values()))
+
+        options = {}
+        try:
+            if "percentiles" in request.args:
+                options["percentiles"] = [float(p) for p in request.args["percentiles"].split(",")]
+                if not all(0 <= p <= 100 for p in options["percentiles"]):
+                    raise ValueError()
+        except ValueError:
+            errors.append("percentiles must be a comma separated list of numbers between 0 and 100.")
+
+        try:
+            if "glucose_low" in request.args or "glucose_high" in request.args:
+                options["glucose_range"] = (
+                    float(request.args.get("glucose_low", stats.GLUCOSE_TARGET_RANGE[0])),
+                    float(request.args.get("glucose_high", stats.GLUCOSE_TARGET_RANGE[1])))
+            if "spo2_threshold" in request.args:
+                options["spo2_threshold"] = float(request.args["spo2_threshold"])
+        except ValueError:
+            errors.append("glucose_low, glucose_high and spo2_threshold must be numbers.")
+
+        if errors:
+            return error_response(errors)
+
+        storage = get_storage("data")
+        results = {}
+        for datum_cls in types:
+            results[TYPE_NAMES[datum_cls.__name__]] = stats.compute_stats(storage, datum_cls, **kwargs, **options)
+
+        return jsonify(stats=results)
+
+
+class LatestEndpoints:
+
+    @staticmethod
+    def latest_json(data: list) -> dict:
+        """Key the latest readings of one patient by API type name."""
+        return {TYPE_NAMES[type(datum).__name__]: encode(datum) for datum in data}
+
+    @staticmethod
+    def latest_readings(user_ids: list) -> dict:
+        """Get the latest readings of patients, from their shards if the
+        data are sharded."""
+        storage = get_storage("data")
+        if isinstance(storage, ShardedDataStorage):
+            return storage.latest_readings(user_ids)
+        return latest.latest_readings(user_ids)
+
+    @staticmethod
+    def get():
+        """Get the most recent reading of each type for one patient."""
+        try:
+            user_id = int(request.args["user_id"])
+        except KeyError:
+            return error_response(["Missing required parameter: user_id"])
+        except ValueError:
+            return error_response(["user_id must be an integer."])
+
+        results = LatestEndpoints.latest_readings([user_id])
+        return json_response(user_id=user_id, latest=LatestEndpoints.latest_json(results[user_id]))
+
+    @staticmethod
+    def post():
+        """Get the most recent reading of each type for many patients, e.g.
+        a ward, with their user IDs posted as {"user_ids": [...]}."""
+        body = request.get_json(silent=True)
+        user_ids = body.get("user_ids") if isinstance(body, dict) else None
+        if not isinstance(user_ids, list) or not all(isinstance(u, int) for u in user_ids):
+            return error_response(["\"user_ids\" must be a list of integers."])
+
+        results = LatestEndpoints.latest_readings(user_ids)
+        patients = [dict(user_id=user_id, latest=LatestEndpoints.latest_json(data))
+                    for user_id, data in results.items()]
+        return json_response(patients=patients, count=len(patients))
+
+
+class WaveformEndpoints:
+
+    @staticmethod
+    def post():
+        """Store a waveform segment. Posting the same segment again returns
+        the id of the stored one."""
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return error_response(["The request body must be a JSON object."])
+
+        datum, error = parse_waveform(body)
+        if error:
+            return error_response([error])
+
+        assign_users([datum])
+        try:
+            stored = get_storage("waveforms").create(datum)
+        except ValueError as err:
+            return error_response([str(err)])
+
+        return json_response(datum_id=stored.datum_id, n_samples=len(stored.samples)), 201
+
+    @staticmethod
+    def get():
+        """Query the waveform segments of a patient or device, cut to the
+        requested time window."""
+        kwargs, errors = parse_query_args(request.args)
+        for name in ["limit", "types", "after"]:
+            if name in kwargs:
+                errors.append(f"{name} is not supported for waveforms.")
+
+        if "assigned_user" not in kwargs and "device_id" not in kwargs:
+            errors.append("Missing required parameter: assigned_user or device_id")
+
+        waveform = request.args.get("waveform")
+        if waveform is not None and waveform not in waveforms.WAVEFORM_TYPES:
+            errors.append(f"Invalid waveform type: {waveform}")
+
+        if errors:
+            return error_response(errors)
+
+        data = get_storage("waveforms").query(waveform=waveform, **kwargs)
+        return json_response(segments=[encode(d) for d in data], count=len(data))
+
+    @staticmethod
+    def get_segment(datum_id: int):
+        """Get one waveform segment, optionally cut to a time window."""
+        kwargs, errors = parse_query_args(request.args)
+        if set(kwargs) - {"since", "until"}:
+            errors.append("Only since and until are supported.")
+
+        if errors:
+            return error_response(errors)
+
+        datum = get_storage("waveforms").get(datum_id, **kwargs)
+        if datum is None:
+            return error_response([f"Waveform segment {datum_id} does not exist."], status_code=404)
+
+        return json_response(segment=encode(datum))
+
+
+class AdmissionEndpoints:
+
+    @staticmethod
+    def get():
+        admission = current_app.config["STORAGE"].get("admission")
+        if admission is None:
+            return error_response(["Admission control is not enabled."], status_code=404)
+
+        return jsonify(admission.stats())
+
+
+class WriterEndpoints:
+
+    @staticmethod
+    def get():
+        writer = current_app.config["STORAGE"].get("data_writer")
+        if writer is None:
+            return error_response(["The background data writer is not enabled."], status_code=404)
+
+        return jsonify(writer.stats())
 
 
 @DATA_API_BLUEPRINT.route("", methods=["GET", "POST"])
@@ -101,3 +832,42 @@ def data_endpoints():
         return Endpoints.post()
     else:
         return "Not Implemented", 501
+
+
+@DATA_API_BLUEPRINT.route("/rollups", methods=["GET"])
+def rollup_endpoints():
+    return RollupEndpoints.get()
+
+
+@DATA_API_BLUEPRINT.route("/stats", methods=["GET"])
+def stats_endpoints():
+    return StatsEndpoints.get()
+
+
+@DATA_API_BLUEPRINT.route("/latest", methods=["GET", "POST"])
+def latest_endpoints():
+    if request.method == "GET":
+        return LatestEndpoints.get()
+    return LatestEndpoints.post()
+
+
+@DATA_API_BLUEPRINT.route("/waveforms", methods=["GET", "POST"])
+def waveform_endpoints():
+    if request.method == "GET":
+        return WaveformEndpoints.get()
+    return WaveformEndpoints.post()
+
+
+@DATA_API_BLUEPRINT.route("/waveforms/<int:datum_id>", methods=["GET"])
+def waveform_segment_endpoints(datum_id):
+    return WaveformEndpoints.get_segment(datum_id)
+
+
+@DATA_API_BLUEPRINT.route("/writer", methods=["GET"])
+def writer_endpoints():
+    return WriterEndpoints.get()
+
+
+@DATA_API_BLUEPRINT.route("/admission", methods=["GET"])
+def admission_endpoints():
+    return AdmissionEndpoints.get()
@@ -4,6 +4,12 @@
     operations team whether they want to host this API separately or in
     conjunction with another set of APIs.
 """
+import csv
+import io
+from datetime import datetime
+from typing import Optional
+
+import attr
 import peewee
 from flask import (
     Blueprint,
@@ -12,18 +18,92 @@ from flask import (
     jsonify
 )
 
-from .common import error_response
+from .common import error_response, json_response
 from .. import models
+from ..models.device_models import DEVICE_FIELDS, Device, DeviceAssignment
+from ..models.serialization import encode
 
 # TODO: Make this configurable
 DEVICES_API_BLUEPRINT = Blueprint("devices", __name__)
 
 
+# The number of devices returned per page when the request does not set a
+# limit.
+DEFAULT_PAGE_SIZE = 1000
+
+# The maximum number of devices written by a bulk request.
+MAX_BULK_DEVICES = 10_000
+
+CSV_MIMETYPE = "text/csv"
+
+# The fields of a device a bulk request can set. Rows with a device_id
+# update that device.
+BULK_FIELDS = ["device_id"] + DEVICE_FIELDS
+
+
+def parse_device_query_args(args) -> tuple[dict, list[str]]:
+    """Parse the filters for querying devices from the request's query
+    string parameters.
+
+    Parameters
+    ----------
+    args : werkzeug.datastructures.MultiDict
+        The request's query string arguments.
+
+    Returns
+    -------
+    A tuple of the keyword arguments for :meth:`DeviceStorage.query` and a
+    list of error messages.
+    """
+    kwargs = {}
+    errors = []
+    for name in ["serial_number", "mac_address", "current_firmware_version", "name_prefix"]:
+        if name in args:
+            kwargs[name] = args[name]
+
+    if "limit" in args:
+        try:
+            kwargs["limit"] = int(args["limit"])
+        except ValueError:
+            errors.append("limit must be an integer.")
+
+    if kwargs.get("limit", 1) < 1:
+        errors.append("limit must be greater than zero.")
+
+    for name in ["purchased_since", "purchased_until"]:
+        if name in args:
+            try:
+                kwargs[name] = datetime.fromisoformat(args[name]).date()
+            except ValueError:
+                errors.append(f"{name} must be an ISO-8601 date string.")
+
+    # The cursor is the id of the last device of the previous page.
+    if "cursor" in args:
+        try:
+            kwargs["after"] = int(args["cursor"])
+        except ValueError:
+            errors.append(f"Invalid cursor: {args['cursor']}")
+
+    return kwargs, errors
+
+
 @DEVICES_API_BLUEPRINT.route("", methods=["GET"])
 def device_query():
-    devices = models.get_storage("devices")
-    existing = devices.query()
-    return jsonify(devices=[e.to_dict() for e in existing])
+    """List the devices matching the query string filters, a page at a time
+    ordered by id. See the HTTP API documentation for the filters."""
+    kwargs, errors = parse_device_query_args(request.args)
+    if errors:
+        return error_response(errors)
+
+    # Read one extra device to find out if there is another page.
+    page_size = kwargs.pop("limit", DEFAULT_PAGE_SIZE)
+    devices = models.get_storage("devices").query(**kwargs, limit=page_size + 1)
+    next_cursor = None
+    if len(devices) > page_size:
+        devices = devices[:page_size]
+        next_cursor = str(devices[-1].device_id)
+
+    return json_response(devices=[encode(d) for d in devices], next_cursor=next_cursor)
 
 @DEVICES_API_BLUEPRINT.route("", methods=["POST"])
 def device_create():
@@ -65,7 +145,17 @@ def device_create():
     if errors:
         return error_response(errors)
 
-    return jsonify(device.to_dict())
+    return json_response(encode(device))
+
+@DEVICES_API_BLUEPRINT.route("/cache", methods=["GET"])
+def device_cache_stats():
+    """Get the counters of this server process' device cache. See
+    :meth:`~medops.models.cache.LRUCache.stats`."""
+    stats = models.get_storage("devices").cache_stats()
+    if stats is None:
+        return make_response("The device cache is disabled."), 404
+
+    return jsonify(stats), 200
 
 class DeviceEndpoint:
 
@@ -118,7 +208,7 @@ class DeviceEndpoint:
         else:
             # We don't want to save the model if there were errors
             updated = models.get_storage("devices").update(device)
-            return jsonify(updated.to_dict()), 200
+            return json_response(encode(updated)), 200
 
     @staticmethod
     def get(device_id: int):
@@ -128,7 +218,7 @@ class DeviceEndpoint:
         if not device:
             return make_response("Not found"), 404
 
-        return jsonify(device.to_dict()), 200
+        return json_response(encode(device)), 200
 
     @staticmethod
     def delete(device_id):
@@ -152,3 +242,309 @@ def single_device_route(device_id):
         # isn't supported. If we get here it means the method is supported by
         # not yet implemented.
         return "Not implemented", 501
+
+
+def read_bulk_rows() -> tuple[Optional[list], list[str]]:
+    """Read the rows of a bulk request, either a JSON array of objects or
+    CSV with a header of field names. Empty CSV cells are read as null when
+    creating a device and are left out when updating one, so they keep the
+    stored value.
+
+    Returns
+    -------
+    A tuple of the rows, None if the body is invalid, and a list of error
+    messages.
+    """
+    if request.mimetype == CSV_MIMETYPE:
+        reader = csv.DictReader(io.StringIO(request.get_data(as_text=True)))
+        unknown = [name for name in reader.fieldnames or [] if name not in BULK_FIELDS]
+        if unknown:
+            return None, [f"'{name}' is not a device field." for name in unknown]
+
+        try:
+            rows = [{field: value or None for field, value in row.items()} for row in reader]
+        except csv.Error as err:
+            return None, [f"Invalid CSV: {err}"]
+
+        for i, row in enumerate(rows):
+            if None in row:
+                return None, [f"Row {i} has more values than the header."]
+            if row.get("device_id") is not None and row["device_id"].isdigit():
+                row["device_id"] = int(row["device_id"])
+            if row.get("device_id") is not None:
+                rows[i] = {field: value for field, value in row.items() if value is not None}
+        return rows, []
+
+    if not request.is_json:
+        return None, ["Unsupported content type."]
+
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        return None, ["The body must be a JSON array of devices."]
+
+    return rows, []
+
+
+def parse_bulk_row(row) -> tuple[dict, list[str]]:
+    """Check the fields of one device of a bulk request.
+
+    Returns
+    -------
+    A tuple of the fields and a list of error messages.
+    """
+    if not isinstance(row, dict):
+        return {}, ["A device must be an object."]
+
+    errors = [f"'{field}' is not a device field." for field in row if field not in BULK_FIELDS]
+    device_id = row.get("device_id")
+    if device_id is not None and (type(device_id) is not int or device_id < 1):
+        errors.append("device_id must be a positive integer.")
+
+    if device_id is None and "name" not in row:
+        errors.append("Missing required field: name")
+
+    if "name" in row and not (isinstance(row["name"], str) and row["name"].strip()):
+        errors.append("name must be a non-blank string.")
+
+    for field in ["current_firmware_version", "serial_number", "mac_address", "date_of_purchase"]:
+        if row.get(field) is not None and not isinstance(row[field], str):
+            errors.append(f"{field} must be a string.")
+
+    if isinstance(row.get("date_of_purchase"), str):
+        try:
+            datetime.fromisoformat(row["date_of_purchase"])
+        except ValueError:
+            errors.append("date_of_purchase must be an ISO-8601 date string.")
+
+    return row, errors
+
+
+def check_bulk_rows(rows: list) -> tuple[list[Optional[Device]], list[list[str]]]:
+    """Validate the rows of a bulk request and build the devices to write.
+    Names are checked against each other and, with the ids of the devices to
+    update, against the stored devices in a single query.
+
+    Returns
+    -------
+    A tuple of the device to write for each row, None for invalid rows, and
+    the list of error messages of each row.
+    """
+    parsed = [parse_bulk_row(row) for row in rows]
+    row_errors = [errors for _, errors in parsed]
+    fields = [row if not errors else None for row, errors in parsed]
+
+    device_ids = [row["device_id"] for row in fields if row is not None and row.get("device_id") is not None]
+    names = [row["name"] for row in fields if row is not None and "name" in row]
+    existing = models.get_storage("devices").find(names, device_ids)
+    by_id = {device.device_id: device for device in existing}
+    owners = {device.name: device.device_id for device in existing}
+
+    # The stored devices renamed by this request give up their names.
+    renamed = set()
+    for row in fields:
+        if row is not None and row.get("device_id") in by_id:
+            stored = by_id[row["device_id"]]
+            if row.get("name", stored.name) != stored.name:
+                renamed.add(stored.device_id)
+
+    seen_ids = set()
+    seen_names = set()
+    devices = []
+    for row, errors in zip(fields, row_errors):
+        if row is None:
+            devices.append(None)
+            continue
+
+        device_id = row.get("device_id")
+        if device_id is not None:
+            if device_id not in by_id:
+                errors.append(f"Device {device_id} does not exist.")
+            elif device_id in seen_ids:
+                errors.append(f"Device {device_id} is updated more than once.")
+            seen_ids.add(device_id)
+
+        name = row.get("name")
+        if name is None and device_id in by_id:
+            name = by_id[device_id].name
+        if name in seen_names:
+            errors.append(f"The name {name} is used more than once.")
+        elif owners.get(name, device_id) not in (device_id, *renamed):
+            errors.append(f"The name {name} is already taken.")
+        seen_names.add(name)
+
+        if errors:
+            devices.append(None)
+        elif device_id is None:
+            devices.append(Device(device_id=None, **{field: row.get(field) for field in DEVICE_FIELDS}))
+        else:
+            changes = {field: row[field] for field in DEVICE_FIELDS if field in row}
+            devices.append(attr.evolve(by_id[device_id], **changes))
+
+    return devices, row_errors
+
+
+class BulkDeviceEndpoint:
+
+    @staticmethod
+    def post():
+        """Create and update many devices at once, e.g. when onboarding a
+        ward.
+
+        The body is a JSON array of devices or CSV with a header of field
+        names. Rows without a `device_id` create a device, the others update
+        the fields they set of that device. Every row is validated before
+        anything is written, and the devices are then written in one
+        transaction: either all of them or none are.
+
+        See the HTTP API documentation for the response structure.
+        """
+        rows, errors = read_bulk_rows()
+        if rows is None:
+            return error_response(errors)
+
+        if len(rows) > MAX_BULK_DEVICES:
+            return error_response([f"At most {MAX_BULK_DEVICES} devices can be written at once."])
+
+        devices, row_errors = check_bulk_rows(rows)
+        if any(row_errors):
+            errors = [f"Row {i}: {error}" for i, messages in enumerate(row_errors) for error in messages]
+            results = [dict(row=i, status="invalid" if messages else "valid", errors=messages)
+                       for i, messages in enumerate(row_errors)]
+            return jsonify(results=results, errors=errors, count=len(errors)), 422
+
+        try:
+            written = models.get_storage("devices").bulk_write(devices)
+        except peewee.IntegrityError as err:
+            # Another request took a name since the rows were checked.
+            return error_response([str(err)])
+
+        results = [dict(row=i, status="created" if row.get("device_id") is None else "updated", device=encode(device))
+                   for i, (row, device) in enumerate(zip(rows, written))]
+        n_created = sum(result["status"] == "created" for result in results)
+        return json_response(results=results, created=n_created, updated=len(results) - n_created)
+
+
+@DEVICES_API_BLUEPRINT.route("/bulk", methods=["POST"])
+def bulk_devices_route():
+    return BulkDeviceEndpoint.post()
+
+
+def parse_assignment_dates(data: dict, errors: list) -> dict:
+    """Parse the ISO 8601 date fields of a posted assignment, appending a
+    message to `errors` for each invalid one."""
+    dates = {}
+    for field in ["date_assigned", "date_returned"]:
+        value = data.get(field)
+        if value is None:
+            continue
+        try:
+            dates[field] = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            errors.append(f"Invalid {field}: {value}")
+    return dates
+
+
+class AssignmentEndpoint:
+
+    @staticmethod
+    def get(device_id: int):
+        """List the assignments of a device ordered by start time."""
+        assignments = models.get_storage("assignments").query(device_id=device_id)
+        return jsonify(assignments=[a.to_json() for a in assignments]), 200
+
+    @staticmethod
+    def post(device_id: int):
+        """Assign a device to a patient.
+
+        The payload requires `patient_id` and `assigner_id`. The
+        `date_assigned` defaults to now and `date_returned` to None.
+        """
+        data = request.get_json()
+        if data is None:
+            return make_response("Invalid JSON request."), 400
+
+        if not models.get_storage("devices").get(device_id):
+            return make_response("Not found"), 404
+
+        errors = []
+        for field in ["patient_id", "assigner_id"]:
+            if field not in data:
+                errors.append(f"Missing required field: {field}")
+
+        dates = parse_assignment_dates(data, errors)
+        if not errors:
+            try:
+                assignment = models.get_storage("assignments").create(DeviceAssignment(
+                    device_id=device_id,
+                    patient_id=data["patient_id"],
+                    assigner_id=data["assigner_id"],
+                    date_assigned=dates.get("date_assigned", datetime.now()),
+                    date_returned=dates.get("date_returned"),
+                ))
+            except ValueError as err:
+                errors.append(str(err))
+
+        if errors:
+            return error_response(errors)
+
+        return jsonify(assignment.to_json()), 201
+
+    @staticmethod
+    def put(device_id: int, assignment_id: int):
+        """Update the dates of an assignment, e.g. to set `date_returned`
+        when the device is returned."""
+        data = request.get_json()
+        if data is None:
+            return make_response("Invalid JSON request."), 400
+
+        storage = models.get_storage("assignments")
+        assignment = storage.get(assignment_id)
+        if not assignment or assignment.device_id != device_id:
+            return make_response("Not found"), 404
+
+        errors = []
+        for field in data:
+            if field not in ["date_assigned", "date_returned"]:
+                errors.append(f"'{field}' is not editable.")
+
+        dates = parse_assignment_dates(data, errors)
+        if not errors:
+            if "date_assigned" in dates:
+                assignment.date_assigned = dates["date_assigned"]
+            if "date_returned" in data:
+                assignment.date_returned = dates.get("date_returned")
+            try:
+                assignment = storage.update(assignment)
+            except ValueError as err:
+                errors.append(str(err))
+
+        if errors:
+            return error_response(errors)
+
+        return jsonify(assignment.to_json()), 200
+
+    @staticmethod
+    def delete(device_id: int, assignment_id: int):
+        storage = models.get_storage("assignments")
+        assignment = storage.get(assignment_id)
+        if not assignment or assignment.device_id != device_id:
+            return "", 404
+
+        storage.delete(assignment_id)
+        return "", 200
+
+
+@DEVICES_API_BLUEPRINT.route("/<int:device_id>/assignments", methods=["GET", "POST"])
+def device_assignments_route(device_id):
+    if request.method == "GET":
+        return AssignmentEndpoint.get(device_id)
+    else:
+        return AssignmentEndpoint.post(device_id)
+
+
+@DEVICES_API_BLUEPRINT.route("/<int:device_id>/assignments/<int:assignment_id>", methods=["PUT", "DELETE"])
+def single_assignment_route(device_id, assignment_id):
+    if request.method == "PUT":
+        return AssignmentEndpoint.put(device_id, assignment_id)
+    else:
+        return AssignmentEndpoint.delete(device_id, assignment_id)
@@ -11,13 +11,21 @@ from flask import (
     jsonify,
 )
 
-from .common import error_response
+from .common import error_response, json_response
 from .. import models
+from ..models.serialization import encoder_for
 import logging
 logger = logging.getLogger()
 
 USERS_API_BLUEPRINT = Blueprint("users", __name__)
 
+# Users are serialized without their password hash. Their patients and
+# medical staff are summarized without roles or relationships, as in
+# User.to_json.
+RELATED_USER_ENCODER = encoder_for(models.User, exclude=("password", "roles", "patients", "medical_staff"))
+USER_ENCODER = encoder_for(models.User, exclude=("password",),
+                           nested=dict(patients=RELATED_USER_ENCODER, medical_staff=RELATED_USER_ENCODER))
+
 class UserEndpoint:
 
     @staticmethod
@@ -104,7 +112,7 @@ class UserEndpoint:
             user = models.User(**kwargs)
             user.password = models.hashUserPassword(user.email, user.password)
             user = models.get_storage("users").users.create(user)
-            return jsonify(user=user.to_json())
+            return json_response(user=USER_ENCODER(user))
 
     @staticmethod
     def query(role=None):
@@ -114,7 +122,7 @@ class UserEndpoint:
         else:
             users = models.get_storage("users").users.query(roles=roles)
 
-        return jsonify(users=[u.to_json() for u in users])
+        return json_response(users=[USER_ENCODER(u) for u in users])
 
     @staticmethod
     def get(user_id=None, email=None):
@@ -130,7 +138,7 @@ class UserEndpoint:
             errors.append(f"User {user_id or email} does not exist.")
             return error_response(errors=errors, status_code=404)
         else:
-            return jsonify(user=user.to_json())
+            return json_response(user=USER_ENCODER(user))
 
     @staticmethod
     def update(user_id):
@@ -200,7 +208,7 @@ class UserEndpoint:
             return error_response(errors=errors)
 
         user = models.get_storage("users").users.update(user)
-        return jsonify(user=user.to_json())
+        return json_response(user=USER_ENCODER(user))
 
     @staticmethod
     def delete(user_id):
@@ -226,7 +234,7 @@ class UserEndpoint:
                 errors.append("Incorrect password.")
                 return error_response(errors=errors, status_code=401)
 
-        return jsonify(user=user.to_json()), 201
+        return json_response(user=USER_ENCODER(user)), 201
 
 class UserRoleEndpoint:
 
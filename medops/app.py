@@ -11,6 +11,29 @@ MONGO_CHAT_DATABASE_NAME - The name of the mongodb database to log chat
                            messages to
 SQLITEDB_FILENAME - The file to use as the sqlite databse.
 
+The following environment variables are optional:
+
+DATA_DB_LAYOUT - How device data are stored, either "tables" (default),
+                 "wide" or "monthly".
+DATA_WRITER_QUEUE_SIZE - If set, device data are stored by a background
+                         writer in group commits. The value is the maximum
+                         number of data waiting to be written. A larger
+                         upload is taken when nothing else is waiting.
+DATA_ARCHIVE_DIR - If set, queries also read device data archived to this
+                   directory with `python -m medops.models archive`.
+DATA_INGEST_RATE - If set, the number of device readings per second stored
+                   across all devices. Uploads beyond it get a 429 response.
+DATA_DEVICE_INGEST_RATE - If set, the number of readings per second stored
+                          from each device.
+DATA_MAX_INGEST_IN_FLIGHT - If set, the number of uploads handled at once by
+                            each server process.
+DATA_DB_SHARDS - The number of SQLite files the device data are spread over
+                 by patient with the "tables" layout. Defaults to 1.
+DEVICES_CACHE_SIZE - The number of device reads cached by each server
+                     process. Defaults to 1024, 0 disables the cache.
+DEVICES_CACHE_TTL - The number of seconds a cached device read is used for.
+                    Defaults to 60.
+
 For convenience, you can define them in a `.env` file and they will get
 automatically loaded. Then, from the root of this development repository
 run: `FLASK_APP=medops.app flak run`
@@ -28,6 +51,7 @@ from .apis import (
     S2T_BLUEPRINT_API
 )
 from .models import init_db, deinit
+from .models.device_models import DEVICE_CACHE_SIZE, DEVICE_CACHE_TTL
 
 APP = Flask(__name__)
 APP.register_blueprint(DEVICES_API_BLUEPRINT, url_prefix="/devices")
@@ -42,6 +66,15 @@ class Config:
         self.mongo_connection_string = None
         self.mongo_chat_db_name = None
         self.sqlite_db_filename = None
+        self.data_db_layout = "tables"
+        self.data_writer_queue_size = 0
+        self.data_archive_dir = None
+        self.data_db_shards = 1
+        self.data_ingest_rate = 0
+        self.data_device_ingest_rate = 0
+        self.data_max_ingest_in_flight = 0
+        self.devices_cache_size = DEVICE_CACHE_SIZE
+        self.devices_cache_ttl = DEVICE_CACHE_TTL
 
     def load_from_env(self):
         dotenv.load_dotenv()
@@ -58,6 +91,15 @@ class Config:
             raise ValueError("Missing environment variable SQLITEDB_FILENAME")
 
         self.upload_folder = os.getenv("APP_UPLOAD_FOLDER")
+        self.data_db_layout = os.getenv("DATA_DB_LAYOUT", "tables")
+        self.data_writer_queue_size = int(os.getenv("DATA_WRITER_QUEUE_SIZE", "0"))
+        self.data_archive_dir = os.getenv("DATA_ARCHIVE_DIR")
+        self.data_db_shards = int(os.getenv("DATA_DB_SHARDS", "1"))
+        self.data_ingest_rate = float(os.getenv("DATA_INGEST_RATE", "0"))
+        self.data_device_ingest_rate = float(os.getenv("DATA_DEVICE_INGEST_RATE", "0"))
+        self.data_max_ingest_in_flight = int(os.getenv("DATA_MAX_INGEST_IN_FLIGHT", "0"))
+        self.devices_cache_size = int(os.getenv("DEVICES_CACHE_SIZE", str(DEVICE_CACHE_SIZE)))
+        self.devices_cache_ttl = float(os.getenv("DEVICES_CACHE_TTL", str(DEVICE_CACHE_TTL)))
 
     def init_app(self, app, from_env=False):
         if from_env:
@@ -65,7 +107,16 @@ class Config:
 
         init_db(app, {
             "DEVICES_FILENAME": self.sqlite_db_filename,
+            "DEVICES_CACHE_SIZE": self.devices_cache_size,
+            "DEVICES_CACHE_TTL": self.devices_cache_ttl,
             "DATA_DB_FILENAME": self.sqlite_db_filename,
+            "DATA_DB_LAYOUT": self.data_db_layout,
+            "DATA_WRITER_QUEUE_SIZE": self.data_writer_queue_size,
+            "DATA_ARCHIVE_DIR": self.data_archive_dir,
+            "DATA_DB_SHARDS": self.data_db_shards,
+            "DATA_INGEST_RATE": self.data_ingest_rate,
+            "DATA_DEVICE_INGEST_RATE": self.data_device_ingest_rate,
+            "DATA_MAX_INGEST_IN_FLIGHT": self.data_max_ingest_in_flight,
             "USERS_DB_FILENAME": self.sqlite_db_filename,
             "MONGO_CONNECTION_STRING": self.mongo_connection_string,
             "MONGO_DATABASE": self.mongo_chat_db_name,
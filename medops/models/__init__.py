@@ -6,12 +6,23 @@ from .device_models import DeviceStorage, DataStorage
 from .user_models import UserStorage
 from .base import Storage
 from .device_models import Device # noqa: F401
+from .device_models import DEVICE_CACHE_SIZE, DEVICE_CACHE_TTL
 from .user_models import User, UserRole # noqa: F401
 from .user_models import hashUserPassword # noqa: F401
 from .chat_model import MessageStore
+from . import rollups # noqa: F401
+from . import latest # noqa: F401
+from .wide_storage import WideDataStorage
+from .partitioned_storage import PartitionedDataStorage
+from .archive import ColdArchive
+from .ingest_writer import GroupCommitWriter
+from .assignments import DeviceAssignmentStorage
+from .waveforms import WaveformStorage
+from .sharding import ShardedDataStorage
+from .admission import AdmissionController
 
 from flask import current_app
-from typing import Optional
+from typing import Optional, Union
 
 def init_db(app, config):
     """Initialize the current application instance with the loaded
@@ -25,7 +36,19 @@ def init_db(app, config):
         The application configuration.
     """
     devices_file = config.get("DEVICES_FILENAME", "")
+    devices_cache_size = config.get("DEVICES_CACHE_SIZE", DEVICE_CACHE_SIZE)
+    devices_cache_ttl = config.get("DEVICES_CACHE_TTL", DEVICE_CACHE_TTL)
     data_db_file = config.get("DATA_DB_FILENAME", "")
+    data_db_layout = config.get("DATA_DB_LAYOUT", "tables")
+    data_db_shards = config.get("DATA_DB_SHARDS", 1)
+    data_writer_queue_size = config.get("DATA_WRITER_QUEUE_SIZE", 0)
+    data_writer_batch_size = config.get("DATA_WRITER_BATCH_SIZE", 5000)
+    data_archive_dir = config.get("DATA_ARCHIVE_DIR", "")
+    data_ingest_rate = config.get("DATA_INGEST_RATE", 0)
+    data_ingest_burst = config.get("DATA_INGEST_BURST", None)
+    data_device_ingest_rate = config.get("DATA_DEVICE_INGEST_RATE", 0)
+    data_device_ingest_burst = config.get("DATA_DEVICE_INGEST_BURST", None)
+    data_max_ingest_in_flight = config.get("DATA_MAX_INGEST_IN_FLIGHT", 0)
     users_db_file = config.get("USERS_DB_FILENAME", "")
     mongo_connection = config.get("MONGO_CONNECTION_STRING", "")
     mongo_database = config.get("MONGO_DATABASE", "")
@@ -35,13 +58,50 @@ def init_db(app, config):
         if isinstance(devices_file, str):
             devices_file = Path(devices_file)
 
-        app.config["STORAGE"]["devices"] = DeviceStorage(devices_file)
+        app.config["STORAGE"]["devices"] = DeviceStorage(devices_file,
+                                                         cache_size=devices_cache_size,
+                                                         cache_ttl=devices_cache_ttl)
+        app.config["STORAGE"]["assignments"] = DeviceAssignmentStorage(devices_file)
 
     if data_db_file:
         if isinstance(data_db_file, str):
             data_db_file = Path(data_db_file)
 
-        app.config["STORAGE"]["data"] = DataStorage(data_db_file)
+        if data_db_shards > 1 and (data_db_layout != "tables" or data_archive_dir):
+            raise ValueError("Sharding is only supported with the tables layout and without an archive.")
+
+        if data_db_layout == "wide":
+            app.config["STORAGE"]["data"] = WideDataStorage(data_db_file)
+        elif data_db_layout == "monthly":
+            app.config["STORAGE"]["data"] = PartitionedDataStorage(data_db_file)
+        elif data_db_layout == "tables" and data_db_shards > 1:
+            sharded = app.config["STORAGE"]["data"] = ShardedDataStorage(data_db_file, data_db_shards)
+            # Request threads open their own connections to the shards.
+            app.teardown_appcontext(lambda _: sharded.close())
+        elif data_db_layout == "tables":
+            archive = ColdArchive(data_archive_dir) if data_archive_dir else None
+            app.config["STORAGE"]["data"] = DataStorage(data_db_file, archive=archive)
+        else:
+            raise ValueError(f"Unknown data storage layout: {data_db_layout}")
+
+        app.config["STORAGE"]["waveforms"] = WaveformStorage(data_db_file)
+
+        if data_archive_dir and data_db_layout != "tables":
+            raise ValueError("The data archive is only supported with the tables layout.")
+
+        if data_writer_queue_size:
+            app.config["STORAGE"]["data_writer"] = GroupCommitWriter(
+                app.config["STORAGE"]["data"],
+                max_queue_size=data_writer_queue_size,
+                max_batch_size=data_writer_batch_size)
+
+        if data_ingest_rate or data_device_ingest_rate or data_max_ingest_in_flight:
+            app.config["STORAGE"]["admission"] = AdmissionController(
+                rate=data_ingest_rate,
+                burst=data_ingest_burst,
+                device_rate=data_device_ingest_rate,
+                device_burst=data_device_ingest_burst,
+                max_in_flight=data_max_ingest_in_flight)
 
     if users_db_file:
         if isinstance(users_db_file, str):
@@ -58,10 +118,22 @@ def deinit(app):
     if dev_storage:
         dev_storage.deinit()
 
-    data_storage: Optional[DataStorage] = app.config['STORAGE'].get("data")
+    assignment_storage: Optional[DeviceAssignmentStorage] = app.config['STORAGE'].get("assignments")
+    if assignment_storage:
+        assignment_storage.deinit()
+
+    data_writer: Optional[GroupCommitWriter] = app.config['STORAGE'].get("data_writer")
+    if data_writer:
+        data_writer.stop()
+
+    data_storage: Optional[Union[DataStorage, WideDataStorage, ShardedDataStorage]] = app.config['STORAGE'].get("data")
     if data_storage:
         data_storage.deinit()
 
+    waveform_storage: Optional[WaveformStorage] = app.config['STORAGE'].get("waveforms")
+    if waveform_storage:
+        waveform_storage.deinit()
+
     user_storage: Optional[UserStorage] = app.config['STORAGE'].get("users")
     if user_storage:
         user_storage.deinit()
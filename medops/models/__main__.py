@@ -0,0 +1,179 @@
+"""
+Maintenance commands for the MedOps storage. Run
+``python -m medops.models --help`` for the list of commands.
+"""
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from . import archive, latest, rollups, sharding, wide_storage
+from .device_models import DataStorage
+from .partitioned_storage import PartitionedDataStorage
+
+LAYOUTS = {
+    "tables": DataStorage,
+    "wide": wide_storage.WideDataStorage,
+    "monthly": PartitionedDataStorage,
+}
+
+
+def open_storage(args):
+    """Open the database of a command, with its archive if one is given."""
+    if args.archive is None:
+        return LAYOUTS[args.layout](args.database)
+    if args.layout != "tables":
+        raise SystemExit("The archive is only supported with the tables layout.")
+    return DataStorage(args.database, archive=archive.ColdArchive(args.archive))
+
+
+def rebuild_rollups(args):
+    storage = open_storage(args)
+    try:
+        rollups.rebuild_rollups(storage, args.since)
+    finally:
+        storage.deinit()
+
+
+def rebuild_latest(args):
+    storage = open_storage(args)
+    try:
+        latest.rebuild_latest(storage)
+    finally:
+        storage.deinit()
+
+
+def migrate_layout(args):
+    source = LAYOUTS[args.source_layout](args.source)
+    destination = LAYOUTS[args.destination_layout](args.destination)
+    try:
+        n_copied = wide_storage.migrate(source, destination)
+        print(f"Copied {n_copied} data.")
+    finally:
+        source.deinit()
+        destination.deinit()
+
+
+def remove_duplicates(args):
+    storage = open_storage(args)
+    try:
+        n_deleted = storage.remove_duplicates()
+        print(f"Deleted {n_deleted} duplicate readings.")
+        if n_deleted:
+            rollups.rebuild_rollups(storage)
+            latest.rebuild_latest(storage)
+    finally:
+        storage.deinit()
+
+
+def drop_partitions(args):
+    storage = PartitionedDataStorage(args.database)
+    try:
+        dropped = storage.drop_partitions(args.before)
+        print(f"Dropped {len(dropped)} partitions.")
+    finally:
+        storage.deinit()
+
+
+def archive_data(args):
+    storage = DataStorage(args.database)
+    try:
+        before = datetime.now() - timedelta(days=args.older_than_days)
+        n_archived = archive.archive_data(storage, archive.ColdArchive(args.archive), before)
+        print(f"Archived {n_archived} data.")
+        if args.vacuum:
+            storage.database.execute_sql("VACUUM")
+    finally:
+        storage.deinit()
+
+
+def reshard(args):
+    if args.source_shards == args.destination_shards:
+        raise SystemExit("The number of shards is unchanged.")
+
+    source = sharding.ShardedDataStorage(args.database, args.source_shards)
+    destination = sharding.ShardedDataStorage(args.database, args.destination_shards)
+    try:
+        n_copied = sharding.rebalance(source, destination)
+        print(f"Copied {n_copied} data. Set DATA_DB_SHARDS to {args.destination_shards}.")
+        if args.source_shards > 1:
+            # A single shard is the main database file, which holds other tables too.
+            print("The old shards can then be deleted:")
+            for filename in sharding.shard_filenames(args.database, args.source_shards):
+                print(f"  {filename}")
+    finally:
+        source.deinit()
+        destination.deinit()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m medops.models", description=__doc__)
+    archive_help = ("The archive directory of the database, if data were archived. "
+                    "Defaults to the DATA_ARCHIVE_DIR environment variable.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("rebuild-rollups",
+                                  help="Recompute the vital rollups from the raw device data.")
+    command.add_argument("database", help="The SQLite database file with the device data.")
+    command.add_argument("--since", type=datetime.fromisoformat, default=None,
+                         help="Only rebuild buckets from this ISO-8601 date-time onwards.")
+    command.add_argument("--layout", choices=list(LAYOUTS), default="tables",
+                         help="The storage layout of the database.")
+    command.add_argument("--archive", default=os.environ.get("DATA_ARCHIVE_DIR"), help=archive_help)
+    command.set_defaults(func=rebuild_rollups)
+
+    command = commands.add_parser("rebuild-latest",
+                                  help="Recompute the latest reading of each type for each patient.")
+    command.add_argument("database", help="The SQLite database file with the device data.")
+    command.add_argument("--layout", choices=list(LAYOUTS), default="tables",
+                         help="The storage layout of the database.")
+    command.add_argument("--archive", default=os.environ.get("DATA_ARCHIVE_DIR"), help=archive_help)
+    command.set_defaults(func=rebuild_latest)
+
+    command = commands.add_parser("migrate-layout",
+                                  help="Copy device data between storage layouts.")
+    command.add_argument("source", help="The SQLite database file to copy from.")
+    command.add_argument("source_layout", choices=list(LAYOUTS))
+    command.add_argument("destination", help="The SQLite database file to copy to.")
+    command.add_argument("destination_layout", choices=list(LAYOUTS))
+    command.set_defaults(func=migrate_layout)
+
+    command = commands.add_parser("remove-duplicates",
+                                  help="Delete duplicate readings stored by earlier versions and rebuild the rollups.")
+    command.add_argument("database", help="The SQLite database file with the device data.")
+    command.add_argument("--layout", choices=list(LAYOUTS), default="tables",
+                         help="The storage layout of the database.")
+    command.add_argument("--archive", default=os.environ.get("DATA_ARCHIVE_DIR"), help=archive_help)
+    command.set_defaults(func=remove_duplicates)
+
+    command = commands.add_parser("drop-partitions",
+                                  help="Delete the monthly partitions of the device data older than a date.")
+    command.add_argument("database", help="The SQLite database file with the monthly layout.")
+    command.add_argument("--before", type=datetime.fromisoformat, required=True,
+                         help="Drop the months before the month of this ISO-8601 date-time.")
+    command.set_defaults(func=drop_partitions)
+
+    command = commands.add_parser("archive",
+                                  help="Move old device data into a directory of columnar files.")
+    command.add_argument("database", help="The SQLite database file with the device data.")
+    command.add_argument("archive", help="The archive directory. It is created if needed.")
+    command.add_argument("--older-than-days", type=float, required=True,
+                         help="Archive data collected more than this many days ago.")
+    command.add_argument("--vacuum", action="store_true",
+                         help="Shrink the database file once the data are archived.")
+    command.set_defaults(func=archive_data)
+
+    command = commands.add_parser("reshard",
+                                  help="Copy the device data to another number of shards.")
+    command.add_argument("database", help="The SQLite database file the shards are named after.")
+    command.add_argument("--from", dest="source_shards", type=int, required=True,
+                         help="The current number of shards, 1 if the data are not sharded.")
+    command.add_argument("--to", dest="destination_shards", type=int, required=True,
+                         help="The new number of shards.")
+    command.set_defaults(func=reshard)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+This module provides admission control for data ingestion. When many
+gateways flush their backlog at once, e.g. after a network outage, storing
+everything as it arrives ties up every server worker on the database and
+reads stop being served. The :class:`AdmissionController` instead sheds
+the load it can't absorb, and clients are told when to retry.
+
+Three limits are applied, each optional:
+
+* a cap on the number of ingestion requests handled at once, checked before
+  the body is read;
+* a token bucket per device, refilled at a number of readings per second,
+  so a single gateway can't starve the others;
+* a global token bucket of readings per second across all devices.
+
+The limits apply per server process.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# The number of device buckets kept. The least recently used ones are
+# dropped first, and a device whose bucket was dropped starts full again.
+MAX_DEVICE_BUCKETS = 100_000
+
+# The reasons load is shed for.
+SHED_REASONS = ("in_flight", "device_rate", "global_rate")
+
+
+class TokenBucket:
+    """A token bucket refilled at a constant rate.
+
+    A cost larger than the bucket is admitted once the bucket is full and
+    leaves it in debt, so large batches are delayed rather than rejected
+    forever.
+
+    Parameters
+    ----------
+    rate : float
+        The number of tokens added per second.
+    capacity : float
+        The maximum number of tokens held.
+    now : Optional[float]
+        The current time, as returned by ``time.monotonic``. Defaults to
+        the time the bucket is first used.
+    """
+
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        if self.updated is None:
+            self.updated = now
+        elif now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Get the number of seconds until a cost can be taken, zero if it
+        can be taken now."""
+        self._refill(now)
+        missing = min(cost, self.capacity) - self.tokens
+        return max(missing, 0) / self.rate
+
+    def take(self, cost: float, now: float):
+        """Take a cost from the bucket. Check :meth:`wait_time` first."""
+        self._refill(now)
+        self.tokens -= cost
+
+
+class AdmissionController:
+    """Decides which ingestion requests are handled and counts the ones
+    that are shed. It is safe to use from several threads.
+
+    Parameters
+    ----------
+    rate : float
+        The number of readings per second admitted across all devices. Zero
+        disables the global limit.
+    burst : Optional[float]
+        The number of readings admitted at once across all devices. Defaults
+        to one second worth of readings.
+    device_rate : float
+        The number of readings per second admitted from each device. Zero
+        disables the per device limit.
+    device_burst : Optional[float]
+        The number of readings admitted at once from a device. Defaults to
+        one minute worth of readings, since devices upload in batches.
+    max_in_flight : int
+        The maximum number of ingestion requests handled at once. Zero
+        disables the limit.
+    """
+
+    def __init__(self,
+                 rate: float = 0,
+                 burst: Optional[float] = None,
+                 device_rate: float = 0,
+                 device_burst: Optional[float] = None,
+                 max_in_flight: int = 0):
+        self.device_rate = device_rate
+        self.device_burst = device_burst or device_rate * 60
+        self.max_in_flight = max_in_flight
+        self._global = TokenBucket(rate, burst or rate) if rate else None
+        self._devices = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+        self.admitted_requests = 0
+        self.admitted_readings = 0
+        self.shed_requests = dict.fromkeys(SHED_REASONS, 0)
+        self.shed_readings = 0
+
+    def enter(self) -> bool:
+        """Start handling an ingestion request, unless too many are in
+        flight. Every request that entered must :meth:`leave`.
+
+        Returns
+        -------
+        Whether the request can be handled.
+        """
+        with self._lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                self.shed_requests["in_flight"] += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def leave(self):
+        """Finish handling an ingestion request."""
+        with self._lock:
+            self._in_flight -= 1
+
+    def _device_bucket(self, device_id: int, now: float) -> TokenBucket:
+        bucket = self._devices.get(device_id)
+        if bucket is None:
+            bucket = self._devices[device_id] = TokenBucket(self.device_rate, self.device_burst, now)
+            if len(self._devices) > MAX_DEVICE_BUCKETS:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(device_id)
+        return bucket
+
+    def admit(self, readings_by_device: dict[int, int], now: Optional[float] = None) -> float:
+        """Admit a batch of readings if every device it holds readings from,
+        and the server, has enough tokens. Nothing is taken from the buckets
+        otherwise.
+
+        Parameters
+        ----------
+        readings_by_device : dict[int, int]
+            The number of readings in the batch from each device.
+        now : Optional[float]
+            The current time, as returned by ``time.monotonic``.
+
+        Returns
+        -------
+        Zero if the batch is admitted, otherwise the number of seconds after
+        which it can be retried.
+        """
+        now = time.monotonic() if now is None else now
+        n_readings = sum(readings_by_device.values())
+        with self._lock:
+            buckets = []
+            wait = 0.0
+            if self.device_rate:
+                for device_id, count in readings_by_device.items():
+                    bucket = self._device_bucket(device_id, now)
+                    wait = max(wait, bucket.wait_time(count, now))
+                    buckets.append((bucket, count))
+            reason = "device_rate"
+
+            if not wait and self._global is not None:
+                wait = self._global.wait_time(n_readings, now)
+                buckets.append((self._global, n_readings))
+                reason = "global_rate"
+
+            if wait:
+                self.shed_requests[reason] += 1
+                self.shed_readings += n_readings
+                return wait
+
+            for bucket, count in buckets:
+                bucket.take(count, now)
+            self.admitted_requests += 1
+            self.admitted_readings += n_readings
+            return 0.0
+
+    def stats(self) -> dict:
+        """Get the admission counters.
+
+        Returns
+        -------
+        A dictionary with the number of ingestion requests in flight, the
+        number of requests and readings admitted, the number of requests shed
+        for each reason and the number of readings they held. Readings of
+        requests shed before their body was read are not counted.
+        """
+        with self._lock:
+            return dict(
+                in_flight=self._in_flight,
+                max_in_flight=self.max_in_flight,
+                admitted_requests=self.admitted_requests,
+                admitted_readings=self.admitted_readings,
+                shed_requests=dict(self.shed_requests),
+                shed_readings=self.shed_readings,
+            )
+
+
+def retry_after(wait: float) -> str:
+    """Format a wait time as the value of a ``Retry-After`` header, a whole
+    number of seconds."""
+    return str(max(1, math.ceil(wait)))
@@ -0,0 +1,470 @@
+"""
+This module moves old device data out of SQLite into a cold-tier archive
+of columnar NumPy files, and reads them back for
+:class:`~medops.models.device_models.DataStorage` queries.
+
+The archive holds one directory per datum type, patient and month of
+collection time, e.g. ``PulseDatum/12/202203/``, with the columns in a
+zlib compressed ``columns.npz`` file. Rows are sorted by collection time.
+To compress well, each column is stored with the smallest dtype that fits
+it:
+
+* ``collection_time`` holds the difference in microseconds from the previous
+  row, with the first row relative to a base kept in ``meta.json``.
+* ``received_time`` holds the microseconds from the collection time.
+* ``datum_id`` and ``device_id`` and integer fields hold their values.
+* Float fields are stored as float64 so values read back unchanged.
+
+A query only decompresses the columns it reads. Each partition's
+``meta.json`` records its first and last collection time, and each datum
+type directory has an ``index.json`` of the patients with data in each
+month, so queries skip the partitions outside their time window without
+opening them. Partitions written by the first version of the archive, with
+one memory mapped ``.npy`` file per column, are still read. Old data are
+archived with::
+
+    python -m medops.models archive <sqlite database file> <archive directory> --older-than-days 365
+"""
+from __future__ import annotations
+
+import heapq
+import json
+import os
+import shutil
+from datetime import datetime
+from itertools import chain
+from pathlib import Path
+from typing import Iterator, Optional
+
+import attr
+import numpy as np
+from peewee import chunked
+
+from .device_models import (
+    DATUM_TO_MODEL,
+    DeviceDatum,
+    datum_value_fields
+)
+
+ARCHIVE_VERSION = 2
+
+# The columns every partition has, in addition to the value fields.
+COMMON_COLUMNS = ["datum_id", "device_id", "received_time", "collection_time"]
+TIME_COLUMNS = ("received_time", "collection_time")
+
+# The number of rows deleted from SQLite per statement once archived.
+DELETE_BATCH_SIZE = 500
+
+
+def month_key(timestamp: datetime) -> str:
+    """The archive partition key, formatted as YYYYMM, of a timestamp."""
+    return f"{timestamp.year:04d}{timestamp.month:02d}"
+
+
+def next_month(timestamp: datetime) -> datetime:
+    """The start of the month after the one containing a timestamp."""
+    if timestamp.month == 12:
+        return datetime(timestamp.year + 1, 1, 1)
+    return datetime(timestamp.year, timestamp.month + 1, 1)
+
+
+def to_microseconds(timestamps) -> np.ndarray:
+    """Convert datetimes, or their SQLite string representation, into
+    microseconds since the epoch."""
+    return np.array(timestamps, dtype="datetime64[us]").astype(np.int64)
+
+
+def smallest_dtype(values: np.ndarray) -> np.dtype:
+    """The smallest integer dtype that can hold every value."""
+    if not len(values):
+        return np.dtype(np.int8)
+    return np.promote_types(np.min_scalar_type(values.min()), np.min_scalar_type(values.max()))
+
+
+def _value_dtypes(datum_cls: type) -> dict:
+    types = {field.name: field.type for field in attr.fields(datum_cls)}
+    return {field: np.int64 if types[field] in ("int", int) else np.float64
+            for field in datum_value_fields(datum_cls)}
+
+
+class ArchivePartition:
+    """The archived data of one datum type, patient and month.
+
+    Parameters
+    ----------
+    path : Path
+        The directory of the partition.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @property
+    def exists(self) -> bool:
+        return (self.path / "meta.json").exists()
+
+    def meta(self) -> dict:
+        """Read the partition's metadata: the archive version, the number of
+        rows, the base of the collection times and, since version 2, the
+        first and last collection time in microseconds since the epoch."""
+        with open(self.path / "meta.json") as f:
+            return json.load(f)
+
+    def overlaps(self, since: Optional[int], until: Optional[int]) -> bool:
+        """Whether the partition may hold rows collected within a window,
+        given in microseconds since the epoch, `until` excluded."""
+        meta = self.meta()
+        if "last_collection_time" not in meta:
+            return True
+        if since is not None and meta["last_collection_time"] < since:
+            return False
+        return until is None or meta["first_collection_time"] < until
+
+    def write(self, columns: dict[str, np.ndarray]):
+        """Replace the partition with new data.
+
+        Parameters
+        ----------
+        columns : dict[str, np.ndarray]
+            The decoded columns, i.e. with timestamps in microseconds since
+            the epoch, sorted by collection time and datum id.
+        """
+        collection = columns["collection_time"]
+        base = int(collection[0]) if len(collection) else 0
+        encoded = dict(columns)
+        encoded["collection_time"] = np.diff(collection, prepend=base)
+        encoded["received_time"] = columns["received_time"] - collection
+        for name in ["datum_id", "device_id", "collection_time", "received_time"]:
+            encoded[name] = encoded[name].astype(smallest_dtype(encoded[name]))
+
+        # Write a new directory and swap it in, so readers never see a
+        # partially written partition.
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        old = self.path.with_name(self.path.name + ".old")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        np.savez_compressed(tmp / "columns.npz", **encoded)
+        meta = dict(version=ARCHIVE_VERSION, count=len(collection), collection_time_base=base)
+        if len(collection):
+            meta.update(first_collection_time=int(collection[0]), last_collection_time=int(collection[-1]))
+        with open(tmp / "meta.json", "w") as f:
+            json.dump(meta, f)
+
+        if self.path.exists():
+            os.replace(self.path, old)
+        os.replace(tmp, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def read(self, names: Optional[set[str]] = None) -> dict[str, np.ndarray]:
+        """Read the columns of the partition. Timestamps are decoded into
+        microseconds since the epoch.
+
+        Parameters
+        ----------
+        names : Optional[set[str]]
+            The columns to read, all of them by default. The collection time
+            is always read.
+
+        Returns
+        -------
+        A dictionary mapping column names to arrays.
+        """
+        def wanted(name):
+            return names is None or name in names or name == "collection_time"
+
+        meta = self.meta()
+        if meta["version"] == 1:
+            columns = {file.stem: np.load(file, mmap_mode="r") for file in self.path.glob("*.npy") if wanted(file.stem)}
+        else:
+            with np.load(self.path / "columns.npz") as files:
+                columns = {name: files[name] for name in files.files if wanted(name)}
+
+        collection = meta["collection_time_base"] + np.cumsum(columns["collection_time"], dtype=np.int64)
+        columns["collection_time"] = collection
+        if "received_time" in columns:
+            columns["received_time"] = collection + columns["received_time"]
+        return columns
+
+
+class ColdArchive:
+    """A directory of archived device data.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        The root directory of the archive. It is created if it does not exist.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def partition(self, datum_cls: type, assigned_user: int, key: str) -> ArchivePartition:
+        return ArchivePartition(self.directory / datum_cls.__name__ / str(assigned_user) / key)
+
+    def users(self, datum_cls: type) -> list[int]:
+        """List the patients with archived data of a datum type."""
+        type_dir = self.directory / datum_cls.__name__
+        if not type_dir.exists():
+            return []
+        return sorted(int(p.name) for p in type_dir.iterdir() if p.name.lstrip("-").isdigit())
+
+    def months(self, datum_cls: type) -> dict[str, list[int]]:
+        """Map the month keys of a datum type to the patients with archived
+        data in that month. The map is kept in the ``index.json`` file of
+        the datum type, which is rebuilt from the directories if missing,
+        e.g. in archives written by the first version."""
+        path = self.directory / datum_cls.__name__ / "index.json"
+        if path.exists():
+            with open(path) as f:
+                return json.load(f)
+
+        months = {}
+        for user in self.users(datum_cls):
+            for partition in self.partitions(datum_cls, user):
+                months.setdefault(partition.path.name, []).append(user)
+        if months:
+            self._write_months(datum_cls, months)
+        return months
+
+    def _write_months(self, datum_cls: type, months: dict[str, list[int]]):
+        path = self.directory / datum_cls.__name__ / "index.json"
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({key: sorted(users) for key, users in sorted(months.items())}, f)
+        os.replace(tmp, path)
+
+    def partitions(self,
+                   datum_cls: type,
+                   assigned_user: int,
+                   since: Optional[datetime] = None,
+                   until: Optional[datetime] = None) -> list[ArchivePartition]:
+        """List the partitions of a patient that overlap a time window in
+        chronological order."""
+        user_dir = self.directory / datum_cls.__name__ / str(assigned_user)
+        if not user_dir.exists():
+            return []
+
+        first = month_key(since) if since is not None else None
+        last = month_key(until) if until is not None else None
+        keys = sorted(p.name for p in user_dir.iterdir() if p.name.isdigit())
+        return [ArchivePartition(user_dir / key) for key in keys
+                if (first is None or key >= first) and (last is None or key <= last)]
+
+    def append(self, datum_cls: type, assigned_user: int, key: str, columns: dict[str, np.ndarray]):
+        """Add rows to a partition, merging them with the rows already
+        archived. Rows with the same datum id and collection time as an
+        archived row are ignored, so archiving the same rows twice is
+        harmless. The collection time is compared too because SQLite may
+        reuse the ids of deleted rows."""
+        partition = self.partition(datum_cls, assigned_user, key)
+        if partition.exists:
+            existing = partition.read()
+            archived = set(zip(existing["datum_id"].tolist(), existing["collection_time"].tolist()))
+            keys = zip(columns["datum_id"].tolist(), columns["collection_time"].tolist())
+            new = np.array([k not in archived for k in keys], dtype=bool)
+            columns = {name: np.concatenate([np.asarray(existing[name]), values[new]])
+                       for name, values in columns.items()}
+
+        order = np.lexsort((columns["datum_id"], columns["collection_time"]))
+        partition.write({name: values[order] for name, values in columns.items()})
+
+        months = self.months(datum_cls)
+        if assigned_user not in months.get(key, []):
+            months.setdefault(key, []).append(assigned_user)
+            self._write_months(datum_cls, months)
+
+    def _window_partitions(self,
+                           datum_cls: type,
+                           assigned_user: Optional[int],
+                           since: Optional[datetime],
+                           until: Optional[datetime]) -> Iterator[tuple[int, ArchivePartition]]:
+        """Yield the patient and partition of each partition that may hold
+        data collected within a time window, in chronological order per
+        patient. Only the metadata of the partitions of the window's months
+        are read."""
+        if assigned_user is not None:
+            partitions = ((assigned_user, p) for p in self.partitions(datum_cls, assigned_user, since, until))
+        else:
+            first = month_key(since) if since is not None else None
+            last = month_key(until) if until is not None else None
+            partitions = ((user, self.partition(datum_cls, user, key))
+                          for key, users in sorted(self.months(datum_cls).items())
+                          if (first is None or key >= first) and (last is None or key <= last)
+                          for user in users)
+
+        since_us = None if since is None else int(to_microseconds(since))
+        until_us = None if until is None else int(to_microseconds(until))
+        for user, partition in partitions:
+            if partition.exists and partition.overlaps(since_us, until_us):
+                yield user, partition
+
+    def _masked(self,
+                datum_cls: type,
+                assigned_user: Optional[int],
+                device_id: Optional[int],
+                since: Optional[datetime],
+                until: Optional[datetime],
+                after: Optional[tuple],
+                names: Optional[set[str]] = None):
+        """Yield the patient and selected columns of each partition that
+        match the filters, in chronological order per patient. If `names`
+        is given, only those columns and the ones filtered on are read."""
+        window_start = since
+        if after is not None and (since is None or after[0] > since):
+            window_start = after[0]
+        if names is not None:
+            names = set(names) | {"device_id", "datum_id"}
+
+        for user, partition in self._window_partitions(datum_cls, assigned_user, window_start, until):
+            columns = partition.read(names)
+            collection = columns["collection_time"]
+            mask = np.ones(len(collection), dtype=bool)
+            if device_id is not None:
+                mask &= columns["device_id"] == device_id
+            if since is not None:
+                mask &= collection >= to_microseconds(since)
+            if until is not None:
+                mask &= collection < to_microseconds(until)
+            if after is not None:
+                mask &= self._after_mask(datum_cls, columns, after)
+
+            if mask.all():
+                yield user, columns
+            elif mask.any():
+                yield user, {name: values[mask] for name, values in columns.items()}
+
+    @staticmethod
+    def _after_mask(datum_cls: type, columns: dict, after: tuple) -> np.ndarray:
+        """The keyset condition of :meth:`DataStorage._select` as a mask."""
+        after_time, after_type, after_id = after
+        after_time = to_microseconds(after_time)
+        collection = columns["collection_time"]
+        if datum_cls.__name__ > after_type:
+            return collection >= after_time
+        elif datum_cls.__name__ == after_type:
+            return (collection > after_time) | ((collection == after_time) & (columns["datum_id"] > after_id))
+        return collection > after_time
+
+    def iter_data(self,
+                  datum_cls: type,
+                  assigned_user: Optional[int] = None,
+                  device_id: Optional[int] = None,
+                  since: Optional[datetime] = None,
+                  until: Optional[datetime] = None,
+                  after: Optional[tuple] = None) -> Iterator[DeviceDatum]:
+        """Read archived data of one datum type. See
+        :meth:`~medops.models.device_models.DataStorage.query` for the
+        parameters.
+
+        Returns
+        -------
+        An iterator of DeviceDatum instances ordered by collection time and
+        datum id.
+        """
+        fields = list(_value_dtypes(datum_cls))
+
+        def read(user, columns):
+            values = [columns[field].tolist() for field in fields]
+            rows = zip(columns["datum_id"].tolist(),
+                       columns["device_id"].tolist(),
+                       columns["received_time"].astype("datetime64[us]").tolist(),
+                       columns["collection_time"].astype("datetime64[us]").tolist(),
+                       *values)
+            for datum_id, device, received, collected, *row in rows:
+                yield datum_cls(datum_id=datum_id,
+                                device_id=device,
+                                assigned_user=user,
+                                received_time=received,
+                                collection_time=collected,
+                                **dict(zip(fields, row)))
+
+        by_user = {}
+        for user, columns in self._masked(datum_cls, assigned_user, device_id, since, until, after):
+            by_user.setdefault(user, []).append(read(user, columns))
+
+        cursors = [chain.from_iterable(partitions) for partitions in by_user.values()]
+        return heapq.merge(*cursors, key=lambda d: (d.collection_time, d.datum_id))
+
+    def iter_columns(self,
+                     datum_cls: type,
+                     columns: list[str],
+                     assigned_user: Optional[int] = None,
+                     device_id: Optional[int] = None,
+                     since: Optional[datetime] = None,
+                     until: Optional[datetime] = None) -> Iterator[tuple]:
+        """Read the values of some columns of one archived datum type. Like
+        :meth:`DataStorage.iter_columns`, timestamps are returned as strings
+        and rows are not ordered."""
+        for user, selected in self._masked(datum_cls, assigned_user, device_id, since, until, None, set(columns)):
+            n_rows = len(selected["collection_time"])
+            values = []
+            for column in columns:
+                if column == "assigned_user":
+                    values.append([user] * n_rows)
+                elif column in TIME_COLUMNS:
+                    values.append([str(t) for t in selected[column].astype("datetime64[us]").tolist()])
+                else:
+                    values.append(selected[column].tolist())
+            yield from zip(*values)
+
+
+def archive_data(storage, archive: ColdArchive, before: datetime) -> int:
+    """Move the data collected before a time from a storage's SQLite tables
+    into the archive.
+
+    The data are processed one datum type and month at a time. The archive
+    files of a month are written before its rows are deleted, and only the
+    rows that were written are deleted.
+
+    Parameters
+    ----------
+    storage : DataStorage
+        The storage to archive data from.
+    archive : ColdArchive
+        The archive to move the data to.
+    before : datetime
+        Data collected before this time are archived.
+
+    Returns
+    -------
+    The number of data archived.
+    """
+    n_archived = 0
+    for datum_cls, Model in DATUM_TO_MODEL.items():
+        dtypes = _value_dtypes(datum_cls)
+        first = Model.select(Model.collection_time).order_by(Model.collection_time).limit(1).scalar()
+        if first is None:
+            continue
+
+        month = datetime.fromisoformat(str(first)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        while month < before:
+            end = min(next_month(month), before)
+            query = storage._select(Model, since=month, until=end)
+            selected = [Model.assigned_user] + [getattr(Model, c) for c in COMMON_COLUMNS + list(dtypes)]
+            rows = list(storage.database.execute(query.select(*selected)))
+            if rows:
+                values = list(zip(*rows))
+                users = np.array(values[0], dtype=np.int64)
+                columns = dict(
+                    datum_id=np.array(values[1], dtype=np.int64),
+                    device_id=np.array(values[2], dtype=np.int64),
+                    received_time=to_microseconds(values[3]),
+                    collection_time=to_microseconds(values[4]),
+                )
+                for i, (field, dtype) in enumerate(dtypes.items()):
+                    columns[field] = np.array(values[5 + i], dtype=dtype)
+
+                for user in np.unique(users):
+                    mask = users == user
+                    archive.append(datum_cls, int(user), month_key(month),
+                                   {name: column[mask] for name, column in columns.items()})
+
+                with storage.database.atomic():
+                    for ids in chunked(columns["datum_id"].tolist(), DELETE_BATCH_SIZE):
+                        Model.delete().where(Model.datum_id.in_(ids)).execute()
+                n_archived += len(rows)
+
+            month = next_month(month)
+
+    return n_archived
@@ -0,0 +1,334 @@
+"""
+This module persists the assignment of devices to patients and keeps an
+in-memory interval index of them, so that data posted without an
+assigned user can be tagged with the patient that had the device at the
+time each datum was collected.
+
+A device is assigned to at most one patient at a time: the assignments of
+a device never overlap. Each device's assignments are kept sorted by start
+time, so finding the assignment that covers a timestamp is a binary search.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Optional
+
+import attr
+from peewee import (
+    AutoField,
+    DateTimeField,
+    IntegerField
+)
+
+from .base import (
+    BaseModel,
+    SqliteStorage,
+    register
+)
+from .device_models import DeviceAssignment, DeviceDatum, naive_utc
+
+ASSIGNMENT_TABLES = []
+
+# The user data are tagged with when their device was not assigned to anyone
+# at the time they were collected.
+UNASSIGNED_USER = -1
+
+
+@register(ASSIGNMENT_TABLES)
+class DeviceAssignmentModel(BaseModel):
+    """The relational model for persisting device assignments. See
+    :class:`~medops.models.device_models.DeviceAssignment` for a
+    description of the fields."""
+    assignment_id = AutoField()
+    device_id = IntegerField(null=False)
+    patient_id = IntegerField(null=False)
+    assigner_id = IntegerField(null=False)
+    date_assigned = DateTimeField(null=False)
+    date_returned = DateTimeField(null=True)
+
+    class Meta:
+        table_name = "device_assignments"
+        indexes = (
+            (("device_id", "date_assigned", "date_returned"), False),
+            (("patient_id",), False),
+        )
+
+    def to_dataclass(self) -> DeviceAssignment:
+        """Create a DeviceAssignment data class from a model instance."""
+        return DeviceAssignment(
+            assignment_id=self.assignment_id,
+            device_id=self.device_id,
+            patient_id=self.patient_id,
+            assigner_id=self.assigner_id,
+            date_assigned=self.date_assigned,
+            date_returned=self.date_returned
+        )
+
+    @staticmethod
+    def from_dataclass(assignment: DeviceAssignment) -> DeviceAssignmentModel:
+        """Create a model instance from a DeviceAssignment data class."""
+        return DeviceAssignmentModel(
+            assignment_id=assignment.assignment_id,
+            device_id=assignment.device_id,
+            patient_id=assignment.patient_id,
+            assigner_id=assignment.assigner_id,
+            date_assigned=assignment.date_assigned,
+            date_returned=assignment.date_returned
+        )
+
+
+def with_naive_dates(assignment: DeviceAssignment) -> DeviceAssignment:
+    """Convert the offset-aware dates of an assignment to naive UTC, the
+    form collection times are stored and compared in."""
+    date_returned = assignment.date_returned
+    return attr.evolve(assignment,
+                       date_assigned=naive_utc(assignment.date_assigned),
+                       date_returned=None if date_returned is None else naive_utc(date_returned))
+
+
+class AssignmentIndex:
+    """An in-memory index of device assignments for point lookups.
+
+    Parameters
+    ----------
+    assignments : Iterable[DeviceAssignment]
+        The assignments to index. The assignments of a device must not
+        overlap.
+    """
+
+    def __init__(self, assignments=()):
+        by_device = {}
+        for assignment in assignments:
+            by_device.setdefault(assignment.device_id, []).append(assignment)
+
+        # For each device, the sorted start times and the matching
+        # (end time, patient id) pairs.
+        self._starts = {}
+        self._intervals = {}
+        for device_id, device_assignments in by_device.items():
+            device_assignments.sort(key=lambda a: a.date_assigned)
+            self._starts[device_id] = [a.date_assigned for a in device_assignments]
+            self._intervals[device_id] = [(a.date_returned, a.patient_id) for a in device_assignments]
+
+    def lookup(self, device_id: int, timestamp: datetime) -> Optional[int]:
+        """Find the patient a device was assigned to at some time.
+
+        Parameters
+        ----------
+        device_id : int
+            The device to look up.
+        timestamp : datetime
+            The time of interest. Assignments include their start time and
+            exclude their return time.
+
+        Returns
+        -------
+        The patient id, or None if the device was not assigned at that time.
+        """
+        starts = self._starts.get(device_id)
+        if not starts:
+            return None
+
+        i = bisect_right(starts, timestamp) - 1
+        if i < 0:
+            return None
+
+        date_returned, patient_id = self._intervals[device_id][i]
+        if date_returned is not None and timestamp >= date_returned:
+            return None
+        return patient_id
+
+
+class DeviceAssignmentStorage(SqliteStorage):
+    """SqliteStorage implementation for device assignments.
+
+    The storage keeps an :class:`AssignmentIndex` of every assignment. It is
+    rebuilt whenever this instance changes an assignment and, to pick up
+    changes made by other processes, at most every `refresh_interval`
+    seconds when it is used.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the sqlite database to use.
+    refresh_interval : float
+        The maximum age in seconds of the index before it is reloaded.
+    """
+
+    tables = ASSIGNMENT_TABLES
+
+    def __init__(self, filename, refresh_interval: float = 5.0):
+        super().__init__(filename)
+        self.refresh_interval = refresh_interval
+        self._index = None
+        self._index_loaded = 0.0
+        self._index_lock = threading.Lock()
+
+    def query(self,
+              device_id: Optional[int] = None,
+              patient_id: Optional[int] = None) -> list[DeviceAssignment]:
+        """Query assignments ordered by device and start time.
+
+        Parameters
+        ----------
+        device_id : Optional[int]
+            Only return the assignments of this device.
+        patient_id : Optional[int]
+            Only return the assignments to this patient.
+
+        Returns
+        -------
+        A list of DeviceAssignment instances.
+        """
+        M = DeviceAssignmentModel
+        query = M.select()
+        if device_id is not None:
+            query = query.where(M.device_id == device_id)
+
+        if patient_id is not None:
+            query = query.where(M.patient_id == patient_id)
+
+        query = query.order_by(M.device_id, M.date_assigned)
+        return [m.to_dataclass() for m in query]
+
+    def get(self, assignment_id: int) -> Optional[DeviceAssignment]:
+        """Get an assignment by its id.
+
+        Returns
+        -------
+        None if the assignment does not exist, otherwise a DeviceAssignment
+        instance.
+        """
+        model = DeviceAssignmentModel.get_or_none(DeviceAssignmentModel.assignment_id == assignment_id)
+        if model is None:
+            return None
+        return model.to_dataclass()
+
+    def _check_overlap(self, assignment: DeviceAssignment):
+        """Raise a ValueError if an assignment is invalid or overlaps another
+        assignment of the same device."""
+        if assignment.date_returned is not None and assignment.date_returned <= assignment.date_assigned:
+            raise ValueError("date_returned must be after date_assigned.")
+
+        M = DeviceAssignmentModel
+        not_returned_before = M.date_returned.is_null() | (M.date_returned > assignment.date_assigned)
+        query = M.select().where((M.device_id == assignment.device_id) & not_returned_before)
+        if assignment.date_returned is not None:
+            query = query.where(M.date_assigned < assignment.date_returned)
+
+        if assignment.assignment_id is not None:
+            query = query.where(M.assignment_id != assignment.assignment_id)
+
+        if query.exists():
+            raise ValueError(f"Device {assignment.device_id} is already assigned during this period.")
+
+    def create(self, assignment: DeviceAssignment) -> DeviceAssignment:
+        """Assign a device to a patient.
+
+        Parameters
+        ----------
+        assignment : DeviceAssignment
+            The assignment to create. Its `assignment_id` must be None.
+
+        Returns
+        -------
+        A DeviceAssignment instance with the generated id.
+
+        Raises
+        ------
+        ValueError if the assignment overlaps an existing assignment of the
+        device.
+        """
+        if assignment.assignment_id is not None:
+            raise ValueError("assignment_id must be None when creating a new assignment.")
+
+        assignment = with_naive_dates(assignment)
+        with self.database.atomic():
+            self._check_overlap(assignment)
+            model = DeviceAssignmentModel.from_dataclass(assignment)
+            model.save()
+
+        self.refresh()
+        return model.to_dataclass()
+
+    def update(self, assignment: DeviceAssignment) -> DeviceAssignment:
+        """Update an existing assignment, e.g. to record that the device was
+        returned.
+
+        Raises
+        ------
+        ValueError if the updated assignment overlaps another assignment of
+        the device.
+        """
+        assignment = with_naive_dates(assignment)
+        with self.database.atomic():
+            self._check_overlap(assignment)
+            model = DeviceAssignmentModel.from_dataclass(assignment)
+            model.save()
+
+        self.refresh()
+        return model.to_dataclass()
+
+    def delete(self, assignment_id: int) -> bool:
+        """Delete an assignment.
+
+        Returns
+        -------
+        True if an assignment was deleted.
+        """
+        deleted = DeviceAssignmentModel.delete_by_id(assignment_id)
+        self.refresh()
+        return deleted > 0
+
+    def refresh(self) -> AssignmentIndex:
+        """Reload the assignment index from the database."""
+        index = AssignmentIndex(self.query())
+        with self._index_lock:
+            self._index = index
+            self._index_loaded = time.monotonic()
+        return index
+
+    @property
+    def index(self) -> AssignmentIndex:
+        """The assignment index, reloaded first if it is stale."""
+        with self._index_lock:
+            index = self._index
+            stale = time.monotonic() - self._index_loaded > self.refresh_interval
+
+        if index is None or stale:
+            index = self.refresh()
+        return index
+
+    def assign_users(self, data: list[DeviceDatum]) -> int:
+        """Tag data that have no assigned user with the patient their device
+        was assigned to when they were collected. Data collected while their
+        device was not assigned are tagged with :data:`UNASSIGNED_USER`.
+        Offset-aware collection times are looked up in naive UTC.
+
+        Parameters
+        ----------
+        data : list[DeviceDatum]
+            The data to tag. Data that already have an assigned user are not
+            changed.
+
+        Returns
+        -------
+        The number of data that were tagged with a patient.
+        """
+        index = self.index
+        n_assigned = 0
+        for datum in data:
+            if datum.assigned_user is not None:
+                continue
+
+            patient_id = index.lookup(datum.device_id, naive_utc(datum.collection_time))
+            if patient_id is None:
+                datum.assigned_user = UNASSIGNED_USER
+            else:
+                datum.assigned_user = patient_id
+                n_assigned += 1
+
+        return n_assigned
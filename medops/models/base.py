@@ -3,11 +3,16 @@ This module provides some base definitions and functions used by
 other model modules.
 """
 
+import logging
+
 from peewee import (
+    IntegrityError,
     Model,
     SqliteDatabase,
 )
 
+LOGGER = logging.getLogger("medops")
+
 
 class BaseModel(Model):
     """Recommended practice is to have a base model that
@@ -67,6 +72,17 @@ class SqliteStorage(Storage):
         to_create = [model for model in self.tables if not model.table_exists()]
         self.database.create_tables(to_create)
 
+        # Tables created by an earlier version may be missing indexes that
+        # have since been added to the models. A unique index can't be added
+        # while the table holds duplicates, which must be removed first.
+        for model in self.tables:
+            if model not in to_create:
+                for query in model._schema._create_indexes(safe=True):
+                    try:
+                        self.database.execute(query)
+                    except IntegrityError as err:
+                        LOGGER.warning("Could not create an index on %s: %s", model._meta.table_name, err)
+
     def __setattr__(self, attr, value):
         if attr == "tables":
             raise Exception("tables should not be overwritten at runtime.")
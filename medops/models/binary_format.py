@@ -0,0 +1,201 @@
+"""
+This module implements a compact binary format for uploading device data,
+meant for devices that send many small readings, e.g. pulse oximeters and
+continuous glucose monitors.
+
+A payload is one or more blocks. Each block holds the readings of one datum
+type from one device: a fixed size header followed by fixed width records.
+All values are little-endian.
+
+The header is packed as ``<4sBBHqqI``:
+
+=============  ========  ==================================================
+Field          Type      Description
+=============  ========  ==================================================
+magic          4 bytes   ``b"MOPS"``
+version        uint8     :data:`FORMAT_VERSION`
+type_code      uint8     The datum type, see :data:`TYPE_CODES`
+flags          uint16    Bit 0 is set if `assigned_user` is given
+device_id      int64     The device that collected the readings
+assigned_user  int64     The patient, ignored unless flagged
+count          uint32    The number of records following the header
+=============  ========  ==================================================
+
+Each record is the collection time, as an int64 of microseconds since the
+Unix epoch, followed by the measurement fields of the datum type in the order
+they are declared: int32 for integer fields and float64 for float fields,
+e.g. ``<q i`` for a pulse reading and ``<q d d`` for a blood pressure
+reading. The records of a block are decoded at once with NumPy.
+"""
+from __future__ import annotations
+
+import struct
+from datetime import datetime
+from typing import Optional, Sequence
+
+import attr
+import numpy as np
+
+from .device_models import (
+    BloodPressureDatum,
+    BloodSaturationDatum,
+    DeviceDatum,
+    GlucometerDatum,
+    PulseDatum,
+    TemperatureDatum,
+    WeightDatum,
+    VALUE_RANGES,
+    datum_value_fields
+)
+
+MAGIC = b"MOPS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBBHqqI")
+FLAG_ASSIGNED_USER = 0x1
+
+# The codes identifying the datum type of a block. These are part of the
+# format and must not change.
+TYPE_CODES = {
+    TemperatureDatum: 1,
+    BloodPressureDatum: 2,
+    GlucometerDatum: 3,
+    PulseDatum: 4,
+    WeightDatum: 5,
+    BloodSaturationDatum: 6,
+}
+
+# The range of collection times that can be represented as datetimes.
+MIN_TIMESTAMP = 0
+MAX_TIMESTAMP = int((datetime(9999, 12, 31) - datetime(1970, 1, 1)).total_seconds()) * 10**6
+
+
+class _RecordType:
+    """Precomputed record layout of one datum type."""
+
+    def __init__(self, datum_cls: type):
+        self.datum_cls = datum_cls
+        self.code = TYPE_CODES[datum_cls]
+        self.fields = datum_value_fields(datum_cls)
+        types = {field.name: field.type for field in attr.fields(datum_cls)}
+        self.float_fields = [field for field in self.fields if types[field] not in ("int", int)]
+        self.dtype = np.dtype([("time", "<i8")] + [
+            (field, "<f8" if field in self.float_fields else "<i4") for field in self.fields
+        ])
+
+    def decode(self,
+               records: np.ndarray,
+               device_id: int,
+               assigned_user: Optional[int],
+               received_time: datetime) -> list[DeviceDatum]:
+        times = records["time"]
+        if len(times) and (times.min() < MIN_TIMESTAMP or times.max() > MAX_TIMESTAMP):
+            raise ValueError(f"Collection times of {self.datum_cls.__name__} records are out of range.")
+
+        for field, (low, high) in VALUE_RANGES[self.datum_cls].items():
+            values = records[field]
+            # NaN fails both comparisons.
+            if not ((values >= low) & (values <= high)).all():
+                raise ValueError(f"{field} values must be between {low} and {high}.")
+
+        collection_times = times.astype("datetime64[us]").astype(object).tolist()
+        columns = [records[field].tolist() for field in self.fields]
+        datum_cls = self.datum_cls
+        fields = self.fields
+        return [datum_cls(device_id=device_id,
+                          assigned_user=assigned_user,
+                          received_time=received_time,
+                          collection_time=collection_time,
+                          **dict(zip(fields, values)))
+                for collection_time, *values in zip(collection_times, *columns)]
+
+
+RECORD_TYPES = {datum_cls: _RecordType(datum_cls) for datum_cls in TYPE_CODES}
+RECORD_CODE_TYPES = {record_type.code: record_type for record_type in RECORD_TYPES.values()}
+
+
+def encode_block(datum_cls: type,
+                 device_id: int,
+                 collection_times: Sequence[datetime],
+                 values: dict,
+                 assigned_user: Optional[int] = None) -> bytes:
+    """Pack the readings of one datum type from one device into a block.
+    Blocks can be concatenated into a single payload.
+
+    Parameters
+    ----------
+    datum_cls : type
+        The DeviceDatum subclass of the readings.
+    device_id : int
+        The device that collected the readings.
+    collection_times : Sequence[datetime]
+        The collection time of each reading.
+    values : dict
+        A sequence of values for each measurement field of the datum type,
+        e.g. ``{"bpm": [60, 61]}``.
+    assigned_user : Optional[int]
+        The patient the readings were collected from. If None, the server
+        looks the patient up from the device assignments.
+
+    Returns
+    -------
+    The packed block.
+    """
+    record_type = RECORD_TYPES[datum_cls]
+    records = np.empty(len(collection_times), dtype=record_type.dtype)
+    records["time"] = np.array(collection_times, dtype="datetime64[us]").astype("<i8")
+    for field in record_type.fields:
+        records[field] = values[field]
+
+    flags = 0 if assigned_user is None else FLAG_ASSIGNED_USER
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, record_type.code, flags, device_id,
+                         assigned_user or 0, len(records))
+    return header + records.tobytes()
+
+
+def decode(payload: bytes, received_time: Optional[datetime] = None) -> list[DeviceDatum]:
+    """Unpack the readings of a binary payload.
+
+    Parameters
+    ----------
+    payload : bytes
+        One or more blocks packed as described in this module.
+    received_time : Optional[datetime]
+        The received time of the data. Defaults to now.
+
+    Returns
+    -------
+    A list of DeviceDatum instances in the order of the payload. Data
+    without an assigned user have `assigned_user` set to None.
+
+    Raises
+    ------
+    ValueError if the payload is malformed.
+    """
+    received_time = received_time or datetime.now()
+    data = []
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < HEADER.size:
+            raise ValueError(f"Truncated block header at byte {offset}.")
+
+        magic, version, type_code, flags, device_id, assigned_user, count = HEADER.unpack_from(payload, offset)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid block at byte {offset}: bad magic number.")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version: {version}")
+        if type_code not in RECORD_CODE_TYPES:
+            raise ValueError(f"Invalid data type code: {type_code}")
+
+        record_type = RECORD_CODE_TYPES[type_code]
+        offset += HEADER.size
+        size = count * record_type.dtype.itemsize
+        if len(payload) - offset < size:
+            raise ValueError(f"Truncated block: expected {count} records of {record_type.dtype.itemsize} bytes.")
+
+        records = np.frombuffer(payload, dtype=record_type.dtype, count=count, offset=offset)
+        offset += size
+        if not flags & FLAG_ASSIGNED_USER:
+            assigned_user = None
+        data.extend(record_type.decode(records, device_id, assigned_user, received_time))
+
+    return data
@@ -0,0 +1,144 @@
+"""
+This module provides a small in-process cache for storage reads of records
+that rarely change, e.g. device metadata.
+
+Each server process has its own cache. Writes through a storage invalidate
+the entries of that process only, so entries also expire after a time to
+live to bound how stale they can be in the other processes.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """A bounded cache that evicts the least recently used entry when full
+    and drops entries older than a time to live. It is safe to use from
+    several threads.
+
+    Parameters
+    ----------
+    max_size : int
+        The maximum number of entries.
+    ttl : Optional[float]
+        The number of seconds an entry is used for. If None, entries don't
+        expire.
+    clock : Callable[[], float]
+        The time source, ``time.monotonic`` by default.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        if max_size < 1:
+            raise ValueError("max_size must be at least one.")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented by every invalidation, so a value read from the
+        # database before a write is not cached after it.
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: Hashable) -> tuple[bool, Any, int]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value, self._generation
+                del self._entries[key]
+
+            self.misses += 1
+            return False, None, self._generation
+
+    def _store(self, key: Hashable, value: Any, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """Get the cached value of a key, or load and cache it.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the value.
+        load : Callable[[], Any]
+            Reads the value when it is not cached. None results are not
+            cached, so records created later are found.
+
+        Returns
+        -------
+        The value.
+        """
+        found, value, generation = self._lookup(key)
+        if found:
+            return value
+
+        value = load()
+        if value is not None:
+            self._store(key, value, generation)
+        return value
+
+    def invalidate(self, *keys: Hashable, match: Optional[Callable[[Hashable], bool]] = None):
+        """Drop the entries of some keys. Values being loaded while this is
+        called are not cached.
+
+        Parameters
+        ----------
+        *keys : Hashable
+            The keys to drop.
+        match : Optional[Callable[[Hashable], bool]]
+            If given, also drop the entries whose key it returns True for,
+            e.g. every cached query result.
+        """
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+            if match is not None:
+                for key in [key for key in self._entries if match(key)]:
+                    del self._entries[key]
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Get the cache counters.
+
+        Returns
+        -------
+        A dictionary with the number of entries, the maximum number of
+        entries, the number of hits, misses and evictions, and the hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+            )
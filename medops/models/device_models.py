@@ -4,13 +4,21 @@ when loaded from the data store.
 """
 from __future__ import annotations
 
-from typing import Optional
+import heapq
+import json
+import sys
+from itertools import chain, islice
+from typing import Iterator, Optional
 import attr
 from attr import asdict
 
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 
 from peewee import (
+    SQL,
+    Tuple,
+    chunked,
+    fn,
     DateTimeField,
     IntegerField,
     FloatField,
@@ -18,6 +26,7 @@ from peewee import (
     AutoField
 )
 
+from .cache import LRUCache
 from .base import (
     BaseModel,
     SqliteStorage,
@@ -27,6 +36,28 @@ from .base import (
 DEVICE_TABLES = []
 DATA_TABLES = []
 DATUM_TO_MODEL = {}
+# Functions called with (storage, data) inside the transaction that stores
+# a batch of data, used to keep derived tables up to date.
+INGEST_HOOKS = []
+# Tables maintained by INGEST_HOOKS. They are created alongside the datum
+# tables by every data storage layout.
+DERIVED_TABLES = []
+
+# SQLite limits the number of bound parameters in a single statement
+# (999 on older builds), so multi-row inserts are split into batches
+# that stay well below that for every datum model.
+INSERT_BATCH_SIZE = 100
+
+# The number of device ids per query when looking up already stored readings.
+KEY_QUERY_BATCH_SIZE = 500
+
+# The fields of a device besides its id.
+DEVICE_FIELDS = ["name", "current_firmware_version", "date_of_purchase", "serial_number", "mac_address"]
+
+# The default number of device reads cached by DeviceStorage, and the number
+# of seconds they are used for. A query result is one read.
+DEVICE_CACHE_SIZE = 1024
+DEVICE_CACHE_TTL = 60.0
 
 @attr.s(auto_attribs=True, kw_only=True)
 class Device:
@@ -84,11 +115,14 @@ class Device:
         return asdict(self)
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class DeviceDatum:
     """Base class for different device datum types. This class should
     not be used directly.
 
+    The datum classes are slotted, since queries can create millions of
+    them, so attributes other than their fields cannot be set.
+
     Parameters
     ----------
         device_id : int
@@ -152,7 +186,7 @@ class DeviceDatum:
                    collection_time=collection_time)
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class TemperatureDatum(DeviceDatum):
     """A temperature datum
 
@@ -166,7 +200,7 @@ class TemperatureDatum(DeviceDatum):
     deg_c: float
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class BloodPressureDatum(DeviceDatum):
     """A blood pressure datum
 
@@ -183,7 +217,7 @@ class BloodPressureDatum(DeviceDatum):
     diastolic: float
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class GlucometerDatum(DeviceDatum):
     """A glucose level reading
 
@@ -197,7 +231,7 @@ class GlucometerDatum(DeviceDatum):
     mg_dl: int
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class PulseDatum(DeviceDatum):
     """A heart rate dataum
 
@@ -211,7 +245,7 @@ class PulseDatum(DeviceDatum):
     bpm: int
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class WeightDatum(DeviceDatum):
     """A weight datum
 
@@ -225,7 +259,7 @@ class WeightDatum(DeviceDatum):
     grams: int
 
 
-@attr.s(auto_attribs=True, kw_only=True)
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
 class BloodSaturationDatum(DeviceDatum):
     """Blood saturation datum
 
@@ -262,6 +296,10 @@ class DeviceAssignment:
     date_returned : Optional[datetime]
         The date when the device is no longer recording data from the patient.
         This field should be set to None
+
+    assignment_id : Optional[int]
+        An internal identifier for the assignment. This field will be
+        auto-generated when a new assignment is created.
     """
 
     device_id: int
@@ -269,6 +307,19 @@ class DeviceAssignment:
     assigner_id: int
     date_assigned: datetime
     date_returned: Optional[datetime]
+    assignment_id: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        """Convert the model into a dict representation for serialization."""
+        return asdict(self)
+
+    def to_json(self) -> dict:
+        """Converts the model into a json serializeable dictionary."""
+        data = self.to_dict()
+        data['date_assigned'] = self.date_assigned.isoformat()
+        if self.date_returned is not None:
+            data['date_returned'] = self.date_returned.isoformat()
+        return data
 
 
 @register(DEVICE_TABLES)
@@ -281,8 +332,16 @@ class DeviceModel(BaseModel):
     name = CharField(unique=True)
     current_firmware_version = CharField(null=True)
     date_of_purchase = DateTimeField(null=True)
-    serial_number = CharField(null=True)
-    mac_address = CharField(null=True, max_length=100)
+    # Gateways identify devices by serial number or MAC address.
+    serial_number = CharField(null=True, index=True)
+    mac_address = CharField(null=True, max_length=100, index=True)
+
+    class Meta:
+        indexes = (
+            # Devices running a firmware version, in the order they are
+            # paged through.
+            (("current_firmware_version", "device_id"), False),
+        )
 
     def to_dataclass(self) -> Device:
         """Create a Device data class from a model instance."""
@@ -319,6 +378,18 @@ class DeviceDatumModel(BaseModel):
     received_time = DateTimeField(null=False)
     collection_time = DateTimeField(null=False)
 
+    class Meta:
+        # Inherited by every datum model. These cover the common access
+        # patterns: a patient's timeline, a device's timeline and time windows
+        # across all patients. A device can't report two readings of the same
+        # type at the same time, so the device index is also the key used to
+        # drop duplicate readings.
+        indexes = (
+            (("assigned_user", "collection_time"), False),
+            (("device_id", "collection_time"), True),
+            (("collection_time",), False),
+        )
+
     @classmethod
     def from_dataclass(cls, instance: DeviceDatum) -> DeviceDatumModel:
         """This classmethod is used to automate the conversion between
@@ -353,6 +424,47 @@ class DeviceDatumModel(BaseModel):
 
         return cls(**attrs)
 
+    @classmethod
+    def converter(cls) -> DatumConverter:
+        """The :class:`DatumConverter` of this model. It is created on first
+        use and shared by all instances."""
+        converter = DATUM_CONVERTERS.get(cls)
+        if converter is None:
+            converter = DatumConverter(cls)
+            DATUM_CONVERTERS[cls] = converter
+        return converter
+
+    @classmethod
+    def datum_class(cls) -> type:
+        """The DeviceDatum subclass stored by this model, or by the model
+        it derives from, e.g. for the partitions of a datum model."""
+        for model_cls in cls.__mro__:
+            if model_cls in MODEL_TO_DATUM:
+                return MODEL_TO_DATUM[model_cls]
+        raise ValueError(f"No datum class found for model: {cls.__name__}")
+
+    @classmethod
+    def insert_fields(cls) -> list:
+        """The fields written when inserting a new datum. The datum_id
+        is left out so the database can assign it."""
+        return [f for f in cls._meta.sorted_fields if f.name != "datum_id"]
+
+    @classmethod
+    def row_from_dataclass(cls, instance: DeviceDatum) -> tuple:
+        """Convert a datum into a row tuple ordered like
+        :meth:`insert_fields` for use with multi-row inserts.
+
+        Parameters
+        ----------
+        instance : DeviceDatum
+            The datum instance to convert.
+
+        Returns
+        -------
+        A tuple of column values.
+        """
+        return tuple(getattr(instance, field.name) for field in cls.insert_fields())
+
     def to_dataclass(self) -> DeviceDatum:
         """Convert this model into the appropriate dataclass
 
@@ -360,17 +472,33 @@ class DeviceDatumModel(BaseModel):
         -------
         An instance of the dataclass for the appropriate datum type.
         """
+        return self.converter().from_model(self)
 
-        DatumClass = None
-        for data_cls, model_cls in DATUM_TO_MODEL.items():
-            if isinstance(self, model_cls):
-                DatumClass = data_cls
 
-        attrs = {}
-        for field in self._meta.sorted_fields:
-            attrs[field.name] = getattr(self, field.name)
+class DatumConverter:
+    """Precomputed conversion from the rows of a datum model to datum
+    instances. The datum class and field names are looked up once per model
+    instead of once per row.
+
+    Parameters
+    ----------
+    Model : DeviceDatumModel
+        The datum model, or a model derived from one.
+    """
+
+    def __init__(self, Model):
+        self.datum_cls = Model.datum_class()
+        self.names = tuple(field.name for field in Model._meta.sorted_fields)
+
+    def from_row(self, row: tuple) -> DeviceDatum:
+        """Create a datum from a row of values ordered like the model's
+        fields, e.g. as read with ``Model.select().tuples()``."""
+        return self.datum_cls(**dict(zip(self.names, row)))
 
-        return DatumClass(**attrs)
+    def from_model(self, model: DeviceDatumModel) -> DeviceDatum:
+        """Create a datum from a model instance."""
+        values = model.__data__
+        return self.datum_cls(**{name: values.get(name) for name in self.names})
 
 
 @register(DATA_TABLES)
@@ -410,15 +538,144 @@ class BloodSaturationDatumModel(DeviceDatumModel):
     percentage = FloatField()
 
 
+def _as_date(value: Optional[date]) -> Optional[date]:
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _json_values(values: list):
+    # A subquery over a JSON array bound as one variable.
+    return SQL("(SELECT value FROM json_each(?))", [json.dumps(values)])
+
+
+def _is_query_key(key) -> bool:
+    # Devices are cached by id and query results by a tuple of arguments.
+    return isinstance(key, tuple)
+
+
 class DeviceStorage(SqliteStorage):
-    """SqliteStorage Implementation for devices"""
+    """SqliteStorage Implementation for devices
+
+    Devices are read far more often than they change, e.g. to validate
+    uploads, so reads go through a least recently used cache. Writes through
+    the storage invalidate the entries they affect. Other server processes
+    have their own cache and only see a write once their entries expire.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the sqlite database to use.
+    cache_size : int
+        The maximum number of cached reads. Zero disables the cache.
+    cache_ttl : Optional[float]
+        The number of seconds a cached read is used for. If None, entries
+        only expire when invalidated.
+    """
 
     tables = DEVICE_TABLES
 
-    def query(self):
-        query = DeviceModel.select()
-        models = list(query)
-        return [m.to_dataclass() for m in models]
+    def __init__(self,
+                 filename,
+                 cache_size: int = DEVICE_CACHE_SIZE,
+                 cache_ttl: Optional[float] = DEVICE_CACHE_TTL):
+        super().__init__(filename)
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+
+    def _cached(self, key, load):
+        if self.cache is None:
+            return load()
+        return self.cache.get_or_load(key, load)
+
+    def _invalidate(self, *device_ids):
+        # Any write may change the results of queries, which are cached by
+        # their arguments.
+        if self.cache is not None:
+            self.cache.invalidate(*device_ids, match=_is_query_key)
+
+    def cache_stats(self) -> Optional[dict]:
+        """Get the counters of the device cache, see
+        :meth:`~medops.models.cache.LRUCache.stats`. None if the cache is
+        disabled."""
+        return None if self.cache is None else self.cache.stats()
+
+    def query(self,
+              serial_number: Optional[str] = None,
+              mac_address: Optional[str] = None,
+              current_firmware_version: Optional[str] = None,
+              purchased_since: Optional[date] = None,
+              purchased_until: Optional[date] = None,
+              name_prefix: Optional[str] = None,
+              limit: Optional[int] = None,
+              after: Optional[int] = None) -> list[Device]:
+        """Query devices. Lookups by serial number, MAC address and firmware
+        version use an index.
+
+        Parameters
+        ----------
+        serial_number : Optional[str]
+            Only return the devices with this serial number.
+        mac_address : Optional[str]
+            Only return the devices with this MAC address.
+        current_firmware_version : Optional[str]
+            Only return the devices running this firmware version.
+        purchased_since : Optional[date]
+            Only return the devices purchased on or after this date.
+        purchased_until : Optional[date]
+            Only return the devices purchased on or before this date.
+        name_prefix : Optional[str]
+            Only return the devices whose name starts with this prefix,
+            case sensitive.
+        limit : Optional[int]
+            The maximum number of devices to return.
+        after : Optional[int]
+            Only return the devices with a greater id, i.e. the devices after
+            the last one of the previous page.
+
+        Returns
+        -------
+        A list of Device instances ordered by id.
+        """
+        purchased_since = _as_date(purchased_since)
+        purchased_until = _as_date(purchased_until)
+        key = (serial_number, mac_address, current_firmware_version, purchased_since, purchased_until,
+               name_prefix, limit, after)
+
+        def load():
+            M = DeviceModel
+            query = M.select()
+            if serial_number is not None:
+                query = query.where(M.serial_number == serial_number)
+
+            if mac_address is not None:
+                query = query.where(M.mac_address == mac_address)
+
+            if current_firmware_version is not None:
+                query = query.where(M.current_firmware_version == current_firmware_version)
+
+            # Purchase dates may be stored as dates or date-times.
+            if purchased_since is not None:
+                query = query.where(fn.date(M.date_of_purchase) >= purchased_since.isoformat())
+
+            if purchased_until is not None:
+                query = query.where(fn.date(M.date_of_purchase) <= purchased_until.isoformat())
+
+            if name_prefix:
+                # A range rather than LIKE, which is case insensitive and
+                # can't use the index on names.
+                query = query.where(M.name >= name_prefix)
+                if ord(name_prefix[-1]) < sys.maxunicode:
+                    query = query.where(M.name < name_prefix[:-1] + chr(ord(name_prefix[-1]) + 1))
+
+            if after is not None:
+                query = query.where(M.device_id > after)
+
+            query = query.order_by(M.device_id)
+            if limit is not None:
+                query = query.limit(limit)
+            return [m.to_dataclass() for m in query]
+
+        # Callers may change the returned devices, so the cached ones are
+        # copied.
+        return [attr.evolve(device) for device in self._cached(key, load)]
 
     def get(self, device_id: int) -> Optional[Device]:
         """Get a device by its id.
@@ -432,12 +689,12 @@ class DeviceStorage(SqliteStorage):
         -------
         None if the device does not exist, otherwise a Device instance.
         """
-        query = DeviceModel.select().where(DeviceModel.device_id == device_id)
-        if query.count() == 0:
-            return None
+        def load():
+            model = DeviceModel.get_or_none(DeviceModel.device_id == device_id)
+            return None if model is None else model.to_dataclass()
 
-        model: DeviceModel = query[0]
-        return model.to_dataclass()
+        device = self._cached(device_id, load)
+        return None if device is None else attr.evolve(device)
 
     def create(self, device: Device) -> Device:
         """Create a new device.
@@ -459,6 +716,7 @@ class DeviceStorage(SqliteStorage):
 
         model = DeviceModel.from_dataclass(device)
         model.save()
+        self._invalidate()
         return model.to_dataclass()
 
     def update(self, device: Device) -> Device:
@@ -474,17 +732,17 @@ class DeviceStorage(SqliteStorage):
         -------
         An updated Device instance.
         """
-        query = DeviceModel.select().where(DeviceModel.device_id == device.device_id)
-        if not query.count():
+        model = DeviceModel.get_or_none(DeviceModel.device_id == device.device_id)
+        if model is None:
             raise ValueError(f"Device {device.device_id} does not exist.")
 
-        model = query[0]
         model.name = device.name
         model.current_firmware_version = device.current_firmware_version
         model.date_of_purchase = device.date_of_purchase
         model.serial_number = device.serial_number
         model.mac_address = device.mac_address
         model.save()
+        self._invalidate(device.device_id)
         return model.to_dataclass()
 
     def delete(self, device_id: int) -> bool:
@@ -501,8 +759,67 @@ class DeviceStorage(SqliteStorage):
         """
         query = DeviceModel.delete().where(DeviceModel.device_id == device_id)
         n_rows_deleted = query.execute()
+        self._invalidate(device_id)
         return n_rows_deleted >= 1
 
+    def find(self, names: list[str], device_ids: list[int]) -> list[Device]:
+        """Get the devices that have one of some names or ids in a single
+        query, e.g. to check a batch of devices before writing it. The names
+        and ids are bound as JSON arrays, so there can be more of them than
+        SQLite allows variables in a statement. Results are not cached.
+
+        Returns
+        -------
+        A list of Device instances ordered by id.
+        """
+        M = DeviceModel
+        query = M.select().where(M.name.in_(_json_values(names)) | M.device_id.in_(_json_values(device_ids)))
+        return [m.to_dataclass() for m in query.order_by(M.device_id)]
+
+    def bulk_write(self, devices: list[Device]) -> list[Device]:
+        """Create and update many devices in one transaction. Devices without
+        an id are created with multi-row inserts, the others replace the
+        stored device with the same id. Devices should be validated first,
+        see :meth:`find`.
+
+        Parameters
+        ----------
+        devices : list[Device]
+            The devices to write.
+
+        Returns
+        -------
+        The written devices in the same order, with the ids of the created
+        ones set.
+
+        Raises
+        ------
+        peewee.IntegrityError if a name is already taken, in which case
+        nothing is written.
+        """
+        M = DeviceModel
+        to_create = [device for device in devices if device.device_id is None]
+        to_update = [M(**device.to_dict()) for device in devices if device.device_id is not None]
+        with self.database.atomic():
+            # Updates go first, so names given up by renamed devices can be
+            # taken by the created ones.
+            if to_update:
+                # Each row of an update takes a variable for its id and two
+                # for each field.
+                M.bulk_update(to_update, fields=DEVICE_FIELDS, batch_size=INSERT_BATCH_SIZE // 2)
+
+            rows = [{field: getattr(device, field) for field in DEVICE_FIELDS} for device in to_create]
+            for batch in chunked(rows, INSERT_BATCH_SIZE):
+                M.insert_many(batch).execute()
+
+            # Names are unique, so they identify the created devices.
+            query = M.select(M.name, M.device_id).where(M.name.in_(_json_values([d.name for d in to_create])))
+            ids = dict(query.tuples())
+
+        self._invalidate(*(model.device_id for model in to_update))
+        return [attr.evolve(device, device_id=ids[device.name]) if device.device_id is None else device
+                for device in devices]
+
 # TODO: Turn this into a class decorator.
 DATUM_TO_MODEL = {
     # NOTE: DeviceDatum is intentionally commented out. All data are subclasses
@@ -515,11 +832,150 @@ DATUM_TO_MODEL = {
     WeightDatum: WeightDatumModel,
     BloodSaturationDatum: BloodSaturationDatumModel
 }
+MODEL_TO_DATUM = {model_cls: datum_cls for datum_cls, model_cls in DATUM_TO_MODEL.items()}
+# The DatumConverter of each model, see DeviceDatumModel.converter.
+DATUM_CONVERTERS = {}
+
+
+# The bounds, inclusive, of the measurement fields of each datum type. They
+# are wide limits that no real measurement falls outside of, used to reject
+# device faults and unit mistakes at ingestion, not to flag abnormal values.
+VALUE_RANGES = {
+    TemperatureDatum: {"deg_c": (20, 50)},
+    BloodPressureDatum: {"systolic": (20, 350), "diastolic": (10, 300)},
+    GlucometerDatum: {"mg_dl": (0, 3000)},
+    PulseDatum: {"bpm": (0, 350)},
+    WeightDatum: {"grams": (0, 700000)},
+    BloodSaturationDatum: {"percentage": (0, 100)},
+}
+
+# The types accepted as measurement values. bool is left out on purpose.
+NUMBER_TYPES = (int, float)
+
+
+def invalid_value(datum: DeviceDatum) -> Optional[str]:
+    """Check that the measurement fields of a datum are numbers within
+    :data:`VALUE_RANGES`.
+
+    Returns
+    -------
+    The error message of the first invalid field, or None if they are all
+    valid.
+    """
+    for field, (low, high) in VALUE_RANGES.get(type(datum), {}).items():
+        value = getattr(datum, field)
+        if type(value) not in NUMBER_TYPES:
+            return f"{field} must be a number."
+        if not low <= value <= high:
+            return f"{field} must be between {low} and {high}."
+    return None
+
+
+def datum_value_fields(datum_cls: type) -> list[str]:
+    """The names of the measurement fields of a datum class, i.e. the
+    fields that are not common to all data."""
+    common = {field.name for field in attr.fields(DeviceDatum)}
+    return [field.name for field in attr.fields(datum_cls) if field.name not in common]
+
+
+def naive_utc(timestamp: datetime) -> datetime:
+    """Convert an offset-aware time to naive UTC. Naive times are returned
+    unchanged."""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def with_naive_times(data: list[DeviceDatum]) -> list[DeviceDatum]:
+    """Convert the offset-aware collection times of some data to naive UTC.
+    Times are stored and compared in that form, so a batch can mix naive
+    and aware times, and a retried reading is recognized as a duplicate
+    whatever its offset. Data with naive times are returned as is.
+    """
+    return [datum if datum.collection_time.tzinfo is None
+            else attr.evolve(datum, collection_time=naive_utc(datum.collection_time))
+            for datum in data]
+
+
+def new_readings(Model: BaseModel, group: list[DeviceDatum], *conditions) -> list[DeviceDatum]:
+    """Filter out the data of a group that are already stored in a table,
+    or repeated within the group, by device id and collection time. See
+    :meth:`DataStorage._new_data`.
+
+    Parameters
+    ----------
+    Model : BaseModel
+        The table to look up, with device_id and collection_time fields.
+    group : list[DeviceDatum]
+        The data to check.
+    conditions
+        Extra conditions restricting the rows looked up, e.g. a type code.
+
+    Returns
+    -------
+    The data that are not stored yet.
+    """
+    if not group:
+        return []
+
+    times = [datum.collection_time for datum in group]
+    seen = set()
+    for device_ids in chunked({datum.device_id for datum in group}, KEY_QUERY_BATCH_SIZE):
+        query = Model.select(Model.device_id, Model.collection_time).where(
+            Model.device_id.in_(device_ids), Model.collection_time.between(min(times), max(times)), *conditions)
+        seen.update(query.tuples())
+
+    new = []
+    for datum in group:
+        key = (datum.device_id, datum.collection_time)
+        if key not in seen:
+            seen.add(key)
+            new.append(datum)
+    return new
+
+
+def remove_duplicate_rows(Model: BaseModel, key: list) -> int:
+    """Delete the rows of a table that repeat a key, keeping the one with
+    the smallest datum_id, then recreate the table's indexes.
+
+    Returns
+    -------
+    The number of rows deleted.
+    """
+    first = Model.select(fn.MIN(Model.datum_id)).group_by(*key)
+    n_deleted = Model.delete().where(Model.datum_id.not_in(first)).execute()
+    Model._schema.drop_indexes(safe=True)
+    Model._schema.create_indexes(safe=True)
+    return n_deleted
+
+
+def datum_sort_key(datum: DeviceDatum) -> tuple:
+    """The key that orders data across all datum types: the collection
+    time, then the name of the datum type, then the datum id. The key of
+    the last datum on a page can be passed as `after` to
+    :meth:`DataStorage.query` to read the next page."""
+    return (datum.collection_time, type(datum).__name__, datum.datum_id)
 
 class DataStorage(SqliteStorage):
-    """A SQLite storage class for device data."""
+    """A SQLite storage class for device data. Each datum type is stored
+    in its own table.
 
-    tables = DATA_TABLES
+    Parameters
+    ----------
+    filename : str
+        The filename of the sqlite database to use.
+    archive : Optional[ColdArchive]
+        A :class:`~medops.models.archive.ColdArchive` holding data moved
+        out of the database. Queries read archived data as well.
+    """
+
+    @property
+    def tables(self):
+        return DATA_TABLES + DERIVED_TABLES
+
+    def __init__(self, filename, archive=None):
+        super().__init__(filename)
+        self.archive = archive
 
     def _model_for_instance(self, instance: DeviceDatum) -> DeviceDatumModel:
         """Get the peewee.Model class definition that corresponds
@@ -539,19 +995,153 @@ class DataStorage(SqliteStorage):
         ValueError if there is no dataclass mapping for the DeviceDatum instance
         passd in.
         """
+        model_cls = DATUM_TO_MODEL.get(type(instance))
+        if model_cls is not None:
+            return model_cls
+
+        # Subclasses of the datum classes are stored with their base class.
         for datum_cls, model_cls in DATUM_TO_MODEL.items():
             if isinstance(instance, datum_cls):
                 return model_cls
 
-        raise ValueError(f"No datum class found for instance: {instance.__name__}")
+        raise ValueError(f"No datum class found for instance: {type(instance).__name__}")
+
+    def _run_ingest_hooks(self, data: list[DeviceDatum]):
+        """Call the registered :data:`INGEST_HOOKS` with newly stored data."""
+        for hook in INGEST_HOOKS:
+            hook(self, data)
+
+    def _new_data(self, Model: DeviceDatumModel, group: list[DeviceDatum]) -> list[DeviceDatum]:
+        """Drop the data of one datum type that are already stored, or
+        repeated within the group. Readings are identified by their device
+        and collection time, and the stored keys are read with one query per
+        group rather than one per datum.
+
+        Parameters
+        ----------
+        Model : DeviceDatumModel
+            The model the data are stored with.
+        group : list[DeviceDatum]
+            The data to check.
+
+        Returns
+        -------
+        The data that are not stored yet, in their original order.
+        """
+        new = new_readings(Model, group)
+        if self.archive is None or not new:
+            return new
+        return self._not_archived(Model.datum_class(), new)
+
+    def _not_archived(self, datum_cls: type, group: list[DeviceDatum]) -> list[DeviceDatum]:
+        """Drop the data of one datum type that were moved to the archive,
+        e.g. old readings sent again by a gateway. Only the archive months
+        of the patients and time span of the group are read."""
+        times = [datum.collection_time for datum in group]
+        since = min(times)
+        until = max(times) + timedelta(microseconds=1)
+        archived = set()
+        for assigned_user in {datum.assigned_user for datum in group}:
+            rows = self.archive.iter_columns(datum_cls, ["device_id", "collection_time"], assigned_user, None,
+                                             since, until)
+            archived.update((device_id, datetime.fromisoformat(collected)) for device_id, collected in rows)
+        return [datum for datum in group if (datum.device_id, datum.collection_time) not in archived]
 
     def create(self, data: DeviceDatum):
-        """Log a device datum to the database."""
+        """Log a device datum to the database. If the same reading is
+        already stored, the stored datum is returned instead."""
+        data = with_naive_times([data])[0]
         Model = self._model_for_instance(data)
-        instance = Model.from_dataclass(data)
-        instance.save()
+        with self.database.atomic("IMMEDIATE"):
+            if not self._new_data(Model, [data]):
+                key = (Model.device_id == data.device_id) & (Model.collection_time == data.collection_time)
+                existing = Model.get_or_none(key)
+                if existing is not None:
+                    return existing.to_dataclass()
+                return next(self.archive.iter_data(type(data), data.assigned_user, data.device_id,
+                                                   data.collection_time,
+                                                   data.collection_time + timedelta(microseconds=1)))
+
+            instance = Model.from_dataclass(data)
+            instance.save()
+            self._run_ingest_hooks([data])
         return instance.to_dataclass()
 
+    def bulk_create(self, data: list[DeviceDatum], run_hooks: bool = True, stored: Optional[list] = None) -> int:
+        """Log many device data to the database at once.
+
+        Data are grouped by their model type and each group is written
+        with multi-row inserts. All of the inserts happen inside a single
+        transaction so the batch is committed (and synced to disk) once.
+        Readings that are already stored, e.g. because a gateway retried an
+        upload, are skipped, including the ones moved to the archive, see
+        :meth:`_new_data`. The :data:`INGEST_HOOKS`
+        run in the same transaction with the newly stored data only. Unlike
+        :meth:`create`, the stored rows are not read back. Offset-aware
+        collection times are stored as naive UTC, see :func:`with_naive_times`.
+
+        Parameters
+        ----------
+        data : list[DeviceDatum]
+            The data instances to store. They may be of mixed types.
+        run_hooks : bool
+            Whether to run the :data:`INGEST_HOOKS`. This should only be
+            disabled when copying data whose derived tables are rebuilt
+            afterwards.
+        stored : Optional[list]
+            If given, the newly stored data are appended to it, e.g. to tell
+            which submissions of a group commit were duplicates.
+
+        Returns
+        -------
+        The number of data stored, excluding the skipped duplicates.
+        """
+        rows_by_model = {}
+        for datum in with_naive_times(data):
+            rows_by_model.setdefault(type(datum), []).append(datum)
+
+        # Take the write lock up front so no other writer can store the same
+        # readings between looking them up and inserting them.
+        stored = [] if stored is None else stored
+        n_before = len(stored)
+        with self.database.atomic("IMMEDIATE"):
+            for group in rows_by_model.values():
+                Model = self._model_for_instance(group[0])
+                group = self._new_data(Model, group)
+                fields = Model.insert_fields()
+                rows = [Model.row_from_dataclass(datum) for datum in group]
+                for batch in chunked(rows, INSERT_BATCH_SIZE):
+                    Model.insert_many(batch, fields=fields).execute()
+                stored.extend(group)
+
+            if run_hooks:
+                self._run_ingest_hooks(stored[n_before:])
+
+        return len(stored) - n_before
+
+    def remove_duplicates(self) -> int:
+        """Delete duplicate readings stored before they were detected at
+        ingestion, keeping the first one stored, and add the unique indexes
+        that could not be created while they existed. With an archive, the
+        readings stored again after they were archived are deleted too. The
+        rollups should be rebuilt afterwards.
+
+        Returns
+        -------
+        The number of data deleted.
+        """
+        n_deleted = 0
+        with self.database.atomic():
+            for Model in self._models_for_types():
+                n_deleted += remove_duplicate_rows(Model, [Model.device_id, Model.collection_time])
+                if self.archive is not None:
+                    # Times are read from the archive formatted like SQLite stores them.
+                    archived = self.archive.iter_columns(Model.datum_class(), ["device_id", "collection_time"])
+                    key = Tuple(Model.device_id, Model.collection_time)
+                    for batch in chunked(archived, KEY_QUERY_BATCH_SIZE):
+                        n_deleted += Model.delete().where(key.in_(batch)).execute()
+        return n_deleted
+
     def delete(self, datum_id: int):
         raise NotImplementedError("Data cannot be deleted once logged into the database.")
 
@@ -559,17 +1149,175 @@ class DataStorage(SqliteStorage):
         """Data cannot be updated once logged to the database."""
         raise NotImplementedError("Data cannot be updated once logged into the database.")
 
-    def query(self):
-        """"Query data from the database. Currently this only
-        allows a very inefficient select all query on all datum
-        models. This should be extended quite a bit to support
-        filtering data."""
-        data = []
-        for model in DATUM_TO_MODEL.values():
-            data.extend(list(model.select()))
+    def _models_for_types(self, types: Optional[list] = None) -> list:
+        """Get the model classes to read for the requested datum types.
+
+        Parameters
+        ----------
+        types : Optional[list]
+            A list of DeviceDatum subclasses. If None, all datum models are
+            returned.
+
+        Returns
+        -------
+        A list of DeviceDatumModel subclasses.
+
+        Raises
+        ------
+        ValueError if one of the types is not a known datum class.
+        """
+        if types is None:
+            return list(DATUM_TO_MODEL.values())
+
+        models = []
+        for datum_cls in types:
+            if datum_cls not in DATUM_TO_MODEL:
+                raise ValueError(f"Unknown datum type: {datum_cls}")
+            models.append(DATUM_TO_MODEL[datum_cls])
+        return models
+
+    def _select(self,
+                Model: DeviceDatumModel,
+                assigned_user: Optional[int] = None,
+                device_id: Optional[int] = None,
+                since: Optional[datetime] = None,
+                until: Optional[datetime] = None,
+                after: Optional[tuple] = None):
+        """Build a query on a single datum model with the filters applied,
+        ordered by collection time. See :meth:`query` for the parameters."""
+        query = Model.select()
+        if after is not None:
+            # The type name is constant within a table, so the keyset
+            # condition reduces to a range on (collection_time, datum_id).
+            after_time, after_type, after_id = after
+            type_name = Model.datum_class().__name__
+            if type_name > after_type:
+                query = query.where(Model.collection_time >= after_time)
+            elif type_name == after_type:
+                # A row value comparison, unlike the equivalent OR, lets
+                # SQLite seek to the cursor in the collection time indexes.
+                key = Tuple(Model.collection_time, Model.datum_id)
+                query = query.where(key > Tuple(Model.collection_time.db_value(after_time), after_id))
+            else:
+                query = query.where(Model.collection_time > after_time)
+
+        if assigned_user is not None:
+            query = query.where(Model.assigned_user == assigned_user)
+
+        if device_id is not None:
+            query = query.where(Model.device_id == device_id)
+
+        if since is not None:
+            query = query.where(Model.collection_time >= since)
+
+        if until is not None:
+            query = query.where(Model.collection_time < until)
 
-        data = sorted(data, key=lambda d: d.collection_time)
-        return [m.to_dataclass() for m in data]
+        return query.order_by(Model.collection_time, Model.datum_id)
+
+    def iter_columns(self,
+                     datum_cls: type,
+                     columns: list[str],
+                     assigned_user: Optional[int] = None,
+                     device_id: Optional[int] = None,
+                     since: Optional[datetime] = None,
+                     until: Optional[datetime] = None) -> Iterator[tuple]:
+        """Read the raw values of some columns of one datum type without
+        creating model or datum instances. Values are returned as stored by
+        SQLite, e.g. timestamps are strings. Rows are not ordered.
+
+        Parameters
+        ----------
+        datum_cls : type
+            The DeviceDatum subclass to read.
+        columns : list[str]
+            The names of the fields to read.
+
+        See :meth:`query` for the other parameters.
+
+        Returns
+        -------
+        An iterator of row tuples with one value per column.
+        """
+        Model = self._models_for_types([datum_cls])[0]
+        query = self._select(Model, assigned_user, device_id, since, until)
+        query = query.select(*[getattr(Model, column) for column in columns]).order_by()
+        rows = iter(self.database.execute(query))
+        if self.archive is not None:
+            archived = self.archive.iter_columns(datum_cls, columns, assigned_user, device_id, since, until)
+            rows = chain(archived, rows)
+        return rows
+
+    def iter_query(self,
+                   assigned_user: Optional[int] = None,
+                   device_id: Optional[int] = None,
+                   types: Optional[list] = None,
+                   since: Optional[datetime] = None,
+                   until: Optional[datetime] = None,
+                   limit: Optional[int] = None,
+                   after: Optional[tuple] = None) -> Iterator[DeviceDatum]:
+        """Lazily query data from the database. This takes the same
+        parameters as :meth:`query`.
+
+        One cursor is opened per datum table, each already ordered by the
+        database, and the rows are merged as they are read. Only one row
+        per table is held in memory at a time, and the first datum is
+        available as soon as every table has returned its first row.
+        With an archive, the archived data of each type are merged in too.
+
+        Returns
+        -------
+        An iterator of DeviceDatum instances ordered by :func:`datum_sort_key`.
+        """
+        cursors = []
+        for Model in self._models_for_types(types):
+            query = self._select(Model, assigned_user, device_id, since, until, after)
+            if limit is not None:
+                query = query.limit(limit)
+            cursor = map(Model.converter().from_row, query.tuples().iterator())
+            if self.archive is not None:
+                archived = self.archive.iter_data(Model.datum_class(), assigned_user, device_id, since, until, after)
+                cursor = heapq.merge(archived, cursor, key=datum_sort_key)
+            cursors.append(cursor)
+
+        return islice(heapq.merge(*cursors, key=datum_sort_key), limit)
+
+    def query(self,
+              assigned_user: Optional[int] = None,
+              device_id: Optional[int] = None,
+              types: Optional[list] = None,
+              since: Optional[datetime] = None,
+              until: Optional[datetime] = None,
+              limit: Optional[int] = None,
+              after: Optional[tuple] = None) -> list[DeviceDatum]:
+        """Query data from the database. All filters are optional and are
+        applied in SQL so that only the matching rows are read. Results from
+        the different datum models are combined and ordered by collection time.
+        See :meth:`iter_query` to read the results lazily.
+
+        Parameters
+        ----------
+        assigned_user : Optional[int]
+            Only return data collected from this user.
+        device_id : Optional[int]
+            Only return data collected by this device.
+        types : Optional[list]
+            Only return data of these DeviceDatum subclasses.
+        since : Optional[datetime]
+            Only return data collected at or after this time.
+        until : Optional[datetime]
+            Only return data collected before this time.
+        limit : Optional[int]
+            The maximum number of data to return.
+        after : Optional[tuple]
+            Only return data ordered after this key, as returned by
+            :func:`datum_sort_key`. Used for keyset pagination.
+
+        Returns
+        -------
+        A list of DeviceDatum instances ordered by :func:`datum_sort_key`.
+        """
+        return list(self.iter_query(assigned_user, device_id, types, since, until, limit, after))
 
 
 def store_data(data: list[DeviceDatum], storage: DataStorage):
@@ -582,5 +1330,10 @@ def store_data(data: list[DeviceDatum], storage: DataStorage):
     storage : DataStorage
         The instance of the data storage proxy used to persists
         data.
+
+    Returns
+    -------
+    The number of data stored. Readings that were already stored are
+    skipped and not counted.
     """
-    return list(map(storage.create, data))
+    return storage.bulk_create(data)
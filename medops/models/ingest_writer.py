@@ -0,0 +1,250 @@
+"""
+This module provides a background writer that stores device data in group
+commits. Requests hand their validated data to the writer's bounded queue
+and a single writer thread drains it, storing the data of several requests
+in one transaction. This keeps request threads from contending for the
+SQLite write lock under bursty load.
+"""
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+from . import device_models
+from .sharding import ShardedDataStorage
+
+LOGGER = logging.getLogger("medops")
+
+
+class QueueFullError(Exception):
+    """Raised when data are submitted to a writer whose queue is full."""
+    pass
+
+
+def stored_counts(submissions: list[list], stored: list) -> list[int]:
+    """Count the data of each submission of a group commit that were stored.
+    A reading repeated in the group is stored from its first submission,
+    like the storage keeps the first of repeated readings.
+
+    Parameters
+    ----------
+    submissions : list[list[DeviceDatum]]
+        The data of each submission, in the order they were written.
+    stored : list[DeviceDatum]
+        The data newly stored by the group commit.
+
+    Returns
+    -------
+    The number of data stored from each submission.
+    """
+    def key(datum):
+        return type(datum), datum.device_id, device_models.naive_utc(datum.collection_time)
+
+    remaining = Counter(map(key, stored))
+    counts = []
+    for data in submissions:
+        n_stored = 0
+        for datum in data:
+            if remaining[key(datum)]:
+                remaining[key(datum)] -= 1
+                n_stored += 1
+        counts.append(n_stored)
+    return counts
+
+
+class WriteFailedError(Exception):
+    """Raised when the group commit of submitted data failed."""
+    pass
+
+
+class GroupCommitWriter:
+    """Stores device data from a bounded in-memory queue on a dedicated
+    thread.
+
+    Parameters
+    ----------
+    storage : DataStorage
+        The storage the data are written to.
+    max_queue_size : int
+        The maximum number of data waiting to be written. Submitting more
+        raises a :class:`QueueFullError`, unless the queue is empty, so a
+        single larger submission can still be written.
+    max_batch_size : int
+        The maximum number of data written per transaction. Submissions are
+        never split, so a single larger submission is written on its own.
+    """
+
+    def __init__(self, storage, max_queue_size: int = 50000, max_batch_size: int = 5000):
+        self.storage = storage
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+
+        self._pending = deque()
+        self._queue_depth = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        self.batches_written = 0
+        self.data_written = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.last_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="medops-data-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, data: list) -> Future:
+        """Queue data to be written.
+
+        Parameters
+        ----------
+        data : list[DeviceDatum]
+            The data to store.
+
+        Returns
+        -------
+        A future that resolves to the number of data stored once the group
+        commit containing them is durable. Duplicate readings are skipped by
+        the storage, so they are not counted, and they are counted in
+        :meth:`stats`. If the group commit fails, the future raises its
+        error.
+
+        Raises
+        ------
+        QueueFullError if there is not enough room in the queue and it is not
+        empty.
+        """
+        future = Future()
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError("The writer has been stopped.")
+
+            # A submission larger than the queue would never fit, so it is
+            # taken when nothing else is waiting.
+            if self._queue_depth and self._queue_depth + len(data) > self.max_queue_size:
+                self.rejected += 1
+                raise QueueFullError(f"The ingestion queue is full ({self._queue_depth} data waiting).")
+
+            self._pending.append((data, future))
+            self._queue_depth += len(data)
+            self._condition.notify()
+
+        return future
+
+    def write(self, data: list) -> int:
+        """Queue data to be written and wait until the group commit
+        containing them is durable.
+
+        Parameters
+        ----------
+        data : list[DeviceDatum]
+            The data to store.
+
+        Returns
+        -------
+        The number of data stored, excluding the skipped duplicates.
+
+        Raises
+        ------
+        QueueFullError if there is not enough room in the queue, and
+        WriteFailedError if the group commit failed.
+        """
+        future = self.submit(data)
+        try:
+            return future.result()
+        except Exception as err:
+            raise WriteFailedError(f"The data could not be stored: {err}.") from err
+
+    def _next_group(self) -> list:
+        """Wait for submissions and pop as many as fit in one batch. Returns
+        an empty list once stopped and drained."""
+        with self._condition:
+            while not self._pending and not self._stopping:
+                self._condition.wait()
+
+            group = []
+            n_data = 0
+            while self._pending:
+                data, future = self._pending[0]
+                if group and n_data + len(data) > self.max_batch_size:
+                    break
+                self._pending.popleft()
+                group.append((data, future))
+                n_data += len(data)
+
+            self._queue_depth -= n_data
+            return group
+
+    def _run(self):
+        while True:
+            group = self._next_group()
+            if not group:
+                break
+
+            batch = [datum for data, _ in group for datum in data]
+            stored = []
+            start = time.perf_counter()
+            try:
+                n_stored = self.storage.bulk_create(batch, stored=stored)
+            except Exception as err:
+                LOGGER.exception("Failed to store a group commit of %d data", len(batch))
+                for _, future in group:
+                    future.set_exception(err)
+                continue
+
+            latency = time.perf_counter() - start
+            with self._condition:
+                self.batches_written += 1
+                self.data_written += n_stored
+                self.duplicates += len(batch) - n_stored
+                self.last_batch_size = len(batch)
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self._total_flush_latency += latency
+
+            counts = stored_counts([data for data, _ in group], stored)
+            for (_, future), count in zip(group, counts):
+                future.set_result(count)
+
+        # SQLite connections are per thread, close the writer's ones.
+        if isinstance(self.storage, ShardedDataStorage):
+            self.storage.close()
+        else:
+            self.storage.database.close()
+
+    def stats(self) -> dict:
+        """Get the current queue and flush metrics.
+
+        Returns
+        -------
+        A dictionary with the number of data and submissions waiting in the
+        queue, the number of data and batches written, the number of
+        duplicate readings that were skipped, the size of the last
+        batch, the last, mean and max flush latency in seconds and the number
+        of rejected submissions.
+        """
+        with self._condition:
+            return dict(
+                queue_depth=self._queue_depth,
+                queued_submissions=len(self._pending),
+                max_queue_size=self.max_queue_size,
+                batches_written=self.batches_written,
+                data_written=self.data_written,
+                duplicates=self.duplicates,
+                last_batch_size=self.last_batch_size,
+                last_flush_latency=self.last_flush_latency,
+                mean_flush_latency=self._total_flush_latency / self.batches_written if self.batches_written else 0.0,
+                max_flush_latency=self.max_flush_latency,
+                rejected=self.rejected,
+            )
+
+    def stop(self, timeout: float = None):
+        """Write everything still queued and stop the writer thread."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(timeout)
@@ -0,0 +1,166 @@
+"""
+This module maintains the most recent reading of each datum type for each
+patient in a ``latest_readings`` table. The table is updated in the same
+transaction that stores a batch of data, so the current status of a patient,
+or of a whole ward, is read with an index lookup instead of scanning their
+data.
+
+Readings that arrive late, i.e. that were collected before the stored
+latest reading of their type, do not replace it.
+"""
+from __future__ import annotations
+
+import json
+from datetime import datetime
+
+from peewee import (
+    EXCLUDED,
+    chunked,
+    CharField,
+    DateTimeField,
+    IntegerField,
+    TextField
+)
+
+from .base import BaseModel, register
+from .device_models import (
+    DATUM_TO_MODEL,
+    DERIVED_TABLES,
+    INGEST_HOOKS,
+    INSERT_BATCH_SIZE,
+    DataStorage,
+    DeviceDatum,
+    datum_value_fields
+)
+
+# The number of data read at a time when rebuilding the table.
+REBUILD_BATCH_SIZE = 10000
+
+# The number of patients looked up per query.
+LOOKUP_BATCH_SIZE = 500
+
+DATUM_TYPES = {datum_cls.__name__: datum_cls for datum_cls in DATUM_TO_MODEL}
+
+
+@register(DERIVED_TABLES)
+class LatestReadingModel(BaseModel):
+    """The most recent reading of one datum type for one patient. The
+    measurement fields are stored as a JSON object in `values`."""
+    assigned_user = IntegerField()
+    datum_type = CharField()
+    device_id = IntegerField()
+    received_time = DateTimeField()
+    collection_time = DateTimeField()
+    values = TextField()
+
+    class Meta:
+        table_name = "latest_readings"
+        indexes = (
+            (("assigned_user", "datum_type"), True),
+        )
+
+    def to_dataclass(self) -> DeviceDatum:
+        """Create a datum instance from the stored reading. The datum id
+        is not kept and is None."""
+        return DATUM_TYPES[self.datum_type](
+            device_id=self.device_id,
+            assigned_user=self.assigned_user,
+            received_time=self.received_time,
+            collection_time=self.collection_time,
+            **json.loads(self.values)
+        )
+
+
+def latest_of(data: list[DeviceDatum]) -> dict:
+    """Find the most recent datum of each patient and datum type in a batch.
+
+    Returns
+    -------
+    A dictionary mapping (assigned_user, datum type name) to a datum.
+    """
+    latest = {}
+    for datum in data:
+        key = (datum.assigned_user, type(datum).__name__)
+        current = latest.get(key)
+        if current is None or datum.collection_time > current.collection_time:
+            latest[key] = datum
+    return latest
+
+
+@register(INGEST_HOOKS)
+def update_latest(storage: DataStorage, data: list[DeviceDatum]):
+    """Merge a newly stored batch of data into the latest readings. This is
+    called by the data storages inside the transaction that stores the data.
+    A stored reading is only replaced by a more recent one."""
+    rows = []
+    fields_by_type = {}
+    for (assigned_user, type_name), datum in latest_of(data).items():
+        if type_name not in fields_by_type:
+            fields_by_type[type_name] = datum_value_fields(type(datum))
+        values = {field: getattr(datum, field) for field in fields_by_type[type_name]}
+        rows.append((assigned_user, type_name, datum.device_id, datum.received_time,
+                     datum.collection_time, json.dumps(values)))
+
+    M = LatestReadingModel
+    fields = [M.assigned_user, M.datum_type, M.device_id, M.received_time, M.collection_time, M.values]
+    for batch in chunked(rows, INSERT_BATCH_SIZE):
+        M.insert_many(batch, fields=fields).on_conflict(
+            conflict_target=[M.assigned_user, M.datum_type],
+            update={
+                M.device_id: EXCLUDED.device_id,
+                M.received_time: EXCLUDED.received_time,
+                M.collection_time: EXCLUDED.collection_time,
+                M.values: EXCLUDED.values,
+            },
+            where=(EXCLUDED.collection_time > M.collection_time)
+        ).execute()
+
+
+def latest_readings(assigned_users: list[int], types: list = None) -> dict[int, list[DeviceDatum]]:
+    """Get the most recent reading of each datum type for some patients.
+
+    Parameters
+    ----------
+    assigned_users : list[int]
+        The user IDs of the patients.
+    types : Optional[list]
+        Only return readings of these DeviceDatum subclasses.
+
+    Returns
+    -------
+    A dictionary mapping each user ID to a list of datum instances, one per
+    datum type with data, ordered by type name. Patients without data map
+    to an empty list.
+    """
+    M = LatestReadingModel
+    results = {assigned_user: [] for assigned_user in assigned_users}
+    for users in chunked(results, LOOKUP_BATCH_SIZE):
+        query = M.select().where(M.assigned_user.in_(users))
+        if types is not None:
+            query = query.where(M.datum_type.in_([t.__name__ for t in types]))
+
+        for model in query.order_by(M.assigned_user, M.datum_type):
+            results[model.assigned_user].append(model.to_dataclass())
+
+    return results
+
+
+def rebuild_latest(storage, since: datetime = None):
+    """Recompute the latest readings from the raw data, e.g. after data was
+    loaded without going through the ingest hooks.
+
+    Parameters
+    ----------
+    storage : DataStorage
+        The storage holding the raw data.
+    since : Optional[datetime]
+        Only read data collected from this time. Readings stored in the table
+        are kept unless newer ones are found. If None, the table is emptied
+        and rebuilt from all data.
+    """
+    with storage.database.atomic():
+        if since is None:
+            LatestReadingModel.delete().execute()
+
+        for batch in chunked(storage.iter_query(since=since), REBUILD_BATCH_SIZE):
+            update_latest(storage, batch)
@@ -0,0 +1,250 @@
+"""
+This module provides a storage layout that partitions each datum table by
+month. The data of a datum type collected in a month are stored in their own
+table, e.g. ``pulsedatummodel_202203``, created on demand with the same
+columns and indexes as the unpartitioned table.
+
+Queries with a time window only read the partitions that overlap it, and
+old data can be removed by dropping whole partitions instead of deleting
+rows one by one::
+
+    python -m medops.models drop-partitions <sqlite database file> --before 2022-01-01
+
+Dropped tables free their pages for reuse within the database file. Run
+``VACUUM`` to return the space to the operating system.
+"""
+from __future__ import annotations
+
+import heapq
+import re
+from datetime import datetime
+from itertools import chain, islice
+from typing import Iterator, Optional
+
+from peewee import chunked
+
+from .device_models import (
+    DATUM_TO_MODEL,
+    DERIVED_TABLES,
+    INSERT_BATCH_SIZE,
+    DataStorage,
+    DeviceDatum,
+    DeviceDatumModel,
+    datum_sort_key,
+    remove_duplicate_rows,
+    with_naive_times
+)
+
+
+def month_key(timestamp: datetime) -> str:
+    """The partition key, formatted as YYYYMM, of the month a timestamp
+    falls in."""
+    return f"{timestamp.year:04d}{timestamp.month:02d}"
+
+
+def month_start(key: str) -> datetime:
+    """The start of the month of a partition key."""
+    return datetime(int(key[:4]), int(key[4:]), 1)
+
+
+def partition_table_name(Model: DeviceDatumModel, key: str) -> str:
+    """The table name of one month of a datum model."""
+    return f"{Model._meta.table_name}_{key}"
+
+
+class PartitionedDataStorage(DataStorage):
+    """A SQLite storage class for device data that stores each datum type
+    in one table per month of collection time. It provides the same API as
+    :class:`~medops.models.device_models.DataStorage`.
+
+    The derived tables, e.g. rollups, are not partitioned.
+    """
+
+    @property
+    def tables(self):
+        return DERIVED_TABLES
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._partition_models = {}
+
+    def _partition_model(self, Model: DeviceDatumModel, key: str) -> DeviceDatumModel:
+        """Get the model class of one month of a datum model. The model
+        derives from the datum model so it has the same fields, indexes and
+        conversions, and is bound to this storage's database."""
+        partition = self._partition_models.get((Model, key))
+        if partition is None:
+            meta = type("Meta", (), dict(table_name=partition_table_name(Model, key), database=self.database))
+            partition = type(f"{Model.__name__}_{key}", (Model,), dict(Meta=meta))
+            self._partition_models[(Model, key)] = partition
+        return partition
+
+    def _create_partition(self, Model: DeviceDatumModel, key: str) -> DeviceDatumModel:
+        """Get the model class of one month of a datum model, creating its
+        table if needed."""
+        created = (Model, key) in self._partition_models
+        partition = self._partition_model(Model, key)
+        if not created:
+            partition.create_table(safe=True)
+        return partition
+
+    def partitions(self, Model: DeviceDatumModel) -> list[str]:
+        """List the partition keys of a datum model in chronological order.
+        The database is read each time so partitions created or dropped by
+        other processes are seen."""
+        pattern = re.compile(re.escape(Model._meta.table_name) + r"_(\d{6})")
+        keys = []
+        for table in self.database.get_tables():
+            match = pattern.fullmatch(table)
+            if match:
+                keys.append(match.group(1))
+        return sorted(keys)
+
+    def _overlapping_partitions(self,
+                                Model: DeviceDatumModel,
+                                since: Optional[datetime] = None,
+                                until: Optional[datetime] = None,
+                                after: Optional[tuple] = None) -> list[DeviceDatumModel]:
+        """Get the partition models of a datum model that may hold data
+        within a time window, in chronological order."""
+        if after is not None and (since is None or after[0] > since):
+            # Nothing before the cursor is read.
+            since = after[0]
+
+        first = month_key(since) if since is not None else None
+        selected = []
+        for key in self.partitions(Model):
+            if first is not None and key < first:
+                continue
+            if until is not None and month_start(key) >= until:
+                break
+            selected.append(self._partition_model(Model, key))
+        return selected
+
+    def create(self, data: DeviceDatum) -> DeviceDatum:
+        """Log a device datum to the partition of its collection month. If
+        the same reading is already stored, the stored datum is returned."""
+        data = with_naive_times([data])[0]
+        Model = self._create_partition(self._model_for_instance(data), month_key(data.collection_time))
+        with self.database.atomic("IMMEDIATE"):
+            if not self._new_data(Model, [data]):
+                key = (Model.device_id == data.device_id) & (Model.collection_time == data.collection_time)
+                return Model.get(key).to_dataclass()
+
+            instance = Model.from_dataclass(data)
+            instance.save()
+            self._run_ingest_hooks([data])
+        return instance.to_dataclass()
+
+    def bulk_create(self, data: list[DeviceDatum], run_hooks: bool = True, stored: Optional[list] = None) -> int:
+        """Log many device data to the database at once with multi-row
+        inserts into the partitions of their collection months, in a single
+        transaction. Duplicate readings are skipped. See
+        :meth:`DataStorage.bulk_create`."""
+        groups = {}
+        for datum in with_naive_times(data):
+            groups.setdefault((type(datum), month_key(datum.collection_time)), []).append(datum)
+
+        stored = [] if stored is None else stored
+        n_before = len(stored)
+        with self.database.atomic("IMMEDIATE"):
+            for (_, key), group in groups.items():
+                Model = self._create_partition(self._model_for_instance(group[0]), key)
+                group = self._new_data(Model, group)
+                fields = Model.insert_fields()
+                rows = [Model.row_from_dataclass(datum) for datum in group]
+                for batch in chunked(rows, INSERT_BATCH_SIZE):
+                    Model.insert_many(batch, fields=fields).execute()
+                stored.extend(group)
+
+            if run_hooks:
+                self._run_ingest_hooks(stored[n_before:])
+
+        return len(stored) - n_before
+
+    def remove_duplicates(self) -> int:
+        """Delete duplicate readings from every partition. See
+        :meth:`DataStorage.remove_duplicates`."""
+        n_deleted = 0
+        with self.database.atomic():
+            for Model in DATUM_TO_MODEL.values():
+                for key in self.partitions(Model):
+                    partition = self._partition_model(Model, key)
+                    n_deleted += remove_duplicate_rows(partition, [partition.device_id, partition.collection_time])
+        return n_deleted
+
+    def drop_partitions(self, before: datetime) -> list[str]:
+        """Delete all data collected before the month containing a time by
+        dropping whole partitions. The rollups of the dropped data are kept.
+
+        Parameters
+        ----------
+        before : datetime
+            Partitions of months that end at or before the start of this
+            time's month are dropped.
+
+        Returns
+        -------
+        The names of the dropped tables.
+        """
+        cutoff = month_key(before)
+        dropped = []
+        with self.database.atomic():
+            for Model in DATUM_TO_MODEL.values():
+                for key in self.partitions(Model):
+                    if key >= cutoff:
+                        break
+                    self._partition_model(Model, key).drop_table(safe=True)
+                    self._partition_models.pop((Model, key))
+                    dropped.append(partition_table_name(Model, key))
+        return dropped
+
+    def iter_columns(self,
+                     datum_cls: type,
+                     columns: list[str],
+                     assigned_user: Optional[int] = None,
+                     device_id: Optional[int] = None,
+                     since: Optional[datetime] = None,
+                     until: Optional[datetime] = None) -> Iterator[tuple]:
+        """Read the raw values of some columns of one datum type from the
+        overlapping partitions. See :meth:`DataStorage.iter_columns`."""
+        Model = self._models_for_types([datum_cls])[0]
+        cursors = []
+        for partition in self._overlapping_partitions(Model, since, until):
+            query = self._select(partition, assigned_user, device_id, since, until)
+            query = query.select(*[getattr(partition, column) for column in columns]).order_by()
+            cursors.append(self.database.execute(query))
+        return chain.from_iterable(cursors)
+
+    def iter_query(self,
+                   assigned_user: Optional[int] = None,
+                   device_id: Optional[int] = None,
+                   types: Optional[list] = None,
+                   since: Optional[datetime] = None,
+                   until: Optional[datetime] = None,
+                   limit: Optional[int] = None,
+                   after: Optional[tuple] = None) -> Iterator[DeviceDatum]:
+        """Lazily query data from the partitions that overlap the time
+        window. See :meth:`DataStorage.query` for the parameters.
+
+        The partitions of a datum type hold disjoint months, so they are
+        read one after the other, and the datum types are merged as in
+        :meth:`DataStorage.iter_query`. A partition is only queried once the
+        previous one has been read.
+
+        Returns
+        -------
+        An iterator of DeviceDatum instances ordered by :func:`datum_sort_key`.
+        """
+        def read(Model):
+            # The partitions have the fields of their datum model, so its
+            # converter reads their rows.
+            converter = Model.converter()
+            for partition in self._overlapping_partitions(Model, since, until, after):
+                query = self._select(partition, assigned_user, device_id, since, until, after)
+                if limit is not None:
+                    query = query.limit(limit)
+                yield from map(converter.from_row, query.tuples().iterator())
+
+        cursors = [read(Model) for Model in self._models_for_types(types)]
+        return islice(heapq.merge(*cursors, key=datum_sort_key), limit)
@@ -0,0 +1,324 @@
+"""
+This module maintains hourly and daily rollups (count, sum, min and max)
+of the values recorded for each patient and datum type. Rollups are
+updated incrementally in the same transaction that stores a batch of data,
+so dashboards can read summaries without scanning the raw data.
+
+The rollups can be rebuilt from the raw data, for example after a backfill,
+by running::
+
+    python -m medops.models rebuild-rollups <sqlite database file>
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Optional
+
+import attr
+from attr import asdict
+from peewee import (
+    EXCLUDED,
+    chunked,
+    fn,
+    CharField,
+    DateTimeField,
+    FloatField,
+    IntegerField,
+    Value
+)
+
+from .base import BaseModel, register
+from .device_models import (
+    DATUM_TO_MODEL,
+    DERIVED_TABLES,
+    INGEST_HOOKS,
+    INSERT_BATCH_SIZE,
+    DataStorage,
+    DeviceDatum,
+    datum_value_fields
+)
+
+# The strftime format for the start of a bucket of each granularity.
+BUCKET_FORMATS = {
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d 00:00:00",
+}
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    """Get the start of the bucket that a timestamp falls in.
+
+    Parameters
+    ----------
+    timestamp : datetime
+        The timestamp to bucket.
+    granularity : str
+        One of the keys of :data:`BUCKET_FORMATS`.
+
+    Returns
+    -------
+    The datetime at the start of the bucket.
+    """
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    elif granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class VitalRollup:
+    """Summary statistics of one measurement field of one datum type, for
+    one patient over one bucket of time.
+
+    Parameters
+    ----------
+    assigned_user : int
+        The user ID of the patient.
+    datum_type : str
+        The name of the DeviceDatum subclass, e.g. PulseDatum.
+    field : str
+        The name of the measurement field, e.g. bpm.
+    granularity : str
+        Either hour or day.
+    bucket : datetime
+        The start of the bucket.
+    count : int
+        The number of values in the bucket.
+    total : float
+        The sum of the values in the bucket.
+    minimum : float
+        The smallest value in the bucket.
+    maximum : float
+        The largest value in the bucket.
+    """
+    assigned_user: int
+    datum_type: str
+    field: str
+    granularity: str
+    bucket: datetime
+    count: int
+    total: float
+    minimum: float
+    maximum: float
+
+    @property
+    def mean(self) -> float:
+        """The mean value in the bucket."""
+        return self.total / self.count
+
+    def to_json(self) -> dict:
+        """Converts the rollup into a json serializeable dictionary
+        including the mean."""
+        data = asdict(self)
+        data['bucket'] = self.bucket.isoformat()
+        data['mean'] = self.mean
+        return data
+
+
+@register(DERIVED_TABLES)
+class VitalRollupModel(BaseModel):
+    """The relational model for persisting rollups. See :class:`VitalRollup`
+    for a description of the fields."""
+    assigned_user = IntegerField()
+    datum_type = CharField()
+    field = CharField()
+    granularity = CharField()
+    bucket = DateTimeField()
+    count = IntegerField()
+    total = FloatField()
+    minimum = FloatField()
+    maximum = FloatField()
+
+    class Meta:
+        table_name = "vital_rollups"
+        indexes = (
+            (("assigned_user", "datum_type", "field", "granularity", "bucket"), True),
+        )
+
+    def to_dataclass(self) -> VitalRollup:
+        """Create a VitalRollup data class from a model instance."""
+        return VitalRollup(
+            assigned_user=self.assigned_user,
+            datum_type=self.datum_type,
+            field=self.field,
+            granularity=self.granularity,
+            bucket=self.bucket,
+            count=self.count,
+            total=self.total,
+            minimum=self.minimum,
+            maximum=self.maximum
+        )
+
+
+ROLLUP_KEY = ["assigned_user", "datum_type", "field", "granularity", "bucket"]
+
+# The number of data aggregated at a time when rebuilding rollups in Python.
+REBUILD_BATCH_SIZE = 10000
+
+
+def aggregate(data: list[DeviceDatum]) -> dict:
+    """Summarize a batch of data into rollup buckets.
+
+    Parameters
+    ----------
+    data : list[DeviceDatum]
+        The data to summarize.
+
+    Returns
+    -------
+    A dictionary mapping rollup keys, ordered as :data:`ROLLUP_KEY`, to a
+    list of [count, total, minimum, maximum].
+    """
+    fields_by_type = {}
+    buckets = {}
+    for datum in data:
+        datum_cls = type(datum)
+        if datum_cls not in fields_by_type:
+            fields_by_type[datum_cls] = datum_value_fields(datum_cls)
+
+        for granularity in BUCKET_FORMATS:
+            bucket = bucket_start(datum.collection_time, granularity)
+            for field in fields_by_type[datum_cls]:
+                value = getattr(datum, field)
+                key = (datum.assigned_user, datum_cls.__name__, field, granularity, bucket)
+                stats = buckets.get(key)
+                if stats is None:
+                    buckets[key] = [1, value, value, value]
+                else:
+                    stats[0] += 1
+                    stats[1] += value
+                    stats[2] = min(stats[2], value)
+                    stats[3] = max(stats[3], value)
+
+    return buckets
+
+
+@register(INGEST_HOOKS)
+def update_rollups(storage: DataStorage, data: list[DeviceDatum]):
+    """Merge a newly stored batch of data into the rollup tables. This is
+    called by :class:`DataStorage` inside the transaction that stores the data.
+    """
+    rows = [key + tuple(stats) for key, stats in aggregate(data).items()]
+    M = VitalRollupModel
+    fields = [getattr(M, name) for name in ROLLUP_KEY] + [M.count, M.total, M.minimum, M.maximum]
+    for batch in chunked(rows, INSERT_BATCH_SIZE):
+        M.insert_many(batch, fields=fields).on_conflict(
+            conflict_target=[getattr(M, name) for name in ROLLUP_KEY],
+            update={
+                M.count: M.count + EXCLUDED.count,
+                M.total: M.total + EXCLUDED.total,
+                # With two arguments, SQLite's min and max are scalar functions.
+                M.minimum: fn.MIN(M.minimum, EXCLUDED.minimum),
+                M.maximum: fn.MAX(M.maximum, EXCLUDED.maximum),
+            }
+        ).execute()
+
+
+def query_rollups(assigned_user: int,
+                  types: Optional[list] = None,
+                  granularity: str = "hour",
+                  since: Optional[datetime] = None,
+                  until: Optional[datetime] = None) -> list[VitalRollup]:
+    """Query the rollups of a patient.
+
+    Parameters
+    ----------
+    assigned_user : int
+        The user ID of the patient.
+    types : Optional[list]
+        Only return rollups of these DeviceDatum subclasses.
+    granularity : str
+        Either hour or day.
+    since : Optional[datetime]
+        Only return buckets that start at or after this time.
+    until : Optional[datetime]
+        Only return buckets that start before this time.
+
+    Returns
+    -------
+    A list of VitalRollup instances ordered by type, field and bucket.
+    """
+    if granularity not in BUCKET_FORMATS:
+        raise ValueError(f"Unknown granularity: {granularity}")
+
+    M = VitalRollupModel
+    query = M.select().where((M.assigned_user == assigned_user) & (M.granularity == granularity))
+    if types is not None:
+        query = query.where(M.datum_type.in_([t.__name__ for t in types]))
+
+    if since is not None:
+        query = query.where(M.bucket >= since)
+
+    if until is not None:
+        query = query.where(M.bucket < until)
+
+    query = query.order_by(M.datum_type, M.field, M.bucket)
+    return [m.to_dataclass() for m in query]
+
+
+def rebuild_rollups(storage, since: Optional[datetime] = None):
+    """Recompute the rollups from the raw data, e.g. after data was loaded
+    without going through the ingest hooks. With :class:`DataStorage` the
+    aggregation is done by the database, and archived data are merged in
+    afterwards. Other storage layouts, including subclasses of
+    :class:`DataStorage` that store data elsewhere, are read back through
+    their `iter_query` method and aggregated in batches.
+
+    Parameters
+    ----------
+    storage : DataStorage
+        The storage holding the raw data.
+    since : Optional[datetime]
+        Only rebuild buckets from the start of the day containing this time.
+        If None, all rollups are rebuilt.
+    """
+    M = VitalRollupModel
+    if since is not None:
+        since = bucket_start(since, "day")
+
+    with storage.database.atomic():
+        delete = M.delete()
+        if since is not None:
+            delete = delete.where(M.bucket >= since)
+        delete.execute()
+
+        if type(storage) is DataStorage:
+            _rebuild_in_sql(since)
+            if storage.archive is not None:
+                # The SQL only reads the rows still in the database.
+                for datum_cls in DATUM_TO_MODEL:
+                    for batch in chunked(storage.archive.iter_data(datum_cls, since=since), REBUILD_BATCH_SIZE):
+                        update_rollups(storage, batch)
+        else:
+            for batch in chunked(storage.iter_query(since=since), REBUILD_BATCH_SIZE):
+                update_rollups(storage, batch)
+
+
+def _rebuild_in_sql(since: Optional[datetime]):
+    """Insert the rollups of every datum table with INSERT ... SELECT
+    ... GROUP BY queries."""
+    M = VitalRollupModel
+    fields = [getattr(M, name) for name in ROLLUP_KEY] + [M.count, M.total, M.minimum, M.maximum]
+    for datum_cls, Model in DATUM_TO_MODEL.items():
+        for field in datum_value_fields(datum_cls):
+            column = getattr(Model, field)
+            for granularity, bucket_format in BUCKET_FORMATS.items():
+                bucket = fn.strftime(bucket_format, Model.collection_time)
+                query = Model.select(
+                    Model.assigned_user,
+                    Value(datum_cls.__name__),
+                    Value(field),
+                    Value(granularity),
+                    bucket,
+                    fn.COUNT(column),
+                    fn.SUM(column),
+                    fn.MIN(column),
+                    fn.MAX(column),
+                ).group_by(Model.assigned_user, bucket)
+
+                if since is not None:
+                    query = query.where(Model.collection_time >= since)
+
+                M.insert_from(query, fields).execute()
@@ -0,0 +1,177 @@
+"""
+This module serializes the data classes returned by the APIs, e.g.
+:class:`~medops.models.device_models.Device`, the datum classes,
+:class:`~medops.models.user_models.User` and
+:class:`~medops.models.chat_model.MessageV1`.
+
+``to_dict`` copies an instance recursively with ``asdict`` and the copy is
+then walked again to convert datetimes and by the JSON encoder. Instead, an
+encoder function is compiled once per class from its fields. It reads each
+attribute directly, writes dates and datetimes as ISO-8601 strings and
+calls the encoders of nested classes. The result only holds JSON types.
+
+:func:`dumps` encodes with `orjson <https://github.com/ijl/orjson>`_ when it
+is installed and falls back to the standard library otherwise.
+"""
+from __future__ import annotations
+
+import dataclasses
+import json
+import typing
+from datetime import date, datetime, time
+from typing import Callable, Optional
+
+import attr
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The backend used by dumps when none is requested, "orjson" or "json".
+JSON_BACKEND = "json" if orjson is None else "orjson"
+
+# The compiled encoders by class, or by (class, excluded fields, nested
+# encoders) for customized ones.
+ENCODERS = {}
+
+_TEMPORAL_TYPES = (date, datetime, time)
+_NONE_TYPE = type(None)
+
+
+def isoformat(value):
+    """Format dates, datetimes and times as ISO-8601 strings. Other values,
+    e.g. None or an already formatted string, are returned unchanged."""
+    if isinstance(value, _TEMPORAL_TYPES):
+        return value.isoformat()
+    return value
+
+
+def _field_names(cls: type) -> list[str]:
+    if attr.has(cls):
+        return [field.name for field in attr.fields(cls)]
+    if dataclasses.is_dataclass(cls):
+        return [field.name for field in dataclasses.fields(cls)]
+    raise TypeError(f"{cls.__name__} is not an attrs class or a dataclass.")
+
+
+def _is_record(hint) -> bool:
+    return isinstance(hint, type) and (attr.has(hint) or dataclasses.is_dataclass(hint))
+
+
+def _describe(hint) -> tuple[Optional[type], bool]:
+    """Get the type that decides how a field is encoded, a record class or
+    a date/time type, and whether the field is a list of them. Optional
+    hints are unwrapped. The type is None for other fields."""
+    if typing.get_origin(hint) is typing.Union:
+        args = [arg for arg in typing.get_args(hint) if arg is not _NONE_TYPE]
+        hint = args[0] if len(args) == 1 else None
+
+    is_list = typing.get_origin(hint) is list
+    if is_list:
+        args = typing.get_args(hint)
+        hint = args[0] if args else None
+
+    if _is_record(hint) or hint in _TEMPORAL_TYPES:
+        return hint, is_list
+    return None, is_list
+
+
+def _compile(cls: type, exclude: tuple, nested: dict) -> Callable[[object], dict]:
+    hints = typing.get_type_hints(cls)
+    namespace = {"isoformat": isoformat}
+    items = []
+    for i, name in enumerate(_field_names(cls)):
+        if name in exclude:
+            continue
+
+        value = f"obj.{name}"
+        item_cls, is_list = _describe(hints.get(name))
+        encoder = nested.get(name)
+        if encoder is None and _is_record(item_cls):
+            encoder = encoder_for(item_cls)
+
+        if encoder is not None:
+            namespace[f"encode_{i}"] = encoder
+            if is_list:
+                expr = f"[encode_{i}(v) for v in {value}]"
+            else:
+                expr = f"(None if {value} is None else encode_{i}({value}))"
+        elif item_cls in _TEMPORAL_TYPES and not is_list:
+            expr = f"isoformat({value})"
+        else:
+            expr = value
+        items.append(f"{name!r}: {expr}")
+
+    source = "def encode(obj):\n    return {" + ", ".join(items) + "}\n"
+    exec(compile(source, f"<encoder for {cls.__name__}>", "exec"), namespace)
+    return namespace["encode"]
+
+
+def encoder_for(cls: type, exclude: tuple = (), nested: Optional[dict] = None) -> Callable[[object], dict]:
+    """Get the compiled encoder of a class. Encoders are compiled on first
+    use and cached.
+
+    Parameters
+    ----------
+    cls : type
+        An attrs class or dataclass.
+    exclude : tuple
+        The names of fields left out of the output, e.g. a password hash.
+    nested : Optional[dict]
+        Encoders to use for some fields instead of the encoder of their
+        annotated type. A field annotated as a list is encoded item by item.
+
+    Returns
+    -------
+    A function that converts an instance into a dict of JSON types.
+    """
+    nested = nested or {}
+    key = cls
+    if exclude or nested:
+        key = (cls, tuple(exclude), tuple(sorted(nested.items(), key=lambda item: item[0])))
+
+    encoder = ENCODERS.get(key)
+    if encoder is None:
+        encoder = _compile(cls, tuple(exclude), nested)
+        ENCODERS[key] = encoder
+    return encoder
+
+
+def encode(obj) -> dict:
+    """Encode an instance with the default encoder of its class."""
+    encoder = ENCODERS.get(type(obj))
+    if encoder is None:
+        encoder = encoder_for(type(obj))
+    return encoder(obj)
+
+
+def _json_default(value):
+    if isinstance(value, _TEMPORAL_TYPES):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(payload, backend: Optional[str] = None) -> bytes:
+    """Serialize encoded data as compact JSON.
+
+    Parameters
+    ----------
+    payload
+        The data to serialize. Any dates and datetimes left in it are
+        written as ISO-8601 strings and NumPy arrays as lists. The orjson
+        backend writes arrays without converting them to Python objects.
+    backend : Optional[str]
+        "orjson" or "json". Defaults to :data:`JSON_BACKEND`.
+
+    Returns
+    -------
+    The UTF-8 encoded JSON document.
+    """
+    backend = backend or JSON_BACKEND
+    if backend == "orjson":
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, separators=(",", ":"), default=_json_default).encode()
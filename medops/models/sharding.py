@@ -0,0 +1,407 @@
+"""
+This module spreads the device data over several SQLite files, the shards,
+by patient. SQLite allows one writer per file, so with a single file the
+ingestion throughput does not grow with the number of server processes.
+With shards, writes for patients in different shards don't wait for each
+other.
+
+Each reading is stored in the shard of its `assigned_user`, chosen by
+:func:`shard_for`, together with the rollups and latest readings of that
+patient. Queries for one patient read a single shard. Other queries are run
+on every shard in a thread pool and their results are merged.
+
+The datum and derived models are bound once per process, so the shards
+share them through a :class:`ShardRouter`: a database proxy that forwards to
+the shard selected by the current thread. Threads that have not selected a
+shard are forwarded to the database the models were bound to otherwise, so
+a :class:`~medops.models.device_models.DataStorage` created before or after
+a :class:`ShardedDataStorage` keeps using its own file. SQLite connections
+are opened per thread: the connections of the query threads are closed by
+:meth:`ShardedDataStorage.deinit`, and request threads should call
+:meth:`ShardedDataStorage.close` when they are done, as the app does when
+its context is torn down.
+
+The number of shards is set with the ``DATA_DB_SHARDS`` configuration. Data
+are moved to a new number of shards, with the server stopped, by::
+
+    python -m medops.models reshard <sqlite database file> --from 1 --to 4
+"""
+from __future__ import annotations
+
+import heapq
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import chain, islice
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from peewee import DatabaseProxy, chunked
+
+from . import latest, rollups
+from .base import Storage
+from .device_models import (
+    DATA_TABLES,
+    DERIVED_TABLES,
+    DataStorage,
+    DeviceDatum,
+    datum_sort_key
+)
+
+# The number of data copied per transaction when rebalancing.
+REBALANCE_BATCH_SIZE = 5000
+
+# Greater than every datum id. A shard queried after this id within a
+# collection time and type continues with the next collection time.
+MAX_DATUM_ID = 2**63 - 1
+
+
+class ShardRouter(DatabaseProxy):
+    """A database proxy that forwards to the database selected by the
+    current thread with :meth:`use`, or else to its :attr:`default`
+    database. Without either, the models bound to the router can't be
+    used."""
+
+    __slots__ = ("_local", "default")
+
+    def __init__(self):
+        object.__setattr__(self, "_local", threading.local())
+        # The database of the threads that have not selected one, e.g. of a
+        # DataStorage that is not sharded.
+        object.__setattr__(self, "default", None)
+        super().__init__()
+
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+
+    @property
+    def obj(self):
+        database = getattr(self._local, "database", None)
+        return self.default if database is None else database
+
+    @obj.setter
+    def obj(self, database):
+        self._local.database = database
+
+    def __getattr__(self, attr):
+        database = self.obj
+        if database is None:
+            raise AttributeError("No data shard is selected in this thread.")
+        return getattr(database, attr)
+
+    @contextmanager
+    def use(self, database):
+        """Forward to a database in the current thread within the context."""
+        previous = getattr(self._local, "database", None)
+        self.obj = database
+        try:
+            yield database
+        finally:
+            self.obj = previous
+
+    def route(self, models: list):
+        """Bind models to the router. Models bound to a database in the
+        meantime, e.g. by creating a DataStorage, are rebound, and that
+        database becomes the :attr:`default` one."""
+        for Model in models:
+            database = Model._meta.database
+            if database is not self:
+                if database is not None:
+                    self.default = database
+                Model.bind(self)
+
+
+ROUTER = ShardRouter()
+
+
+def shard_for(assigned_user: int, n_shards: int) -> int:
+    """Get the index of the shard holding a patient's data. The hash does
+    not depend on the process or Python version, so every server agrees on
+    it."""
+    return zlib.crc32(struct.pack("<q", assigned_user)) % n_shards
+
+
+def shard_filenames(filename, n_shards: int) -> list[Path]:
+    """Get the filenames of the shards of a database, e.g. ``data.0-of-4.db``
+    to ``data.3-of-4.db`` for ``data.db``. A single shard is the database
+    file itself, so unsharded data can be rebalanced."""
+    path = Path(filename)
+    if n_shards == 1:
+        return [path]
+    return [path.with_name(f"{path.stem}.{i}-of-{n_shards}{path.suffix}") for i in range(n_shards)]
+
+
+class ShardedDataStorage(Storage):
+    """A storage class for device data spread over several SQLite files by
+    patient. It provides the API of
+    :class:`~medops.models.device_models.DataStorage`, with each shard
+    being a DataStorage. Datum ids are only unique within a shard, so data
+    are ordered across shards by :meth:`sort_key`.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the database. The shards are stored next to it, see
+        :func:`shard_filenames`.
+    n_shards : int
+        The number of shards.
+    max_workers : Optional[int]
+        The number of threads running queries on the shards. Defaults to
+        one per shard.
+    """
+
+    def __init__(self, filename, n_shards: int, max_workers: Optional[int] = None):
+        if n_shards < 1:
+            raise ValueError("The number of shards must be at least one.")
+
+        # Creating the shards binds the models to them, while a DataStorage
+        # created before should keep its database.
+        previous = DATA_TABLES[0]._meta.database
+        self.shards = [DataStorage(shard_filename) for shard_filename in shard_filenames(filename, n_shards)]
+        for Model in DATA_TABLES + DERIVED_TABLES:
+            Model.bind(ROUTER)
+        if previous is not None and previous is not ROUTER:
+            ROUTER.default = previous
+
+        self._max_workers = max_workers or n_shards
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="medops-shard")
+
+    def deinit(self):
+        """Closes the connections of every query thread, stops them and
+        closes the shards."""
+        # Each query thread waits for the others, so every one of them runs
+        # exactly one of the tasks.
+        barrier = threading.Barrier(self._max_workers)
+
+        def close(_):
+            try:
+                barrier.wait(5)
+            finally:
+                self.close()
+
+        list(self._executor.map(close, range(self._max_workers)))
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.deinit()
+
+    def close(self):
+        """Close the current thread's connections to the shards, e.g. before
+        a thread that stored data exits."""
+        for shard in self.shards:
+            shard.database.close()
+
+    def shard(self, assigned_user: int) -> DataStorage:
+        """Get the shard holding a patient's data."""
+        return self.shards[shard_for(assigned_user, len(self.shards))]
+
+    def sort_key(self, datum: DeviceDatum) -> tuple:
+        """The key that orders data across shards: :func:`datum_sort_key`
+        with the index of the datum's shard before the datum id. The key of
+        the last datum on a page can be passed as `after` to
+        :meth:`query` to read the next page."""
+        collection_time, type_name, datum_id = datum_sort_key(datum)
+        return (collection_time, type_name, shard_for(datum.assigned_user, len(self.shards)), datum_id)
+
+    def _shard_after(self, shard: DataStorage, after: Optional[tuple]) -> Optional[tuple]:
+        """Convert a key returned by :meth:`sort_key` into the key a shard's
+        query continues after. Keys without a shard index, as returned by
+        :func:`datum_sort_key`, are used as is by every shard."""
+        if after is None or len(after) == 3:
+            return after
+
+        collection_time, type_name, after_shard, datum_id = after
+        index = self.shards.index(shard)
+        if index < after_shard:
+            # Every datum of this shard with the same time and type came
+            # before the key.
+            datum_id = MAX_DATUM_ID
+        elif index > after_shard:
+            datum_id = 0
+        return (collection_time, type_name, datum_id)
+
+    def _call(self, shard: DataStorage, method: Callable, *args, **kwargs):
+        ROUTER.route(DATA_TABLES + DERIVED_TABLES)
+        with ROUTER.use(shard.database):
+            return method(*args, **kwargs)
+
+    def map_shards(self, func: Callable, shards: Optional[list] = None) -> list:
+        """Call a function with each shard in the thread pool, e.g.
+        :func:`~medops.models.rollups.rebuild_rollups`. The models are
+        routed to the shard during the call.
+
+        Parameters
+        ----------
+        func : Callable
+            The function, called with the shard.
+        shards : Optional[list]
+            The shards to call the function with. Defaults to all of them.
+
+        Returns
+        -------
+        The results of the calls in the order of the shards.
+        """
+        shards = self.shards if shards is None else shards
+        if len(shards) == 1:
+            return [self._call(shards[0], func, shards[0])]
+        return list(self._executor.map(lambda shard: self._call(shard, func, shard), shards))
+
+    def create(self, data: DeviceDatum) -> DeviceDatum:
+        """Log a device datum to its patient's shard. See
+        :meth:`DataStorage.create`."""
+        shard = self.shard(data.assigned_user)
+        return self._call(shard, shard.create, data)
+
+    def bulk_create(self, data: list[DeviceDatum], run_hooks: bool = True, stored: Optional[list] = None) -> int:
+        """Log many device data at once. The data are split by shard and
+        each shard stores its part in one transaction, in parallel. See
+        :meth:`DataStorage.bulk_create`.
+
+        Returns
+        -------
+        The number of data stored, excluding the skipped duplicates.
+        """
+        groups = {}
+        for datum in data:
+            groups.setdefault(self.shard(datum.assigned_user), []).append(datum)
+
+        # Each shard appends its own list, as they store in parallel.
+        stored_by_shard = {shard: [] for shard in groups}
+        n_stored = sum(self.map_shards(lambda shard: shard.bulk_create(groups[shard], run_hooks,
+                                                                       stored_by_shard[shard]), list(groups)))
+        if stored is not None:
+            for shard_stored in stored_by_shard.values():
+                stored.extend(shard_stored)
+        return n_stored
+
+    def remove_duplicates(self) -> int:
+        """Delete duplicate readings from every shard. See
+        :meth:`DataStorage.remove_duplicates`."""
+        return sum(self.map_shards(DataStorage.remove_duplicates))
+
+    def delete(self, datum_id: int):
+        raise NotImplementedError("Data cannot be deleted once logged into the database.")
+
+    def update(self, datum_id: int):
+        """Data cannot be updated once logged to the database."""
+        raise NotImplementedError("Data cannot be updated once logged into the database.")
+
+    def iter_columns(self,
+                     datum_cls: type,
+                     columns: list[str],
+                     assigned_user: Optional[int] = None,
+                     device_id: Optional[int] = None,
+                     since: Optional[datetime] = None,
+                     until: Optional[datetime] = None) -> Iterator[tuple]:
+        """Read the raw values of some columns of one datum type, from the
+        patient's shard or from every shard. See
+        :meth:`DataStorage.iter_columns`."""
+        shards = self.shards if assigned_user is None else [self.shard(assigned_user)]
+        return chain.from_iterable([
+            shard.iter_columns(datum_cls, columns, assigned_user, device_id, since, until) for shard in shards
+        ])
+
+    def iter_query(self,
+                   assigned_user: Optional[int] = None,
+                   device_id: Optional[int] = None,
+                   types: Optional[list] = None,
+                   since: Optional[datetime] = None,
+                   until: Optional[datetime] = None,
+                   limit: Optional[int] = None,
+                   after: Optional[tuple] = None) -> Iterator[DeviceDatum]:
+        """Lazily query data. See :meth:`query` for the parameters. The
+        queries of every shard are started before returning, in the calling
+        thread, and their rows are merged as they are read.
+
+        Returns
+        -------
+        An iterator of DeviceDatum instances ordered by :meth:`sort_key`.
+        """
+        args = (device_id, types, since, until, limit)
+        if assigned_user is not None:
+            shard = self.shard(assigned_user)
+            return self._call(shard, shard.iter_query, assigned_user, *args, self._shard_after(shard, after))
+
+        cursors = [self._call(shard, shard.iter_query, None, *args, self._shard_after(shard, after))
+                   for shard in self.shards]
+        return islice(heapq.merge(*cursors, key=self.sort_key), limit)
+
+    def query(self,
+              assigned_user: Optional[int] = None,
+              device_id: Optional[int] = None,
+              types: Optional[list] = None,
+              since: Optional[datetime] = None,
+              until: Optional[datetime] = None,
+              limit: Optional[int] = None,
+              after: Optional[tuple] = None) -> list[DeviceDatum]:
+        """Query data. A query for one patient reads their shard only.
+        Otherwise every shard is queried in parallel, each for up to `limit`
+        data, and the results are merged. See :meth:`DataStorage.query`,
+        except that `after` is a key returned by :meth:`sort_key`.
+
+        Returns
+        -------
+        A list of DeviceDatum instances ordered by :meth:`sort_key`.
+        """
+        def query(shard, assigned_user=None):
+            return shard.query(assigned_user, device_id, types, since, until, limit, self._shard_after(shard, after))
+
+        if assigned_user is not None:
+            shard = self.shard(assigned_user)
+            return self._call(shard, query, shard, assigned_user)
+
+        results = self.map_shards(query)
+        return list(islice(heapq.merge(*results, key=self.sort_key), limit))
+
+    def query_rollups(self, assigned_user: int, **kwargs) -> list[rollups.VitalRollup]:
+        """Query the rollups of a patient from their shard. See
+        :func:`~medops.models.rollups.query_rollups`."""
+        return self._call(self.shard(assigned_user), rollups.query_rollups, assigned_user, **kwargs)
+
+    def latest_readings(self, assigned_users: list[int], types: Optional[list] = None) -> dict[int, list[DeviceDatum]]:
+        """Get the latest readings of some patients from their shards. See
+        :func:`~medops.models.latest.latest_readings`."""
+        groups = {}
+        for assigned_user in assigned_users:
+            groups.setdefault(self.shard(assigned_user), []).append(assigned_user)
+
+        results = {}
+        for found in self.map_shards(lambda shard: latest.latest_readings(groups[shard], types), list(groups)):
+            results.update(found)
+        return {assigned_user: results[assigned_user] for assigned_user in assigned_users}
+
+
+def rebalance(source: ShardedDataStorage,
+              destination: ShardedDataStorage,
+              batch_size: int = REBALANCE_BATCH_SIZE) -> int:
+    """Copy the data of a sharded storage into a storage with another number
+    of shards, e.g. when adding shards. The rollups and latest readings of
+    the destination are rebuilt from the copied data. Readings already in
+    the destination are skipped, so an interrupted copy can be run again.
+    The source is left unchanged, and no data should be written to it while
+    copying.
+
+    Parameters
+    ----------
+    source : ShardedDataStorage
+        The storage to copy from.
+    destination : ShardedDataStorage
+        The storage to copy to.
+    batch_size : int
+        The number of data copied per transaction.
+
+    Returns
+    -------
+    The number of data copied.
+    """
+    n_copied = 0
+    for shard in source.shards:
+        data = source._call(shard, shard.iter_query)
+        for batch in chunked(data, batch_size):
+            n_copied += destination.bulk_create(batch, run_hooks=False)
+
+    destination.map_shards(rollups.rebuild_rollups)
+    destination.map_shards(latest.rebuild_latest)
+    return n_copied
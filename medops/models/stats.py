@@ -0,0 +1,145 @@
+"""
+This module computes summary statistics over recorded device data. The
+values of the requested fields are loaded from the database directly into
+NumPy arrays, without creating a datum instance per row, and the statistics
+are computed on the whole array at once.
+"""
+from datetime import datetime
+from itertools import chain
+from typing import Optional
+
+import numpy as np
+
+from .device_models import (
+    BloodSaturationDatum,
+    DataStorage,
+    GlucometerDatum,
+    datum_value_fields
+)
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+# The target glucose range in mg/dL used for time in range.
+GLUCOSE_TARGET_RANGE = (70, 180)
+
+# SpO2 readings below this percentage are considered low.
+SPO2_LOW_THRESHOLD = 90
+
+
+def load_columns(storage: DataStorage,
+                 datum_cls: type,
+                 columns: list[str],
+                 assigned_user: Optional[int] = None,
+                 device_id: Optional[int] = None,
+                 since: Optional[datetime] = None,
+                 until: Optional[datetime] = None) -> dict[str, np.ndarray]:
+    """Load numeric columns of one datum type into arrays.
+
+    Parameters
+    ----------
+    storage : DataStorage
+        The storage to read from.
+    datum_cls : type
+        The DeviceDatum subclass to read.
+    columns : list[str]
+        The names of the numeric fields to read.
+
+    See :meth:`DataStorage.query` for the filter parameters.
+
+    Returns
+    -------
+    A dictionary mapping each column name to a float64 array.
+    """
+    rows = storage.iter_columns(datum_cls, columns, assigned_user, device_id, since, until)
+    values = np.fromiter(chain.from_iterable(rows), dtype=np.float64)
+    values = values.reshape(-1, len(columns))
+    return {column: values[:, i] for i, column in enumerate(columns)}
+
+
+def summarize(values: np.ndarray, percentiles=DEFAULT_PERCENTILES) -> dict:
+    """Compute summary statistics of an array of values.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        A one dimensional array of values.
+    percentiles : Sequence[float]
+        The percentiles to compute, between 0 and 100.
+
+    Returns
+    -------
+    A dictionary with the count, mean, std (population), min, max and a
+    dictionary of percentiles keyed by their formatted value, e.g. "50". All but
+    the count are None if there are no values.
+    """
+    if not len(values):
+        return dict(count=0, mean=None, std=None, min=None, max=None,
+                    percentiles={f"{p:g}": None for p in percentiles})
+
+    computed = np.percentile(values, percentiles)
+    return dict(
+        count=int(len(values)),
+        mean=float(values.mean()),
+        std=float(values.std()),
+        min=float(values.min()),
+        max=float(values.max()),
+        percentiles={f"{p:g}": float(v) for p, v in zip(percentiles, computed)},
+    )
+
+
+def fraction_in_range(values: np.ndarray, low: float, high: float) -> Optional[float]:
+    """The fraction of values in the closed range [low, high], or None if
+    there are no values."""
+    if not len(values):
+        return None
+    return float(np.count_nonzero((values >= low) & (values <= high)) / len(values))
+
+
+def fraction_below(values: np.ndarray, threshold: float) -> Optional[float]:
+    """The fraction of values strictly below a threshold, or None if there
+    are no values."""
+    if not len(values):
+        return None
+    return float(np.count_nonzero(values < threshold) / len(values))
+
+
+def compute_stats(storage: DataStorage,
+                  datum_cls: type,
+                  assigned_user: Optional[int] = None,
+                  device_id: Optional[int] = None,
+                  since: Optional[datetime] = None,
+                  until: Optional[datetime] = None,
+                  percentiles=DEFAULT_PERCENTILES,
+                  glucose_range: tuple = GLUCOSE_TARGET_RANGE,
+                  spo2_threshold: float = SPO2_LOW_THRESHOLD) -> dict:
+    """Compute statistics of every measurement field of a datum type.
+
+    In addition to :func:`summarize`, glucose readings report the fraction
+    of readings within `glucose_range` as `time_in_range` and blood
+    saturation readings report the fraction below `spo2_threshold` as
+    `fraction_below_threshold`.
+
+    Parameters
+    ----------
+    storage : DataStorage
+        The storage to read from.
+    datum_cls : type
+        The DeviceDatum subclass to summarize.
+
+    See :meth:`DataStorage.query` for the filter parameters.
+
+    Returns
+    -------
+    A dictionary mapping each field name to its statistics.
+    """
+    fields = datum_value_fields(datum_cls)
+    columns = load_columns(storage, datum_cls, fields, assigned_user, device_id, since, until)
+    results = {}
+    for field, values in columns.items():
+        results[field] = summarize(values, percentiles)
+        if datum_cls is GlucometerDatum:
+            results[field]["time_in_range"] = fraction_in_range(values, *glucose_range)
+        elif datum_cls is BloodSaturationDatum:
+            results[field]["fraction_below_threshold"] = fraction_below(values, spo2_threshold)
+
+    return results
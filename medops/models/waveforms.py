@@ -0,0 +1,377 @@
+"""
+This module stores sampled waveforms, e.g. ECG and PPG traces recorded at
+hundreds of samples per second. Storing each sample as a datum row would mean
+millions of rows per patient and hour, so a waveform is stored as segments:
+one row per segment with its start time, sample rate and the samples packed
+in a compressed blob.
+
+The samples of a segment are split into chunks of a fixed number of samples
+that are compressed separately with zlib. Integer samples are delta encoded
+within each chunk first, which compresses slowly varying signals well. The
+offset of each chunk in the blob is stored alongside it, so reading a part of
+a segment only decompresses the chunks that overlap it. Samples are returned
+as NumPy arrays, never as Python objects per sample.
+"""
+from __future__ import annotations
+
+import math
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional
+
+import attr
+import numpy as np
+from peewee import (
+    AutoField,
+    BlobField,
+    CharField,
+    DateTimeField,
+    FloatField,
+    IntegerField
+)
+
+from .base import (
+    BaseModel,
+    SqliteStorage,
+    register
+)
+from .device_models import DeviceDatum, naive_utc, with_naive_times
+
+WAVEFORM_TABLES = []
+
+# The kinds of waveforms accepted.
+WAVEFORM_TYPES = ("ecg", "ppg")
+
+# The sample types a waveform can be stored as.
+SAMPLE_DTYPES = ("<i2", "<i4", "<f4", "<f8")
+
+# The number of samples compressed together. Reading any sample of a chunk
+# decompresses the whole chunk.
+CHUNK_SIZE = 2048
+
+COMPRESSION_LEVEL = 6
+
+
+@attr.s(auto_attribs=True, kw_only=True, slots=True)
+class WaveformDatum(DeviceDatum):
+    """A segment of a sampled waveform.
+
+    See :py:class:`~medops.models.device_models.DeviceDatum` for the other
+    constructor parameter descriptions. The `collection_time` is the time of
+    the first sample.
+
+    Parameters
+    ----------
+    waveform : str
+        The kind of waveform, one of :data:`WAVEFORM_TYPES`.
+    sample_rate : float
+        The number of samples per second.
+    samples : np.ndarray
+        The one dimensional array of samples. Samples are not compared when
+        comparing data.
+    """
+    waveform: str
+    sample_rate: float
+    samples: np.ndarray = attr.ib(eq=False)
+
+    @property
+    def end_time(self) -> datetime:
+        """The time right after the last sample."""
+        return self.collection_time + timedelta(seconds=len(self.samples) / self.sample_rate)
+
+    def to_json(self) -> dict:
+        """Converts the datum into a json serializeable dictionary, with the
+        samples as a list."""
+        data = super().to_json()
+        data['samples'] = self.samples.tolist()
+        return data
+
+
+def compress_samples(samples: np.ndarray, chunk_size: int = CHUNK_SIZE) -> tuple[bytes, bytes]:
+    """Compress samples chunk by chunk.
+
+    Parameters
+    ----------
+    samples : np.ndarray
+        A one dimensional array of one of the :data:`SAMPLE_DTYPES`.
+    chunk_size : int
+        The number of samples per chunk.
+
+    Returns
+    -------
+    A tuple of the chunk offsets, packed as little-endian uint32 with one
+    more offset than chunks, and the concatenated compressed chunks.
+    """
+    offsets = [0]
+    chunks = []
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start:start + chunk_size]
+        if chunk.dtype.kind == "i":
+            # Differences wrap around like the sums that undo them.
+            deltas = chunk.copy()
+            deltas[1:] = chunk[1:] - chunk[:-1]
+            chunk = deltas
+        compressed = zlib.compress(chunk.tobytes(), COMPRESSION_LEVEL)
+        chunks.append(compressed)
+        offsets.append(offsets[-1] + len(compressed))
+    return np.array(offsets, dtype="<u4").tobytes(), b"".join(chunks)
+
+
+def decompress_samples(blob: bytes,
+                       chunk_offsets: bytes,
+                       dtype: str,
+                       chunk_size: int,
+                       start: int,
+                       stop: int) -> np.ndarray:
+    """Read a range of samples compressed with :func:`compress_samples`.
+    Only the chunks overlapping the range are decompressed.
+
+    Parameters
+    ----------
+    blob, chunk_offsets : bytes
+        The compressed chunks and their offsets.
+    dtype : str
+        The sample type.
+    chunk_size : int
+        The number of samples per chunk.
+    start, stop : int
+        The range of sample indexes to read, `stop` excluded. They must be
+        within the stored samples.
+
+    Returns
+    -------
+    An array of the samples.
+    """
+    dtype = np.dtype(dtype)
+    if stop <= start:
+        return np.empty(0, dtype=dtype)
+
+    offsets = np.frombuffer(chunk_offsets, dtype="<u4")
+    blob = memoryview(blob)
+    first = start // chunk_size
+    last = (stop - 1) // chunk_size
+    parts = []
+    for i in range(first, last + 1):
+        chunk = np.frombuffer(zlib.decompress(blob[offsets[i]:offsets[i + 1]]), dtype=dtype)
+        if dtype.kind == "i":
+            chunk = np.cumsum(chunk, dtype=dtype)
+        parts.append(chunk)
+
+    samples = parts[0] if len(parts) == 1 else np.concatenate(parts)
+    base = first * chunk_size
+    return samples[start - base:stop - base]
+
+
+@register(WAVEFORM_TABLES)
+class WaveformDatumModel(BaseModel):
+    """The relational model for persisting waveform segments. See
+    :class:`WaveformDatum` for a description of the fields. The samples are
+    stored compressed, see :func:`compress_samples`."""
+    datum_id = AutoField()
+    device_id = IntegerField(null=False)
+    assigned_user = IntegerField(null=False)
+    waveform = CharField(null=False)
+    received_time = DateTimeField(null=False)
+    collection_time = DateTimeField(null=False)
+    end_time = DateTimeField(null=False)
+    sample_rate = FloatField(null=False)
+    n_samples = IntegerField(null=False)
+    dtype = CharField(null=False)
+    chunk_size = IntegerField(null=False)
+    chunk_offsets = BlobField(null=False)
+    samples = BlobField(null=False)
+
+    class Meta:
+        table_name = "waveforms"
+        indexes = (
+            (("assigned_user", "collection_time"), False),
+            # A device can't record two segments of the same waveform
+            # starting at the same time. This is the key used to drop
+            # duplicate uploads.
+            (("device_id", "waveform", "collection_time"), True),
+        )
+
+    @classmethod
+    def from_dataclass(cls, datum: WaveformDatum, chunk_size: int = CHUNK_SIZE) -> WaveformDatumModel:
+        """Create a model instance from a waveform datum, compressing its
+        samples."""
+        chunk_offsets, blob = compress_samples(datum.samples, chunk_size)
+        return cls(
+            device_id=datum.device_id,
+            assigned_user=datum.assigned_user,
+            waveform=datum.waveform,
+            received_time=datum.received_time,
+            collection_time=datum.collection_time,
+            end_time=datum.end_time,
+            sample_rate=datum.sample_rate,
+            n_samples=len(datum.samples),
+            dtype=datum.samples.dtype.str,
+            chunk_size=chunk_size,
+            chunk_offsets=chunk_offsets,
+            samples=blob
+        )
+
+    def sample_range(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> tuple[int, int]:
+        """Get the range of sample indexes collected within a time window,
+        `since` included and `until` excluded."""
+        def index(timestamp):
+            offset = (timestamp - self.collection_time) / timedelta(seconds=1)
+            return min(max(math.ceil(offset * self.sample_rate - 1e-6), 0), self.n_samples)
+
+        start = 0 if since is None else index(since)
+        stop = self.n_samples if until is None else index(until)
+        return start, max(start, stop)
+
+    def read_samples(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Decompress a range of samples. See :func:`decompress_samples`."""
+        stop = self.n_samples if stop is None else min(stop, self.n_samples)
+        return decompress_samples(self.samples, self.chunk_offsets, self.dtype, self.chunk_size, max(start, 0), stop)
+
+    def to_dataclass(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> WaveformDatum:
+        """Create a waveform datum from the stored segment, optionally with
+        only the samples collected within a time window. The collection time
+        of the datum is then the time of its first sample."""
+        start, stop = self.sample_range(since, until)
+        return WaveformDatum(
+            datum_id=self.datum_id,
+            device_id=self.device_id,
+            assigned_user=self.assigned_user,
+            waveform=self.waveform,
+            received_time=self.received_time,
+            collection_time=self.collection_time + timedelta(seconds=start / self.sample_rate),
+            sample_rate=self.sample_rate,
+            samples=self.read_samples(start, stop)
+        )
+
+
+def naive_window(since: Optional[datetime], until: Optional[datetime]) -> tuple[Optional[datetime], Optional[datetime]]:
+    """Convert the offset-aware bounds of a time window to naive UTC, the
+    form segment start times are stored in."""
+    return tuple(None if bound is None else naive_utc(bound) for bound in (since, until))
+
+
+class WaveformStorage(SqliteStorage):
+    """A SQLite storage class for waveform segments.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the sqlite database to use.
+    chunk_size : int
+        The number of samples compressed together in new segments.
+    """
+
+    tables = WAVEFORM_TABLES
+
+    def __init__(self, filename, chunk_size: int = CHUNK_SIZE):
+        super().__init__(filename)
+        self.chunk_size = chunk_size
+
+    def create(self, datum: WaveformDatum) -> WaveformDatum:
+        """Store a waveform segment. If a segment of the same waveform,
+        device and start time is already stored, e.g. because an upload was
+        retried, the stored segment is returned instead. An offset-aware
+        start time is stored as naive UTC, like the collection times of
+        readings.
+
+        Raises
+        ------
+        ValueError if the segment is invalid.
+        """
+        if datum.waveform not in WAVEFORM_TYPES:
+            raise ValueError(f"Invalid waveform type: {datum.waveform}")
+        if not datum.sample_rate > 0:
+            raise ValueError("sample_rate must be greater than zero.")
+        if datum.samples.ndim != 1:
+            raise ValueError("samples must be a one dimensional array.")
+        if datum.samples.dtype.str not in SAMPLE_DTYPES:
+            raise ValueError(f"Unsupported sample type: {datum.samples.dtype}")
+
+        datum = with_naive_times([datum])[0]
+        M = WaveformDatumModel
+        with self.database.atomic("IMMEDIATE"):
+            same_device = (M.device_id == datum.device_id) & (M.waveform == datum.waveform)
+            existing = M.get_or_none(same_device & (M.collection_time == datum.collection_time))
+            if existing is not None:
+                return existing.to_dataclass()
+
+            model = M.from_dataclass(datum, self.chunk_size)
+            model.save()
+
+        return attr.evolve(datum, datum_id=model.datum_id)
+
+    def get(self,
+            datum_id: int,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> Optional[WaveformDatum]:
+        """Get a waveform segment by its id, optionally with only the
+        samples collected within a time window.
+
+        Returns
+        -------
+        None if the segment does not exist, otherwise a WaveformDatum.
+        """
+        model = WaveformDatumModel.get_or_none(WaveformDatumModel.datum_id == datum_id)
+        if model is None:
+            return None
+        return model.to_dataclass(*naive_window(since, until))
+
+    def query(self,
+              assigned_user: Optional[int] = None,
+              device_id: Optional[int] = None,
+              waveform: Optional[str] = None,
+              since: Optional[datetime] = None,
+              until: Optional[datetime] = None) -> list[WaveformDatum]:
+        """Query the waveform segments that overlap a time window. Segments
+        that extend past the window are cut to it, and only the chunks within
+        the window are decompressed.
+
+        Parameters
+        ----------
+        assigned_user : Optional[int]
+            Only return the segments collected from this user.
+        device_id : Optional[int]
+            Only return the segments recorded by this device.
+        waveform : Optional[str]
+            Only return segments of this kind of waveform.
+        since : Optional[datetime]
+            Only return samples collected at or after this time.
+        until : Optional[datetime]
+            Only return samples collected before this time.
+
+        Returns
+        -------
+        A list of WaveformDatum instances ordered by start time. Segments
+        with no samples in the window are left out.
+        """
+        since, until = naive_window(since, until)
+        M = WaveformDatumModel
+        query = M.select()
+        if assigned_user is not None:
+            query = query.where(M.assigned_user == assigned_user)
+
+        if device_id is not None:
+            query = query.where(M.device_id == device_id)
+
+        if waveform is not None:
+            query = query.where(M.waveform == waveform)
+
+        if since is not None:
+            query = query.where(M.end_time > since)
+
+        if until is not None:
+            query = query.where(M.collection_time < until)
+
+        data = []
+        for model in query.order_by(M.collection_time, M.datum_id):
+            datum = model.to_dataclass(since, until)
+            if len(datum.samples):
+                data.append(datum)
+        return data
+
+    def delete(self, datum_id: int):
+        raise NotImplementedError("Data cannot be deleted once logged into the database.")
+
+    def update(self, datum_id: int):
+        """Data cannot be updated once logged to the database."""
+        raise NotImplementedError("Data cannot be updated once logged into the database.")
@@ -0,0 +1,334 @@
+"""
+This module provides an alternative storage layout for device data where
+every datum, whatever its type, is a row of a single ``readings`` table.
+The datum type is stored as a type code and the measurement fields are
+mapped onto a small number of numeric value columns.
+
+Compared to :class:`~medops.models.device_models.DataStorage`, which keeps
+a table per datum type, timelines that span several types are read with a
+single index scan instead of one scan per table. Both layouts use the same
+DeviceDatum classes and can be migrated between with::
+
+    python -m medops.models migrate-layout <source> <tables|wide> <destination> <tables|wide>
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from itertools import islice
+from typing import Iterator, Optional
+
+import attr
+from peewee import (
+    chunked,
+    AutoField,
+    DateTimeField,
+    FloatField,
+    IntegerField,
+    Tuple
+)
+
+from .base import (
+    BaseModel,
+    SqliteStorage,
+    register
+)
+from .device_models import (
+    DERIVED_TABLES,
+    INGEST_HOOKS,
+    INSERT_BATCH_SIZE,
+    BloodPressureDatum,
+    BloodSaturationDatum,
+    DeviceDatum,
+    GlucometerDatum,
+    PulseDatum,
+    TemperatureDatum,
+    WeightDatum,
+    datum_value_fields,
+    new_readings,
+    remove_duplicate_rows,
+    with_naive_times
+)
+from .latest import rebuild_latest
+from .rollups import rebuild_rollups
+
+READING_TABLES = []
+
+# The type code stored for each datum class. Codes are ordered like the
+# class names so that sorting by code matches datum_sort_key. New types must
+# keep that property and existing codes must never change.
+READING_TYPE_CODES = {
+    BloodPressureDatum: 1,
+    BloodSaturationDatum: 2,
+    GlucometerDatum: 3,
+    PulseDatum: 4,
+    TemperatureDatum: 5,
+    WeightDatum: 6,
+}
+READING_CODE_TYPES = {code: datum_cls for datum_cls, code in READING_TYPE_CODES.items()}
+
+# The value columns, in the order the measurement fields of a datum are
+# assigned to them.
+VALUE_COLUMNS = ["value_0", "value_1"]
+
+
+@register(READING_TABLES)
+class ReadingModel(BaseModel):
+    """A single reading of any datum type. The measurement fields of the
+    datum, see :func:`datum_value_fields`, are stored in order in the value
+    columns and the remaining columns are left null."""
+    datum_id = AutoField()
+    type_code = IntegerField(null=False)
+    device_id = IntegerField(null=False)
+    assigned_user = IntegerField(null=False)
+    received_time = DateTimeField(null=False)
+    collection_time = DateTimeField(null=False)
+    value_0 = FloatField(null=True)
+    value_1 = FloatField(null=True)
+
+    class Meta:
+        table_name = "readings"
+        indexes = (
+            (("assigned_user", "collection_time"), False),
+            (("device_id", "collection_time"), False),
+            (("collection_time",), False),
+            # The key used to drop duplicate readings.
+            (("device_id", "type_code", "collection_time"), True),
+        )
+
+
+class _ReadingType:
+    """Precomputed conversion between a datum class and reading rows."""
+
+    def __init__(self, datum_cls: type):
+        self.datum_cls = datum_cls
+        self.code = READING_TYPE_CODES[datum_cls]
+        self.fields = datum_value_fields(datum_cls)
+        if len(self.fields) > len(VALUE_COLUMNS):
+            raise ValueError(f"{datum_cls.__name__} has more fields than value columns.")
+
+        # Integer fields are stored as floats and converted back when read.
+        types = {field.name: field.type for field in attr.fields(datum_cls)}
+        self.converters = [int if types[field] in ("int", int) else float for field in self.fields]
+        self.padding = (None,) * (len(VALUE_COLUMNS) - len(self.fields))
+
+    def to_row(self, datum: DeviceDatum) -> tuple:
+        values = tuple(getattr(datum, field) for field in self.fields)
+        return (self.code, datum.device_id, datum.assigned_user, datum.received_time,
+                datum.collection_time) + values + self.padding
+
+    def to_datum(self, row: tuple) -> DeviceDatum:
+        datum_id, _, device_id, assigned_user, received_time, collection_time = row[:6]
+        values = {field: convert(value) for field, convert, value in zip(self.fields, self.converters, row[6:])}
+        return self.datum_cls(datum_id=datum_id,
+                              device_id=device_id,
+                              assigned_user=assigned_user,
+                              received_time=received_time,
+                              collection_time=collection_time,
+                              **values)
+
+
+READING_TYPES = {datum_cls: _ReadingType(datum_cls) for datum_cls in READING_TYPE_CODES}
+
+
+class WideDataStorage(SqliteStorage):
+    """A SQLite storage class for device data that keeps every datum in
+    one table. It provides the same API as
+    :class:`~medops.models.device_models.DataStorage`."""
+
+    @property
+    def tables(self):
+        return READING_TABLES + DERIVED_TABLES
+
+    def _reading_type(self, datum_cls: type) -> _ReadingType:
+        if datum_cls not in READING_TYPES:
+            raise ValueError(f"Unknown datum type: {datum_cls}")
+        return READING_TYPES[datum_cls]
+
+    def _new_data(self, reading_type: _ReadingType, group: list[DeviceDatum]) -> list[DeviceDatum]:
+        """Drop the data of one datum type that are already stored. See
+        :meth:`DataStorage._new_data`."""
+        return new_readings(ReadingModel, group, ReadingModel.type_code == reading_type.code)
+
+    def create(self, data: DeviceDatum) -> DeviceDatum:
+        """Log a device datum to the database. If the same reading is
+        already stored, the stored datum is returned instead."""
+        data = with_naive_times([data])[0]
+        reading_type = self._reading_type(type(data))
+        fields = ReadingModel._meta.sorted_fields[1:]
+        with self.database.atomic("IMMEDIATE"):
+            if not self._new_data(reading_type, [data]):
+                M = ReadingModel
+                query = M.select().where(M.device_id == data.device_id,
+                                         M.type_code == reading_type.code,
+                                         M.collection_time == data.collection_time)
+                return reading_type.to_datum(query.tuples().get())
+
+            datum_id = ReadingModel.insert_many([reading_type.to_row(data)], fields=fields).execute()
+            for hook in INGEST_HOOKS:
+                hook(self, [data])
+
+        return attr.evolve(data, datum_id=datum_id)
+
+    def bulk_create(self, data: list[DeviceDatum], run_hooks: bool = True, stored: Optional[list] = None) -> int:
+        """Log many device data to the database at once with multi-row inserts
+        in a single transaction, skipping duplicate readings. See
+        :meth:`DataStorage.bulk_create`."""
+        groups = {}
+        for datum in with_naive_times(data):
+            groups.setdefault(type(datum), []).append(datum)
+
+        fields = ReadingModel._meta.sorted_fields[1:]
+        stored = [] if stored is None else stored
+        n_before = len(stored)
+        with self.database.atomic("IMMEDIATE"):
+            for datum_cls, group in groups.items():
+                reading_type = self._reading_type(datum_cls)
+                group = self._new_data(reading_type, group)
+                rows = [reading_type.to_row(datum) for datum in group]
+                for batch in chunked(rows, INSERT_BATCH_SIZE):
+                    ReadingModel.insert_many(batch, fields=fields).execute()
+                stored.extend(group)
+
+            if run_hooks:
+                for hook in INGEST_HOOKS:
+                    hook(self, stored[n_before:])
+
+        return len(stored) - n_before
+
+    def remove_duplicates(self) -> int:
+        """Delete duplicate readings. See :meth:`DataStorage.remove_duplicates`."""
+        M = ReadingModel
+        with self.database.atomic():
+            return remove_duplicate_rows(M, [M.device_id, M.type_code, M.collection_time])
+
+    def delete(self, datum_id: int):
+        raise NotImplementedError("Data cannot be deleted once logged into the database.")
+
+    def update(self, datum_id: int):
+        """Data cannot be updated once logged to the database."""
+        raise NotImplementedError("Data cannot be updated once logged into the database.")
+
+    def _select(self,
+                assigned_user: Optional[int] = None,
+                device_id: Optional[int] = None,
+                types: Optional[list] = None,
+                since: Optional[datetime] = None,
+                until: Optional[datetime] = None):
+        M = ReadingModel
+        query = M.select()
+        if assigned_user is not None:
+            query = query.where(M.assigned_user == assigned_user)
+
+        if device_id is not None:
+            query = query.where(M.device_id == device_id)
+
+        if types is not None:
+            query = query.where(M.type_code.in_([self._reading_type(t).code for t in types]))
+
+        if since is not None:
+            query = query.where(M.collection_time >= since)
+
+        if until is not None:
+            query = query.where(M.collection_time < until)
+
+        return query
+
+    def iter_columns(self,
+                     datum_cls: type,
+                     columns: list[str],
+                     assigned_user: Optional[int] = None,
+                     device_id: Optional[int] = None,
+                     since: Optional[datetime] = None,
+                     until: Optional[datetime] = None) -> Iterator[tuple]:
+        """Read the raw values of some columns of one datum type. See
+        :meth:`DataStorage.iter_columns`."""
+        reading_type = self._reading_type(datum_cls)
+        selected = []
+        for column in columns:
+            if column in reading_type.fields:
+                column = VALUE_COLUMNS[reading_type.fields.index(column)]
+            selected.append(getattr(ReadingModel, column))
+
+        query = self._select(assigned_user, device_id, [datum_cls], since, until).select(*selected)
+        return iter(self.database.execute(query))
+
+    def iter_query(self,
+                   assigned_user: Optional[int] = None,
+                   device_id: Optional[int] = None,
+                   types: Optional[list] = None,
+                   since: Optional[datetime] = None,
+                   until: Optional[datetime] = None,
+                   limit: Optional[int] = None,
+                   after: Optional[tuple] = None) -> Iterator[DeviceDatum]:
+        """Lazily query data from the database with a single ordered scan.
+        See :meth:`DataStorage.query` for the parameters.
+
+        Returns
+        -------
+        An iterator of DeviceDatum instances ordered by :func:`datum_sort_key`.
+        """
+        M = ReadingModel
+        query = self._select(assigned_user, device_id, types, since, until)
+        if after is not None:
+            after_time, after_type, after_id = after
+            codes = {datum_cls.__name__: code for datum_cls, code in READING_TYPE_CODES.items()}
+            if after_type not in codes:
+                raise ValueError(f"Unknown datum type: {after_type}")
+            key = Tuple(M.collection_time, M.type_code, M.datum_id)
+            query = query.where(
+                key > Tuple(M.collection_time.db_value(after_time), codes[after_type], after_id)
+            )
+
+        query = query.order_by(M.collection_time, M.type_code, M.datum_id)
+        if limit is not None:
+            query = query.limit(limit)
+
+        rows = query.tuples().iterator()
+        return islice((READING_TYPES[READING_CODE_TYPES[row[1]]].to_datum(row) for row in rows), limit)
+
+    def query(self,
+              assigned_user: Optional[int] = None,
+              device_id: Optional[int] = None,
+              types: Optional[list] = None,
+              since: Optional[datetime] = None,
+              until: Optional[datetime] = None,
+              limit: Optional[int] = None,
+              after: Optional[tuple] = None) -> list[DeviceDatum]:
+        """Query data from the database. See :meth:`DataStorage.query`."""
+        return list(self.iter_query(assigned_user, device_id, types, since, until, limit, after))
+
+
+def migrate(source, destination, batch_size: int = 10000) -> int:
+    """Copy all data from one storage layout to another.
+
+    Data are read in order from the source and written to the destination in
+    batches without running the ingest hooks. The rollups and latest readings
+    of the destination are rebuilt once at the end. Datum ids are assigned by the destination
+    and will not match the source.
+
+    Parameters
+    ----------
+    source : Union[DataStorage, WideDataStorage]
+        The storage to read from.
+    destination : Union[DataStorage, WideDataStorage]
+        The storage to write to. It should be empty.
+    batch_size : int
+        The number of data copied per transaction.
+
+    Returns
+    -------
+    The number of data copied.
+    """
+    if type(source) is type(destination):
+        raise ValueError("The source and destination must use different layouts.")
+
+    n_copied = 0
+    for batch in chunked(source.iter_query(), batch_size):
+        n_copied += destination.bulk_create(batch, run_hooks=False)
+
+    # Derived tables are shared by both layouts, so make sure they point at
+    # the destination while rebuilding.
+    with destination.database.bind_ctx(DERIVED_TABLES):
+        rebuild_rollups(destination)
+        rebuild_latest(destination)
+    return n_copied
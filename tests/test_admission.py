@@ -0,0 +1,55 @@
+from medops.models.admission import AdmissionController, TokenBucket, retry_after
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, capacity=20, now=0)
+    assert bucket.wait_time(20, 0) == 0
+    bucket.take(20, 0)
+    assert bucket.wait_time(5, 0) == 0.5
+    assert bucket.wait_time(5, 0.5) == 0
+
+    # Costs over the capacity are admitted when the bucket is full and
+    # leave it in debt.
+    assert bucket.wait_time(50, 2) == 0
+    bucket.take(50, 2)
+    assert bucket.wait_time(1, 2) == 3.1
+
+
+def test_device_rate():
+    admission = AdmissionController(device_rate=1, device_burst=10)
+    assert admission.admit({1: 10, 2: 5}, now=0) == 0
+    # Device 1 is out of tokens, so nothing is taken from device 2.
+    assert admission.admit({1: 5, 2: 5}, now=0) == 5
+    assert admission.admit({2: 5}, now=0) == 0
+    assert admission.admit({1: 5}, now=5) == 0
+
+    stats = admission.stats()
+    assert stats["admitted_requests"] == 3
+    assert stats["admitted_readings"] == 25
+    assert stats["shed_requests"] == dict(in_flight=0, device_rate=1, global_rate=0)
+    assert stats["shed_readings"] == 10
+
+
+def test_global_rate():
+    admission = AdmissionController(rate=100, device_rate=100)
+    assert admission.admit({1: 60}, now=0) == 0
+    assert admission.admit({2: 60}, now=0) == 0.2
+    assert admission.stats()["shed_requests"]["global_rate"] == 1
+    # The device bucket was not charged for the shed request.
+    assert admission.admit({2: 6000}, now=1) == 0
+
+
+def test_in_flight():
+    admission = AdmissionController(max_in_flight=2)
+    assert admission.enter()
+    assert admission.enter()
+    assert not admission.enter()
+    admission.leave()
+    assert admission.enter()
+    assert admission.stats()["in_flight"] == 2
+    assert admission.stats()["shed_requests"]["in_flight"] == 1
+
+
+def test_retry_after():
+    assert retry_after(0.2) == "1"
+    assert retry_after(2.5) == "3"
@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pytest
+from medops.models import latest, rollups, stats
+from medops.models.archive import ArchivePartition, ColdArchive, archive_data
+from medops.models.device_models import (
+    BloodPressureDatum,
+    DataStorage,
+    PulseDatum,
+    PulseDatumModel,
+    datum_sort_key,
+)
+
+FILENAME = "archive_test.db"
+ARCHIVE_DIR = "archive_test"
+
+
+def remove_files():
+    if os.path.exists(FILENAME):
+        os.unlink(FILENAME)
+    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def storage():
+    remove_files()
+    storage = DataStorage(FILENAME, archive=ColdArchive(ARCHIVE_DIR))
+    yield storage
+    storage.deinit()
+    remove_files()
+
+
+def make_data(start=datetime(2022, 1, 25), days=20):
+    data = []
+    for i in range(days * 4):
+        collected = start + timedelta(hours=6 * i, microseconds=i)
+        data.append(PulseDatum(device_id=1 + i % 2, assigned_user=1 + i % 3,
+                               received_time=collected + timedelta(seconds=i),
+                               collection_time=collected, bpm=60 + i % 40))
+        data.append(BloodPressureDatum(device_id=3, assigned_user=1 + i % 3,
+                                       received_time=collected, collection_time=collected,
+                                       systolic=110 + i % 20, diastolic=70 + i % 10))
+    return data
+
+
+def snapshot(data):
+    return [d.to_dict() for d in data]
+
+
+def test_archive_moves_old_rows(storage):
+    storage.bulk_create(make_data())
+    expected = snapshot(storage.query())
+    before = datetime(2022, 2, 5)
+
+    n_archived = archive_data(storage, storage.archive, before)
+    assert n_archived == len([d for d in expected if d["collection_time"] < before])
+
+    # Only recent data are left in SQLite.
+    sql_only = DataStorage(FILENAME)
+    try:
+        assert all(d.collection_time >= before for d in sql_only.query())
+    finally:
+        sql_only.deinit()
+
+    # The archive is read transparently and data read back unchanged.
+    assert snapshot(storage.query()) == expected
+    assert os.path.isdir(os.path.join(ARCHIVE_DIR, "PulseDatum", "1", "202201"))
+
+
+def test_archived_queries_filter_and_paginate(storage):
+    storage.bulk_create(make_data())
+    expected = {key: snapshot(storage.query(**kwargs)) for key, kwargs in [
+        ("user", dict(assigned_user=2)),
+        ("device", dict(device_id=1, types=[PulseDatum])),
+        ("window", dict(since=datetime(2022, 1, 30), until=datetime(2022, 2, 8))),
+        ("limit", dict(limit=5, since=datetime(2022, 2, 1))),
+    ]}
+    all_data = storage.query()
+
+    archive_data(storage, storage.archive, datetime(2022, 2, 5))
+    assert snapshot(storage.query(assigned_user=2)) == expected["user"]
+    assert snapshot(storage.query(device_id=1, types=[PulseDatum])) == expected["device"]
+    assert snapshot(storage.query(since=datetime(2022, 1, 30), until=datetime(2022, 2, 8))) == expected["window"]
+    assert snapshot(storage.query(limit=5, since=datetime(2022, 2, 1))) == expected["limit"]
+
+    pages = []
+    after = None
+    while True:
+        page = storage.query(limit=13, after=after)
+        if not page:
+            break
+        pages.extend(page)
+        after = datum_sort_key(page[-1])
+    assert [datum_sort_key(d) for d in pages] == [datum_sort_key(d) for d in all_data]
+
+
+def test_archive_is_incremental(storage):
+    storage.bulk_create(make_data())
+    expected = snapshot(storage.query())
+
+    archive_data(storage, storage.archive, datetime(2022, 1, 28))
+    archive_data(storage, storage.archive, datetime(2022, 1, 28))
+    archive_data(storage, storage.archive, datetime(2022, 2, 10))
+    assert snapshot(storage.query()) == expected
+
+
+def test_archive_columns_are_compact(storage):
+    start = datetime(2022, 2, 1)
+    storage.bulk_create([PulseDatum(device_id=1, assigned_user=1, received_time=start + timedelta(minutes=i, seconds=1),
+                                    collection_time=start + timedelta(minutes=i), bpm=60 + i % 40)
+                         for i in range(1000)])
+    archive_data(storage, storage.archive, datetime(2022, 3, 1))
+
+    # Minutely timestamps fit in 32 bits once delta encoded.
+    path = os.path.join(ARCHIVE_DIR, "PulseDatum", "1", "202202", "columns.npz")
+    with np.load(path) as columns:
+        assert columns["collection_time"].dtype.itemsize < 8
+        assert columns["received_time"].dtype.itemsize < 8
+        assert columns["device_id"].dtype.itemsize == 1
+        raw_size = sum(columns[name].nbytes for name in columns.files)
+    # The repeated deltas and values compress well.
+    assert os.path.getsize(path) < raw_size / 4
+
+
+def test_queries_skip_partitions_outside_window(storage):
+    storage.bulk_create(make_data())
+    window = dict(since=datetime(2022, 1, 26), until=datetime(2022, 1, 27))
+    expected = snapshot(storage.query(**window))
+    archive_data(storage, storage.archive, datetime(2022, 2, 10))
+
+    with mock.patch.object(ArchivePartition, "read", autospec=True, side_effect=ArchivePartition.read) as read:
+        assert snapshot(storage.query(**window)) == expected
+        # Only the January partitions of the 3 patients, for each type.
+        assert len(read.call_args_list) == 6
+        assert {call.args[0].path.name for call in read.call_args_list} == {"202201"}
+
+        # February is archived up to the 10th.
+        read.reset_mock()
+        assert storage.query(since=datetime(2022, 2, 10), until=datetime(2022, 2, 11)) != []
+        assert read.call_count == 0
+
+    # Archives without an index rebuild it.
+    index = os.path.join(ARCHIVE_DIR, "PulseDatum", "index.json")
+    with open(index) as f:
+        months = json.load(f)
+    assert months == {"202201": [1, 2, 3], "202202": [1, 2, 3]}
+    os.unlink(index)
+    assert snapshot(storage.query(**window)) == expected
+    with open(index) as f:
+        assert json.load(f) == months
+
+
+def test_reads_first_version_partitions(storage):
+    storage.bulk_create(make_data())
+    expected = snapshot(storage.query())
+    archive_data(storage, storage.archive, datetime(2022, 2, 10))
+
+    # Convert the archive to uncompressed .npy files without time ranges.
+    for root, _, files in os.walk(ARCHIVE_DIR):
+        if "columns.npz" in files:
+            with np.load(os.path.join(root, "columns.npz")) as columns:
+                for name in columns.files:
+                    np.save(os.path.join(root, f"{name}.npy"), columns[name])
+            os.unlink(os.path.join(root, "columns.npz"))
+            with open(os.path.join(root, "meta.json")) as f:
+                meta = json.load(f)
+            with open(os.path.join(root, "meta.json"), "w") as f:
+                json.dump(dict(version=1, count=meta["count"], collection_time_base=meta["collection_time_base"]), f)
+        if "index.json" in files:
+            os.unlink(os.path.join(root, "index.json"))
+
+    assert snapshot(storage.query()) == expected
+    assert snapshot(storage.query(since=datetime(2022, 1, 26), until=datetime(2022, 1, 27))) == \
+        [d for d in expected if datetime(2022, 1, 26) <= d["collection_time"] < datetime(2022, 1, 27)]
+
+
+def test_stats_include_archive(storage):
+    data = make_data()
+    storage.bulk_create(data)
+    expected = stats.compute_stats(storage, PulseDatum, assigned_user=1)
+
+    archive_data(storage, storage.archive, datetime(2022, 2, 5))
+    assert stats.compute_stats(storage, PulseDatum, assigned_user=1) == expected
+
+
+def test_rebuilds_and_duplicates_include_archive(storage):
+    data = make_data()
+    # A patient whose readings are all archived.
+    old = PulseDatum(device_id=4, assigned_user=4, received_time=datetime(2022, 1, 26),
+                     collection_time=datetime(2022, 1, 26), bpm=80)
+    storage.bulk_create(data + [old])
+    users = [1, 2, 3, 4]
+    expected_rollups = {user: rollups.query_rollups(user, granularity="day") for user in users}
+    expected_latest = latest.latest_readings(users)
+
+    archive_data(storage, storage.archive, datetime(2022, 2, 5))
+    rollups.rebuild_rollups(storage)
+    rollups.rebuild_rollups(storage, since=datetime(2022, 2, 1))
+    latest.rebuild_latest(storage)
+    assert {user: rollups.query_rollups(user, granularity="day") for user in users} == expected_rollups
+    assert latest.latest_readings(users) == expected_latest
+
+    # Archived readings sent again are not stored again.
+    assert storage.bulk_create(data + [old]) == 0
+    assert storage.create(old).to_dict() == snapshot(storage.query(assigned_user=4))[0]
+    assert {user: rollups.query_rollups(user, granularity="day") for user in users} == expected_rollups
+
+    # Nor kept when they were stored by earlier versions.
+    row = (old.device_id, old.assigned_user, old.received_time, old.collection_time, old.bpm)
+    PulseDatumModel.insert_many([row], fields=PulseDatumModel.insert_fields()).execute()
+    assert storage.remove_duplicates() == 1
+    assert PulseDatumModel.select().where(PulseDatumModel.assigned_user == 4).count() == 0
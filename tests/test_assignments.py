@@ -0,0 +1,134 @@
+import os
+from datetime import datetime
+
+import pytest
+from medops.models.assignments import (
+    UNASSIGNED_USER,
+    AssignmentIndex,
+    DeviceAssignmentStorage
+)
+from medops.models.device_models import DeviceAssignment, PulseDatum
+
+FILENAME = "assignments_test.db"
+
+
+@pytest.fixture
+def storage():
+    if os.path.exists(FILENAME):
+        os.unlink(FILENAME)
+
+    storage = DeviceAssignmentStorage(FILENAME)
+    yield storage
+    storage.deinit()
+    os.unlink(FILENAME)
+
+
+def assignment(device_id, patient_id, assigned, returned=None):
+    return DeviceAssignment(device_id=device_id,
+                            patient_id=patient_id,
+                            assigner_id=1,
+                            date_assigned=assigned,
+                            date_returned=returned)
+
+
+def pulse(device_id, collected, assigned_user=None):
+    return PulseDatum(device_id=device_id,
+                      assigned_user=assigned_user,
+                      received_time=collected,
+                      collection_time=collected,
+                      bpm=60)
+
+
+def test_index_lookup():
+    index = AssignmentIndex([
+        assignment(1, 20, datetime(2022, 2, 1)),
+        assignment(1, 10, datetime(2022, 1, 1), datetime(2022, 1, 15)),
+        assignment(2, 30, datetime(2022, 1, 1), datetime(2022, 3, 1)),
+    ])
+
+    assert index.lookup(1, datetime(2021, 12, 31)) is None
+    assert index.lookup(1, datetime(2022, 1, 1)) == 10
+    assert index.lookup(1, datetime(2022, 1, 14)) == 10
+    # Return times are exclusive.
+    assert index.lookup(1, datetime(2022, 1, 15)) is None
+    assert index.lookup(1, datetime(2022, 2, 1)) == 20
+    assert index.lookup(1, datetime(2030, 1, 1)) == 20
+    assert index.lookup(2, datetime(2022, 2, 1)) == 30
+    assert index.lookup(2, datetime(2022, 3, 1)) is None
+    assert index.lookup(3, datetime(2022, 2, 1)) is None
+
+
+def test_create_and_query(storage):
+    created = storage.create(assignment(1, 10, datetime(2022, 1, 1), datetime(2022, 1, 15)))
+    assert created.assignment_id is not None
+    storage.create(assignment(1, 20, datetime(2022, 1, 15)))
+    storage.create(assignment(2, 10, datetime(2022, 2, 1)))
+
+    assert [a.patient_id for a in storage.query(device_id=1)] == [10, 20]
+    assert [a.device_id for a in storage.query(patient_id=10)] == [1, 2]
+    assert storage.get(created.assignment_id) == created
+    assert storage.get(1000) is None
+
+    with pytest.raises(ValueError):
+        storage.create(created)
+
+
+def test_overlapping_assignments_rejected(storage):
+    storage.create(assignment(1, 10, datetime(2022, 1, 1), datetime(2022, 1, 15)))
+    current = storage.create(assignment(1, 20, datetime(2022, 2, 1)))
+
+    with pytest.raises(ValueError):
+        storage.create(assignment(1, 30, datetime(2022, 1, 10), datetime(2022, 1, 20)))
+
+    with pytest.raises(ValueError):
+        storage.create(assignment(1, 30, datetime(2022, 3, 1)))
+
+    with pytest.raises(ValueError):
+        storage.create(assignment(1, 30, datetime(2022, 1, 20), datetime(2022, 1, 10)))
+
+    # Other devices and gaps between assignments are fine.
+    storage.create(assignment(2, 30, datetime(2022, 1, 10)))
+    storage.create(assignment(1, 30, datetime(2022, 1, 20), datetime(2022, 2, 1)))
+
+    # An assignment does not overlap itself when it is updated.
+    current.date_returned = datetime(2022, 3, 1)
+    storage.update(current)
+    storage.create(assignment(1, 40, datetime(2022, 3, 1)))
+
+
+def test_assign_users(storage):
+    storage.create(assignment(1, 10, datetime(2022, 1, 1), datetime(2022, 1, 15)))
+    data = [
+        pulse(1, datetime(2022, 1, 2)),
+        pulse(1, datetime(2022, 1, 16)),
+        pulse(1, datetime(2022, 1, 3), assigned_user=99),
+        pulse(2, datetime(2022, 1, 2)),
+    ]
+
+    assert storage.assign_users(data) == 1
+    assert [d.assigned_user for d in data] == [10, UNASSIGNED_USER, 99, UNASSIGNED_USER]
+
+
+def test_index_refreshed_on_change(storage):
+    existing = storage.create(assignment(1, 10, datetime(2022, 1, 1)))
+    assert storage.index.lookup(1, datetime(2022, 2, 1)) == 10
+
+    existing.date_returned = datetime(2022, 1, 15)
+    storage.update(existing)
+    assert storage.index.lookup(1, datetime(2022, 2, 1)) is None
+
+    storage.delete(existing.assignment_id)
+    assert storage.index.lookup(1, datetime(2022, 1, 2)) is None
+
+
+def test_index_reloads_changes_from_other_instances(storage):
+    storage.refresh_interval = 0
+    assert storage.index.lookup(1, datetime(2022, 1, 2)) is None
+
+    other = DeviceAssignmentStorage(FILENAME)
+    try:
+        other.create(assignment(1, 10, datetime(2022, 1, 1)))
+    finally:
+        other.deinit()
+
+    assert storage.index.lookup(1, datetime(2022, 1, 2)) == 10
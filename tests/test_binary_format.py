@@ -0,0 +1,51 @@
+import struct
+from datetime import datetime, timedelta
+
+import pytest
+
+from medops.models import binary_format
+from medops.models.device_models import BloodPressureDatum, GlucometerDatum
+
+
+def test_round_trip():
+    received = datetime(2022, 3, 2)
+    times = [datetime(2022, 3, 1) + timedelta(minutes=5 * i, microseconds=i) for i in range(3)]
+    payload = b"".join([
+        binary_format.encode_block(GlucometerDatum, 4, times, dict(mg_dl=[90, 110, 130])),
+        binary_format.encode_block(BloodPressureDatum, 5, times[:1],
+                                   dict(systolic=[121.5], diastolic=[79.0]), assigned_user=8),
+    ])
+    # A glucose record is 12 bytes and a blood pressure record 24 bytes.
+    assert len(payload) == 2 * binary_format.HEADER.size + 3 * 12 + 24
+
+    data = binary_format.decode(payload, received)
+    assert data == [GlucometerDatum(device_id=4, assigned_user=None, received_time=received,
+                                    collection_time=t, mg_dl=v) for t, v in zip(times, [90, 110, 130])] + [
+        BloodPressureDatum(device_id=5, assigned_user=8, received_time=received,
+                           collection_time=times[0], systolic=121.5, diastolic=79.0)]
+    assert isinstance(data[0].mg_dl, int)
+
+
+@pytest.mark.parametrize("mutate, message", [
+    (lambda p: p[:10], "Truncated block header"),
+    (lambda p: b"XXXX" + p[4:], "bad magic number"),
+    (lambda p: p[:4] + bytes([2]) + p[5:], "Unsupported format version"),
+    (lambda p: p[:5] + bytes([99]) + p[6:], "Invalid data type code"),
+    (lambda p: p[:-4], "Truncated block"),
+])
+def test_malformed_payloads(mutate, message):
+    payload = binary_format.encode_block(GlucometerDatum, 4, [datetime(2022, 3, 1)], dict(mg_dl=[90]))
+    with pytest.raises(ValueError, match=message):
+        binary_format.decode(mutate(payload))
+
+
+def test_invalid_values():
+    payload = binary_format.encode_block(BloodPressureDatum, 4, [datetime(2022, 3, 1)],
+                                         dict(systolic=[float("nan")], diastolic=[80.0]))
+    with pytest.raises(ValueError, match="between"):
+        binary_format.decode(payload)
+
+    header = binary_format.HEADER.pack(binary_format.MAGIC, binary_format.FORMAT_VERSION,
+                                       binary_format.TYPE_CODES[GlucometerDatum], 0, 4, 0, 1)
+    with pytest.raises(ValueError, match="out of range"):
+        binary_format.decode(header + struct.pack("<qi", -1, 90))
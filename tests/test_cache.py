@@ -0,0 +1,55 @@
+from medops.models.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    assert cache.get_or_load(1, lambda: "a") == "a"
+    assert cache.get_or_load(2, lambda: "b") == "b"
+    # Reading 1 makes 2 the least recently used entry.
+    assert cache.get_or_load(1, lambda: "x") == "a"
+    cache.get_or_load(3, lambda: "c")
+    assert cache.get_or_load(2, lambda: "y") == "y"
+
+    stats = cache.stats()
+    assert stats["size"] == 2
+    assert stats["hits"] == 1
+    assert stats["misses"] == 4
+    assert stats["evictions"] == 2
+    assert stats["hit_rate"] == 0.2
+
+
+def test_ttl():
+    now = [0.0]
+    cache = LRUCache(max_size=10, ttl=5, clock=lambda: now[0])
+    cache.get_or_load(1, lambda: "a")
+    now[0] = 4.9
+    assert cache.get_or_load(1, lambda: "b") == "a"
+    now[0] = 5
+    assert cache.get_or_load(1, lambda: "b") == "b"
+
+
+def test_invalidate():
+    cache = LRUCache(max_size=10)
+    # None results are not cached.
+    assert cache.get_or_load(1, lambda: None) is None
+    assert cache.get_or_load(1, lambda: "a") == "a"
+    cache.invalidate(1, 2)
+    assert cache.get_or_load(1, lambda: "b") == "b"
+    cache.get_or_load(("query", 1), lambda: "c")
+    cache.invalidate(match=lambda key: isinstance(key, tuple))
+    assert cache.get_or_load(("query", 1), lambda: "d") == "d"
+    assert cache.get_or_load(1, lambda: "e") == "b"
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_invalidate_while_loading():
+    cache = LRUCache(max_size=10)
+
+    def load():
+        # A write invalidates the key after the value was read.
+        cache.invalidate(1)
+        return "stale"
+
+    assert cache.get_or_load(1, load) == "stale"
+    assert cache.get_or_load(1, lambda: "fresh") == "fresh"
@@ -1,11 +1,15 @@
+import json
 from unittest import mock
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
+import threading
 
+import attr
 import pytest
 from flask import Flask
 from medops import apis, models
-from medops.models import device_models
+from medops.models import binary_format, device_models, sharding
+from medops.models.device_models import DeviceAssignment
 
 @pytest.fixture()
 def client():
@@ -19,10 +23,14 @@ def client():
     models.init_db(app, {"DEVICES_FILENAME": db_filename,
                          "DATA_DB_FILENAME": db_filename})
 
+    # Tests below replace store_data with a mock. Put the real one
+    # back afterwards so other test modules are not affected.
+    store_data = device_models.store_data
     with app.test_client() as testing_client:
         with app.app_context():
             yield testing_client
 
+    device_models.store_data = store_data
     models.deinit(app)
 
     if os.path.exists(db_filename):
@@ -37,7 +45,7 @@ def test_log_temperatue_data(client):
         data=dict(deg_c=36),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -54,7 +62,7 @@ def test_log_bloodpressure_data(client):
         data=dict(systolic=120, diastolic=80),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -71,7 +79,7 @@ def test_log_oxygensaturation_data(client):
         data=dict(percentage=38.3),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -88,7 +96,7 @@ def test_log_glucose_data(client):
         data=dict(mg_dl=6),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -105,7 +113,7 @@ def test_log_pulse_data(client):
         data=dict(bpm=90),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -122,7 +130,7 @@ def test_log_weight_data(client):
         data=dict(grams=65039),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -140,7 +148,7 @@ def test_data_type_mismatch(client):
         data=dict(deg_c=93.6),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 422
     # Make sure the call was not made to store data.
@@ -155,7 +163,7 @@ def test_missing_required_fields(client):
         data=dict(grams=23000),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 422
     # Make sure the call was not made to store data.
@@ -192,7 +200,7 @@ def test_date_parsing(client):
         data=dict(deg_c=36),
     )])
 
-    store_mock = apis.data.device_models.store_data = mock.MagicMock()
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
     resp = client.post("/data", json=request_data)
     assert resp.status_code == 201
     # Make sure the call was made to store data.
@@ -213,3 +221,703 @@ def test_date_parsing(client):
     assert resp.status_code == 422
     # Make sure the call was made to store data.
     assert store_mock.call_count == 0
+
+
+def test_query_data_filters(client):
+    storage = models.get_storage("data")
+    start = datetime(2022, 3, 1)
+    data = []
+    for i in range(6):
+        collected = start + timedelta(hours=i)
+        data.append(device_models.PulseDatum(device_id=1,
+                                             assigned_user=7,
+                                             received_time=collected,
+                                             collection_time=collected,
+                                             bpm=60 + i))
+        data.append(device_models.TemperatureDatum(device_id=2,
+                                                   assigned_user=8,
+                                                   received_time=collected,
+                                                   collection_time=collected,
+                                                   deg_c=37))
+    storage.bulk_create(data)
+
+    resp = client.get("/data")
+    assert resp.status_code == 200
+    assert len(resp.json["data"]) == 12
+
+    resp = client.get("/data", query_string={"assigned_user": 7})
+    assert [d["bpm"] for d in resp.json["data"]] == list(range(60, 66))
+    assert resp.json["data"][0]["collection_time"] == start.isoformat()
+
+    resp = client.get("/data", query_string={"types": "temperature", "device_id": 2, "limit": 2})
+    assert len(resp.json["data"]) == 2
+    assert all("deg_c" in d for d in resp.json["data"])
+
+    resp = client.get("/data", query_string={"since": (start + timedelta(hours=4)).isoformat(),
+                                             "until": (start + timedelta(hours=5)).isoformat()})
+    assert len(resp.json["data"]) == 2
+
+
+def test_query_data_invalid_args(client):
+    resp = client.get("/data", query_string={"types": "cholesterol",
+                                             "since": "yesterday",
+                                             "limit": "ten"})
+    assert resp.status_code == 422
+    assert resp.json["count"] == 3
+
+
+def test_query_data_pagination(client):
+    storage = models.get_storage("data")
+    start = datetime(2022, 3, 1)
+    storage.bulk_create([
+        device_models.PulseDatum(device_id=1,
+                                 assigned_user=7,
+                                 received_time=start,
+                                 collection_time=start + timedelta(minutes=i),
+                                 bpm=60 + i)
+        for i in range(7)
+    ])
+
+    bpms = []
+    cursor = None
+    n_pages = 0
+    while True:
+        query = {"limit": 3}
+        if cursor:
+            query["cursor"] = cursor
+        resp = client.get("/data", query_string=query)
+        assert resp.status_code == 200
+        n_pages += 1
+        bpms.extend(d["bpm"] for d in resp.json["data"])
+        cursor = resp.json["next_cursor"]
+        if cursor is None:
+            break
+
+    assert n_pages == 3
+    assert bpms == list(range(60, 67))
+
+
+def test_query_data_invalid_cursor(client):
+    resp = client.get("/data", query_string={"cursor": "not-a-cursor"})
+    assert resp.status_code == 422
+
+
+def test_query_data_stream(client):
+    storage = models.get_storage("data")
+    start = datetime(2022, 3, 1)
+    storage.bulk_create([
+        device_models.PulseDatum(device_id=1,
+                                 assigned_user=7,
+                                 received_time=start,
+                                 collection_time=start + timedelta(minutes=i),
+                                 bpm=60 + i)
+        for i in range(1200)
+    ])
+
+    for kwargs in [dict(query_string={"stream": 1}),
+                   dict(headers={"Accept": "application/x-ndjson"})]:
+        resp = client.get("/data", **kwargs)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        assert resp.is_streamed
+        lines = resp.get_data(as_text=True).splitlines()
+        assert len(lines) == 1200
+        first = json.loads(lines[0])
+        assert first["bpm"] == 60
+        assert first["collection_time"] == start.isoformat()
+
+    resp = client.get("/data", query_string={"stream": 1, "limit": 5})
+    assert len(resp.get_data(as_text=True).splitlines()) == 5
+
+
+def test_log_ndjson_data(client):
+    now = datetime.now()
+    lines = []
+    for i in range(25):
+        lines.append(json.dumps(dict(
+            device_id=1,
+            assigned_user=3,
+            collection_time=(now + timedelta(seconds=i)).isoformat(),
+            data_type="heart_rate",
+            data=dict(bpm=60 + i),
+        )))
+    # One malformed line and one invalid data point in the middle.
+    lines.insert(5, "{not json")
+    lines.insert(10, json.dumps(dict(device_id=1,
+                                     collection_time=now.isoformat(),
+                                     data_type="weight",
+                                     data=dict(deg_c=37))))
+
+    with mock.patch.object(apis.data, "NDJSON_BATCH_SIZE", 10):
+        resp = client.post("/data",
+                           data="\n".join(lines) + "\n",
+                           content_type="application/x-ndjson")
+
+    assert resp.status_code == 201
+    assert resp.json["stored"] == 25
+    assert resp.json["count"] == 2
+    assert resp.json["errors"][0].startswith("Error processing data point 5")
+    assert resp.json["errors"][1].startswith("Error processing data point 10")
+
+    stored = models.get_storage("data").query(assigned_user=3)
+    assert [d.bpm for d in stored] == list(range(60, 85))
+
+
+def test_log_ndjson_data_retry(client):
+    now = datetime(2022, 3, 2)
+    lines = [json.dumps(dict(device_id=1, assigned_user=4, collection_time=(now + timedelta(seconds=i)).isoformat(),
+                             data_type="heart_rate", data=dict(bpm=60 + i))) for i in range(3)]
+    body = "\n".join(lines + ["{not json"]) + "\n"
+    resp = client.post("/data", data=body, content_type="application/x-ndjson")
+    assert resp.status_code == 201
+    assert (resp.json["stored"], resp.json["duplicates"], resp.json["count"]) == (3, 0, 1)
+
+    # Sending the upload again only finds duplicates and the same bad line.
+    resp = client.post("/data", data=body, content_type="application/x-ndjson")
+    assert resp.status_code == 201
+    assert (resp.json["stored"], resp.json["duplicates"], resp.json["count"]) == (0, 3, 1)
+
+
+def test_value_ranges(client):
+    now = datetime.now().isoformat()
+    request_data = dict(data=[
+        dict(device_id=1, collection_time=now, data_type="oxygen_saturation", data=dict(percentage=97.5)),
+        dict(device_id=1, collection_time=now, data_type="oxygen_saturation", data=dict(percentage=120)),
+        dict(device_id=1, collection_time=now, data_type="heart_rate", data=dict(bpm="90")),
+    ])
+
+    store_mock = apis.data.device_models.store_data = mock.MagicMock(return_value=1)
+    resp = client.post("/data", json=request_data)
+    assert resp.status_code == 422
+    assert resp.json["errors"] == ["Error processing data point 1: percentage must be between 0 and 100.",
+                                   "Error processing data point 2: bpm must be a number."]
+    assert store_mock.call_count == 0
+
+
+def test_parse_data_matches_parse_datum():
+    now = datetime(2022, 3, 1)
+    datapoints = [
+        dict(device_id=1, collection_time=now.isoformat(), data_type="heart_rate", data=dict(bpm=60)),
+        dict(device_id=1, collection_time="yesterday", data_type="heart_rate", data=dict(bpm=61)),
+        dict(device_id=1, collection_time=now.isoformat(), data_type="blood_pressure",
+             data=dict(systolic=120.0, diastolic=80)),
+        dict(device_id=1, collection_time=now.isoformat(), data_type="blood_pressure",
+             data=dict(systolic=120.0, diastolic=True)),
+        dict(device_id=1, collection_time=now.isoformat(), data_type="weight", data=dict(deg_c=37)),
+        dict(device_id=1, collection_time=now.isoformat(), data_type="height", data=dict(cm=180)),
+        dict(device_id=1, assigned_user=3, collection_time=now.isoformat(), data_type="temperature",
+             data=dict(deg_c=float("nan"))),
+        dict(collection_time=now.isoformat(), data_type="temperature", data=dict(deg_c=37)),
+        [],
+        dict(device_id=2, assigned_user=3, collection_time=now.isoformat(), data_type="temperature",
+             data=dict(deg_c=37)),
+    ]
+    indices = [10 * i for i in range(len(datapoints))]
+    data, errors = apis.data.parse_data(datapoints, indices)
+
+    expected = [apis.data.parse_datum(index, payload) for index, payload in zip(indices, datapoints)]
+    assert errors == [(index, error) for index, (_, error) in zip(indices, expected) if error]
+    strip = dict(received_time=None)
+    assert [attr.evolve(d, **strip) for d in data] == [attr.evolve(d, **strip) for d, _ in expected if d]
+    assert [type(d) for d in data] == [device_models.PulseDatum,
+                                       device_models.BloodPressureDatum,
+                                       device_models.TemperatureDatum]
+
+
+def test_log_ndjson_data_all_invalid(client):
+    resp = client.post("/data", data="[]\n{}\n", content_type="application/x-ndjson")
+    assert resp.status_code == 422
+    assert resp.json["count"] == 2
+
+
+def test_query_rollups(client):
+    storage = models.get_storage("data")
+    start = datetime(2022, 3, 1)
+    storage.bulk_create([
+        device_models.PulseDatum(device_id=1,
+                                 assigned_user=7,
+                                 received_time=start,
+                                 collection_time=start + timedelta(minutes=20 * i),
+                                 bpm=60 + i)
+        for i in range(6)
+    ])
+
+    resp = client.get("/data/rollups", query_string={"assigned_user": 7, "types": "heart_rate"})
+    assert resp.status_code == 200
+    assert resp.json["count"] == 2
+    first = resp.json["rollups"][0]
+    assert first["datum_type"] == "heart_rate"
+    assert first["field"] == "bpm"
+    assert first["bucket"] == start.isoformat()
+    assert first["count"] == 3
+    assert first["mean"] == 61
+
+    resp = client.get("/data/rollups", query_string={"assigned_user": 7, "granularity": "day"})
+    assert resp.json["count"] == 1
+    assert resp.json["rollups"][0]["maximum"] == 65
+
+    resp = client.get("/data/rollups", query_string={"granularity": "week"})
+    assert resp.status_code == 422
+    assert resp.json["count"] == 2
+
+
+def test_query_stats(client):
+    storage = models.get_storage("data")
+    start = datetime(2022, 3, 1)
+    storage.bulk_create([
+        device_models.GlucometerDatum(device_id=1,
+                                      assigned_user=7,
+                                      received_time=start,
+                                      collection_time=start + timedelta(minutes=i),
+                                      mg_dl=mg_dl)
+        for i, mg_dl in enumerate([60, 100, 150, 200])
+    ])
+
+    resp = client.get("/data/stats", query_string={"assigned_user": 7,
+                                                   "types": "glucose_level",
+                                                   "percentiles": "50"})
+    assert resp.status_code == 200
+    glucose = resp.json["stats"]["glucose_level"]["mg_dl"]
+    assert glucose["count"] == 4
+    assert glucose["mean"] == 127.5
+    assert glucose["percentiles"] == {"50": 125}
+    assert glucose["time_in_range"] == 0.5
+
+    resp = client.get("/data/stats", query_string={"glucose_low": 50, "glucose_high": 120})
+    assert resp.json["stats"]["glucose_level"]["mg_dl"]["time_in_range"] == 0.5
+    assert resp.json["stats"]["heart_rate"]["bpm"]["count"] == 0
+
+    resp = client.get("/data/stats", query_string={"percentiles": "200"})
+    assert resp.status_code == 422
+
+
+def test_wide_layout():
+    db_filename = "wide_layout_testing.db"
+    app = Flask(__name__)
+    app.register_blueprint(apis.DATA_API_BLUEPRINT, url_prefix="/data")
+    models.init_db(app, {"DATA_DB_FILENAME": db_filename, "DATA_DB_LAYOUT": "wide"})
+    try:
+        assert isinstance(app.config["STORAGE"]["data"], models.WideDataStorage)
+        with app.test_client() as client:
+            resp = client.post("/data", json=dict(data=[dict(
+                device_id=1,
+                collection_time=datetime(2022, 3, 1).isoformat(),
+                data_type="heart_rate",
+                data=dict(bpm=72),
+            )]))
+            assert resp.status_code == 201
+            resp = client.get("/data")
+            assert [d["bpm"] for d in resp.json["data"]] == [72]
+    finally:
+        models.deinit(app)
+        os.unlink(db_filename)
+
+    with pytest.raises(ValueError):
+        models.init_db(app, {"DATA_DB_FILENAME": db_filename, "DATA_DB_LAYOUT": "columns"})
+
+
+def test_sharded_data():
+    db_filename = "sharded_testing.db"
+    app = Flask(__name__)
+    app.register_blueprint(apis.DATA_API_BLUEPRINT, url_prefix="/data")
+    models.init_db(app, {"DATA_DB_FILENAME": db_filename, "DATA_DB_SHARDS": 2, "DATA_WRITER_QUEUE_SIZE": 100})
+    filenames = [db_filename] + sharding.shard_filenames(db_filename, 2)
+    try:
+        assert isinstance(app.config["STORAGE"]["data"], models.ShardedDataStorage)
+        with app.test_client() as client:
+            resp = client.post("/data", json=dict(data=[dict(
+                device_id=user,
+                assigned_user=user,
+                collection_time=datetime(2022, 3, 1).isoformat(),
+                data_type="heart_rate",
+                data=dict(bpm=70 + user),
+            ) for user in range(4)]))
+            assert resp.status_code == 201
+
+            resp = client.get("/data")
+            assert sorted(d["bpm"] for d in resp.json["data"]) == [70, 71, 72, 73]
+
+            # The shards hold readings with the same time, type and ids, which
+            # the cursor tells apart.
+            bpms = []
+            query = {"limit": 1}
+            while True:
+                resp = client.get("/data", query_string=query)
+                bpms.extend(d["bpm"] for d in resp.json["data"])
+                if resp.json["next_cursor"] is None:
+                    break
+                query["cursor"] = resp.json["next_cursor"]
+            assert sorted(bpms) == [70, 71, 72, 73]
+
+            resp = client.get("/data/rollups", query_string={"assigned_user": 3})
+            assert [r["minimum"] for r in resp.json["rollups"]] == [73]
+            resp = client.post("/data/latest", json=dict(user_ids=[2, 1]))
+            assert [p["latest"]["heart_rate"]["bpm"] for p in resp.json["patients"]] == [72, 71]
+    finally:
+        models.deinit(app)
+        for filename in filenames:
+            os.unlink(filename)
+
+    with pytest.raises(ValueError):
+        models.init_db(app, {"DATA_DB_FILENAME": db_filename, "DATA_DB_SHARDS": 2, "DATA_DB_LAYOUT": "wide"})
+    assert not any(os.path.exists(filename) for filename in filenames)
+
+
+def test_admission_control():
+    db_filename = "admission_testing.db"
+    if os.path.exists(db_filename):
+        os.unlink(db_filename)
+
+    app = Flask(__name__)
+    app.register_blueprint(apis.DATA_API_BLUEPRINT, url_prefix="/data")
+    models.init_db(app, {"DATA_DB_FILENAME": db_filename,
+                         "DATA_DEVICE_INGEST_RATE": 0.01,
+                         "DATA_DEVICE_INGEST_BURST": 3,
+                         "DATA_MAX_INGEST_IN_FLIGHT": 1})
+
+    def points(device_id, count):
+        return [dict(device_id=device_id,
+                     assigned_user=1,
+                     collection_time=datetime(2022, 3, 1, 0, 0, i).isoformat(),
+                     data_type="heart_rate",
+                     data=dict(bpm=60 + i)) for i in range(count)]
+
+    try:
+        with app.test_client() as client:
+            assert client.post("/data", json=dict(data=points(1, 3))).status_code == 201
+            resp = client.post("/data", json=dict(data=points(1, 1)))
+            assert resp.status_code == 429
+            assert int(resp.headers["Retry-After"]) > 1
+            # Other devices are not limited.
+            assert client.post("/data", json=dict(data=points(2, 1))).status_code == 201
+
+            lines = "\n".join(json.dumps(p) for p in points(3, 5))
+            with mock.patch.object(apis.data, "NDJSON_BATCH_SIZE", 3):
+                resp = client.post("/data", data=lines, content_type="application/x-ndjson")
+            assert resp.status_code == 429
+            assert resp.json["errors"] == ["Too many readings, retry later. 3 data were stored."]
+
+            # Reads are not limited while an upload is in progress.
+            app.config["STORAGE"]["admission"].enter()
+            resp = client.post("/data", json=dict(data=points(4, 1)))
+            assert resp.status_code == 429
+            assert resp.headers["Retry-After"] == "1"
+            assert client.get("/data").status_code == 200
+            app.config["STORAGE"]["admission"].leave()
+
+            stats = client.get("/data/admission").json
+            assert stats["admitted_requests"] == 3
+            assert stats["admitted_readings"] == 7
+            assert stats["shed_requests"] == dict(in_flight=1, device_rate=2, global_rate=0)
+            assert stats["shed_readings"] == 3
+    finally:
+        models.deinit(app)
+        os.unlink(db_filename)
+
+
+@pytest.fixture()
+def writer_client():
+    """Sets up a test client with the background data writer enabled"""
+    db_filename = "writer_testing.db"
+    if os.path.exists(db_filename):
+        os.unlink(db_filename)
+
+    app = Flask(__name__)
+    app.register_blueprint(apis.DATA_API_BLUEPRINT, url_prefix="/data")
+    models.init_db(app, {"DATA_DB_FILENAME": db_filename, "DATA_WRITER_QUEUE_SIZE": 10})
+
+    with app.test_client() as testing_client:
+        with app.app_context():
+            yield testing_client
+
+    models.deinit(app)
+    os.unlink(db_filename)
+
+
+def heart_rate_request(n, user=7):
+    return dict(data=[dict(
+        device_id=user,
+        assigned_user=user,
+        collection_time=datetime(2022, 3, 1, 0, i).isoformat(),
+        data_type="heart_rate",
+        data=dict(bpm=60 + i),
+    ) for i in range(n)])
+
+
+def test_log_data_with_writer(writer_client):
+    resp = writer_client.post("/data", json=heart_rate_request(4))
+    assert resp.status_code == 201
+    assert resp.json == dict(stored=4, duplicates=0)
+    # The response is only sent once the data are stored.
+    assert len(models.get_storage("data").query(assigned_user=7)) == 4
+
+    resp = writer_client.post("/data", json=heart_rate_request(5))
+    assert resp.json == dict(stored=1, duplicates=4)
+
+    # A request larger than the queue is taken when the queue is empty.
+    resp = writer_client.post("/data", json=heart_rate_request(11, user=9))
+    assert resp.json == dict(stored=11, duplicates=0)
+
+    writer = models.get_storage("data_writer")
+    writing = threading.Event()
+    release = threading.Event()
+    bulk_create = writer.storage.bulk_create
+
+    def blocked_bulk_create(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        return bulk_create(*args, **kwargs)
+
+    with mock.patch.object(writer.storage, "bulk_create", blocked_bulk_create):
+        resp = writer_client.post("/data?ack=async", json=heart_rate_request(2, user=8))
+        assert resp.status_code == 202
+        assert resp.json == dict(queued=2)
+        assert writing.wait(5)
+
+        # While it is written, other requests queue up to the queue size.
+        assert writer_client.post("/data?ack=async", json=heart_rate_request(3, user=10)).status_code == 202
+        resp = writer_client.post("/data", json=heart_rate_request(8, user=11))
+        assert resp.status_code == 429
+        release.set()
+        writer.stop(5)
+
+    stats = writer_client.get("/data/writer").json
+    assert stats["data_written"] == 21
+    assert stats["rejected"] == 1
+    assert len(models.get_storage("data").query(assigned_user=8)) == 2
+
+
+def test_log_ndjson_data_with_writer(writer_client):
+    lines = [json.dumps(datapoint) for datapoint in heart_rate_request(11)["data"]]
+    with mock.patch.object(apis.data, "NDJSON_BATCH_SIZE", 6):
+        resp = writer_client.post("/data", data="\n".join(lines[:6] + lines), content_type="application/x-ndjson")
+    assert resp.status_code == 201
+    assert (resp.json["stored"], resp.json["duplicates"]) == (11, 6)
+
+    # Batches larger than the writer's queue are written on their own.
+    with mock.patch.object(apis.data, "NDJSON_BATCH_SIZE", 20):
+        resp = writer_client.post("/data", data="\n".join(lines), content_type="application/x-ndjson")
+    assert resp.status_code == 201
+    assert (resp.json["stored"], resp.json["duplicates"]) == (0, 11)
+
+
+def test_writer_errors(writer_client):
+    storage = models.get_storage("data_writer").storage
+    with mock.patch.object(storage, "bulk_create", side_effect=ValueError("disk full")):
+        resp = writer_client.post("/data", json=heart_rate_request(2))
+        assert resp.status_code == 503
+        assert resp.json["errors"] == ["The data could not be stored: disk full."]
+
+        body = json.dumps(heart_rate_request(1)["data"][0]) + "\n"
+        resp = writer_client.post("/data", data=body, content_type="application/x-ndjson")
+        assert resp.status_code == 503
+        assert resp.json["errors"] == ["The data could not be stored: disk full. 0 data were stored."]
+
+
+def test_writer_stats_disabled(client):
+    resp = client.get("/data/writer")
+    assert resp.status_code == 404
+
+
+def test_post_tags_assigned_user(client):
+    assignments = models.get_storage("assignments")
+    assignments.create(DeviceAssignment(device_id=7,
+                                        patient_id=42,
+                                        assigner_id=1,
+                                        date_assigned=datetime(2022, 1, 1),
+                                        date_returned=datetime(2022, 2, 1)))
+
+    def point(collected, **kwargs):
+        return dict(device_id=7, collection_time=collected, data_type="heart_rate", data=dict(bpm=60), **kwargs)
+
+    resp = client.post("/data", json=dict(data=[
+        point("2022-01-10T00:00:00"),
+        point("2022-02-10T00:00:00"),
+        point("2022-01-11T00:00:00", assigned_user=5),
+    ]))
+    assert resp.status_code == 201
+
+    resp = client.get("/data?device_id=7")
+    assert [d["assigned_user"] for d in resp.json["data"]] == [42, 5, -1]
+
+    body = json.dumps(point("2022-01-12T00:00:00")) + "\n"
+    resp = client.post("/data", data=body, content_type="application/x-ndjson")
+    assert resp.status_code == 201
+    assert len(client.get("/data?assigned_user=42").json["data"]) == 2
+
+
+def test_query_with_offset_aware_bounds(client):
+    storage = models.get_storage("data")
+    collected = datetime(2022, 3, 1, 10)
+    storage.bulk_create([device_models.PulseDatum(device_id=14, assigned_user=14, received_time=collected,
+                                                  collection_time=collected, bpm=70)])
+
+    # 09:30 and 10:30 UTC.
+    bounds = dict(since="2022-03-01T11:30:00+02:00", until="2022-03-01T05:30:00-05:00")
+    resp = client.get("/data", query_string=dict(assigned_user=14, **bounds))
+    assert [d["collection_time"] for d in resp.json["data"]] == [collected.isoformat()]
+
+    resp = client.get("/data", query_string=dict(assigned_user=14, since="2022-03-01T10:30:00+00:00"))
+    assert resp.json["data"] == []
+
+
+def test_post_tags_assigned_user_with_offsets(client):
+    assignments = models.get_storage("assignments")
+    offset = timezone(timedelta(hours=2))
+    created = assignments.create(DeviceAssignment(device_id=12,
+                                                  patient_id=43,
+                                                  assigner_id=1,
+                                                  date_assigned=datetime(2022, 1, 1, tzinfo=offset),
+                                                  date_returned=None))
+    assert created.date_assigned == datetime(2021, 12, 31, 22)
+
+    def point(collected):
+        return dict(device_id=12, collection_time=collected, data_type="heart_rate", data=dict(bpm=60))
+
+    resp = client.post("/data", json=dict(data=[point("2021-12-31T23:30:00+00:00"),
+                                                point("2021-12-31T21:30:00+00:00")]))
+    assert resp.status_code == 201
+    resp = client.get("/data?device_id=12")
+    assert [d["assigned_user"] for d in resp.json["data"]] == [-1, 43]
+
+
+def test_retried_post_skips_duplicates(client):
+    request_data = heart_rate_request(5, user=9)
+    resp = client.post("/data", json=request_data)
+    assert resp.status_code == 201
+    assert resp.json == dict(stored=5, duplicates=0)
+
+    # A gateway retrying after a timeout resends the same readings.
+    resp = client.post("/data", json=request_data)
+    assert resp.status_code == 201
+    assert resp.json == dict(stored=0, duplicates=5)
+
+    body = "".join(json.dumps(point) + "\n" for point in heart_rate_request(7, user=9)["data"])
+    resp = client.post("/data", data=body, content_type="application/x-ndjson")
+    assert resp.json["stored"] == 2
+    assert resp.json["duplicates"] == 5
+    assert len(client.get("/data?assigned_user=9").json["data"]) == 7
+
+
+def test_offset_aware_collection_times(client):
+    def point(collected):
+        return dict(device_id=3, assigned_user=3, collection_time=collected, data_type="heart_rate",
+                    data=dict(bpm=60))
+
+    # A batch may mix naive and offset-aware times.
+    request_data = dict(data=[point("2022-01-01T00:00:00"), point("2022-01-01T02:00:01+01:00")])
+    resp = client.post("/data", json=request_data)
+    assert resp.status_code == 201
+    assert resp.json == dict(stored=2, duplicates=0)
+
+    # Aware times are stored as naive UTC, so a retry is a duplicate.
+    resp = client.post("/data", json=request_data)
+    assert resp.status_code == 201
+    assert resp.json == dict(stored=0, duplicates=2)
+    resp = client.post("/data", json=dict(data=[point("2022-01-01T01:00:01+00:00")]))
+    assert resp.json == dict(stored=0, duplicates=1)
+
+    times = [d["collection_time"] for d in client.get("/data?assigned_user=3").json["data"]]
+    assert times == ["2022-01-01T00:00:00", "2022-01-01T01:00:01"]
+
+
+def test_latest_readings(client):
+    resp = client.post("/data", json=heart_rate_request(5, user=11))
+    assert resp.status_code == 201
+
+    resp = client.get("/data/latest?user_id=11")
+    assert resp.status_code == 200
+    assert resp.json["user_id"] == 11
+    assert list(resp.json["latest"]) == ["heart_rate"]
+    assert resp.json["latest"]["heart_rate"]["bpm"] == 64
+    assert resp.json["latest"]["heart_rate"]["collection_time"] == datetime(2022, 3, 1, 0, 4).isoformat()
+
+    resp = client.post("/data/latest", json=dict(user_ids=[11, 12]))
+    assert resp.status_code == 200
+    assert resp.json["count"] == 2
+    assert resp.json["patients"][1] == dict(user_id=12, latest={})
+
+    assert client.get("/data/latest").status_code == 422
+    assert client.get("/data/latest?user_id=abc").status_code == 422
+    assert client.post("/data/latest", json=dict(user_ids="11")).status_code == 422
+
+
+def test_log_binary_data(client):
+    start = datetime(2022, 4, 1)
+    times = [start + timedelta(seconds=i) for i in range(100)]
+    blocks = [
+        binary_format.encode_block(device_models.BloodSaturationDatum, 11, times,
+                                   dict(percentage=[97.5] * 100), assigned_user=11),
+        binary_format.encode_block(device_models.PulseDatum, 11, times,
+                                   dict(bpm=list(range(100))), assigned_user=11),
+    ]
+    payload = b"".join(blocks)
+
+    resp = client.post("/data", data=payload, content_type="application/vnd.medops.readings")
+    assert resp.status_code == 201
+    assert resp.json == dict(stored=200, duplicates=0)
+
+    data = models.get_storage("data").query(assigned_user=11, types=[device_models.PulseDatum])
+    assert [d.bpm for d in data] == list(range(100))
+    assert data[0].collection_time == start
+
+    resp = client.post("/data", data=payload[:-1], content_type="application/vnd.medops.readings")
+    assert resp.status_code == 422
+    assert "Truncated block" in resp.json["errors"][0]
+
+
+def test_waveform_endpoints(client):
+    segment = dict(device_id=12,
+                   assigned_user=12,
+                   waveform="ppg",
+                   collection_time=datetime(2022, 4, 1).isoformat(),
+                   sample_rate=100,
+                   samples=list(range(1000)))
+    resp = client.post("/data/waveforms", json=segment)
+    assert resp.status_code == 201
+    assert resp.json["n_samples"] == 1000
+    datum_id = resp.json["datum_id"]
+
+    resp = client.get("/data/waveforms", query_string={"assigned_user": 12,
+                                                       "since": datetime(2022, 4, 1, 0, 0, 2).isoformat(),
+                                                       "until": datetime(2022, 4, 1, 0, 0, 3).isoformat()})
+    assert resp.status_code == 200
+    assert resp.json["count"] == 1
+    assert resp.json["segments"][0]["samples"] == list(range(200, 300))
+    assert resp.json["segments"][0]["collection_time"] == datetime(2022, 4, 1, 0, 0, 2).isoformat()
+
+    resp = client.get(f"/data/waveforms/{datum_id}")
+    assert resp.json["segment"]["samples"] == list(range(1000))
+    assert client.get(f"/data/waveforms/{datum_id + 1}").status_code == 404
+
+    for changes, message in [(dict(waveform="eeg"), "Invalid waveform type"),
+                             (dict(samples=["a"]), "samples must be a list of numbers"),
+                             (dict(sample_type="int16", samples=[40000]), "do not fit in int16"),
+                             (dict(sample_rate=-1), "greater than zero")]:
+        resp = client.post("/data/waveforms", json=dict(segment, **changes))
+        assert resp.status_code == 422
+        assert message in resp.json["errors"][0]
+
+    resp = client.get("/data/waveforms")
+    assert resp.status_code == 422
+
+
+def test_waveform_offset_aware_times(client):
+    offset = timezone(timedelta(hours=2))
+    segment = dict(device_id=13, assigned_user=13, waveform="ecg", sample_rate=100, samples=list(range(1000)),
+                   collection_time=datetime(2022, 4, 1, 2, tzinfo=offset).isoformat())
+    resp = client.post("/data/waveforms", json=segment)
+    assert resp.status_code == 201
+    datum_id = resp.json["datum_id"]
+    # A retry with another offset is the same segment.
+    segment["collection_time"] = "2022-04-01T00:00:00+00:00"
+    assert client.post("/data/waveforms", json=segment).json["datum_id"] == datum_id
+
+    since = datetime(2022, 4, 1, 2, 0, 2, tzinfo=offset).isoformat()
+    resp = client.get("/data/waveforms", query_string={"device_id": 13, "since": since})
+    assert resp.status_code == 200
+    assert resp.json["segments"][0]["collection_time"] == datetime(2022, 4, 1, 0, 0, 2).isoformat()
+    assert resp.json["segments"][0]["samples"] == list(range(200, 1000))
+
+    resp = client.get(f"/data/waveforms/{datum_id}", query_string={"until": "2022-04-01T00:00:01+00:00"})
+    assert resp.json["segment"]["samples"] == list(range(100))
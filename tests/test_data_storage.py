@@ -1,10 +1,15 @@
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytest
+from medops.models import rollups
 from medops.models.device_models import (
     DataStorage,
     PulseDatum,
-    TemperatureDatum
+    PulseDatumModel,
+    TemperatureDatum,
+    TemperatureDatumModel,
+    datum_sort_key,
+    store_data
 )
 
 import atexit
@@ -52,9 +57,237 @@ def test_create_pulse_datum(data_storage: DataStorage):
     pulse.datum_id = result.datum_id
     assert result == pulse
 
+def test_bulk_create_mixed_types(data_storage: DataStorage):
+    now = datetime.now()
+    data = []
+    for i in range(250):
+        data.append(TemperatureDatum(device_id=i,
+                                     assigned_user=2,
+                                     received_time=now,
+                                     collection_time=now,
+                                     deg_c=36 + i / 100))
+        data.append(PulseDatum(device_id=i,
+                               assigned_user=2,
+                               received_time=now,
+                               collection_time=now,
+                               bpm=60 + i))
+
+    n_temps = TemperatureDatumModel.select().count()
+    n_pulses = PulseDatumModel.select().count()
+    assert data_storage.bulk_create(data) == len(data)
+    assert TemperatureDatumModel.select().count() == n_temps + 250
+    assert PulseDatumModel.select().count() == n_pulses + 250
+
+    stored = PulseDatumModel.select().order_by(PulseDatumModel.datum_id.desc()).first()
+    assert stored.to_dataclass().bpm == 60 + 249
+
+
+def test_store_data_uses_single_transaction(data_storage: DataStorage):
+    now = datetime.now()
+    data = [PulseDatum(device_id=1,
+                       assigned_user=1,
+                       received_time=now,
+                       collection_time=now,
+                       bpm=70),
+            # Missing a value for a non-null column so the batch fails.
+            TemperatureDatum(device_id=1,
+                             assigned_user=1,
+                             received_time=now,
+                             collection_time=now,
+                             deg_c=None)]
+
+    n_pulses = PulseDatumModel.select().count()
+    with pytest.raises(Exception):
+        store_data(data, data_storage)
+
+    # Nothing from the failed batch should have been committed.
+    assert PulseDatumModel.select().count() == n_pulses
+
+
 def test_cannot_overwrite_tables(data_storage):
     try:
         data_storage.tables = None
         pytest.fail()
     except Exception:
         pass
+
+
+def test_query_filters(data_storage: DataStorage):
+    start = datetime(2022, 3, 1)
+    data = []
+    for i in range(10):
+        collected = start + timedelta(hours=i)
+        data.append(TemperatureDatum(device_id=10 + i % 2,
+                                     assigned_user=1001,
+                                     received_time=collected,
+                                     collection_time=collected,
+                                     deg_c=37))
+        data.append(PulseDatum(device_id=10 + i % 2,
+                               assigned_user=1001,
+                               received_time=collected,
+                               collection_time=collected,
+                               bpm=60 + i))
+    # Data for another patient that should never be returned.
+    data.append(PulseDatum(device_id=10,
+                           assigned_user=1002,
+                           received_time=start,
+                           collection_time=start,
+                           bpm=100))
+    data_storage.bulk_create(data)
+
+    result = data_storage.query(assigned_user=1001)
+    assert len(result) == 20
+    assert [d.collection_time for d in result] == sorted(d.collection_time for d in result)
+
+    result = data_storage.query(assigned_user=1001, types=[PulseDatum])
+    assert [d.bpm for d in result] == list(range(60, 70))
+
+    result = data_storage.query(assigned_user=1001, device_id=11, types=[PulseDatum])
+    assert [d.bpm for d in result] == [61, 63, 65, 67, 69]
+
+    result = data_storage.query(assigned_user=1001,
+                                types=[PulseDatum],
+                                since=start + timedelta(hours=2),
+                                until=start + timedelta(hours=5))
+    assert [d.bpm for d in result] == [62, 63, 64]
+
+    result = data_storage.query(assigned_user=1001, limit=3)
+    assert len(result) == 3
+    assert all(d.collection_time <= start + timedelta(hours=1) for d in result)
+
+
+def test_query_unknown_type(data_storage: DataStorage):
+    with pytest.raises(ValueError):
+        data_storage.query(types=[str])
+
+
+def test_datum_indexes_exist(data_storage: DataStorage):
+    indexes = data_storage.database.get_indexes(PulseDatumModel._meta.table_name)
+    columns = {tuple(index.columns) for index in indexes}
+    assert ("assigned_user", "collection_time") in columns
+    assert ("device_id", "collection_time") in columns
+
+
+def test_query_keyset_pagination(data_storage: DataStorage):
+    start = datetime(2022, 4, 1)
+    data = []
+    for i in range(5):
+        # Several data share a collection time so the tie breakers on
+        # type and datum id are exercised.
+        collected = start + timedelta(minutes=i // 2)
+        data.append(TemperatureDatum(device_id=i,
+                                     assigned_user=1003,
+                                     received_time=collected,
+                                     collection_time=collected,
+                                     deg_c=36 + i))
+        data.append(PulseDatum(device_id=i,
+                               assigned_user=1003,
+                               received_time=collected,
+                               collection_time=collected,
+                               bpm=60 + i))
+    data_storage.bulk_create(data)
+
+    expected = data_storage.query(assigned_user=1003)
+    assert len(expected) == 10
+
+    pages = []
+    after = None
+    while True:
+        page = data_storage.query(assigned_user=1003, limit=3, after=after)
+        if not page:
+            break
+        pages.append(page)
+        after = datum_sort_key(page[-1])
+
+    assert [len(p) for p in pages] == [3, 3, 3, 1]
+    assert [d for p in pages for d in p] == expected
+
+
+def test_keyset_condition_uses_index(data_storage: DataStorage):
+    # Deep pages must seek to the cursor rather than scan the rows before it.
+    after = (datetime(2022, 4, 1), "PulseDatum", 10)
+    for assigned_user in [None, 1003]:
+        query = data_storage._select(PulseDatumModel, assigned_user=assigned_user, after=after).limit(3)
+        sql, params = query.sql()
+        plan = " ".join(row[-1] for row in data_storage.database.execute_sql("EXPLAIN QUERY PLAN " + sql, params))
+        assert "collection_time>?" in plan
+
+
+def test_iter_query_is_lazy(data_storage: DataStorage):
+    start = datetime(2022, 5, 1)
+    data = []
+    for i in range(20):
+        collected = start + timedelta(seconds=i)
+        datum_cls, values = [(PulseDatum, dict(bpm=70)),
+                             (TemperatureDatum, dict(deg_c=37))][i % 2]
+        data.append(datum_cls(device_id=1,
+                              assigned_user=1004,
+                              received_time=collected,
+                              collection_time=collected,
+                              **values))
+    data_storage.bulk_create(data)
+
+    results = data_storage.iter_query(assigned_user=1004)
+    assert not isinstance(results, list)
+    first = next(results)
+    assert first.collection_time == start
+    assert isinstance(first, PulseDatum)
+
+    rest = list(results)
+    assert len(rest) == 19
+    assert [d.collection_time for d in rest] == [start + timedelta(seconds=i) for i in range(1, 20)]
+
+
+def test_bulk_create_skips_duplicates(data_storage: DataStorage):
+    start = datetime(2022, 5, 1)
+    data = [PulseDatum(device_id=1005,
+                       assigned_user=1005,
+                       received_time=start,
+                       collection_time=start + timedelta(minutes=i),
+                       bpm=60 + i) for i in range(10)]
+    assert store_data(data[:6], data_storage) == 6
+
+    # A retry of the whole batch, with a repeated reading, only stores the new ones.
+    assert store_data(data + [data[-1]], data_storage) == 4
+    # The same time on another device, or of another type, is not a duplicate.
+    other = [PulseDatum(device_id=1006, assigned_user=1005, received_time=start, collection_time=start, bpm=50),
+             TemperatureDatum(device_id=1005, assigned_user=1005, received_time=start, collection_time=start,
+                              deg_c=37.0)]
+    assert store_data(other, data_storage) == 2
+
+    assert len(data_storage.query(assigned_user=1005)) == 12
+    daily = rollups.query_rollups(1005, types=[PulseDatum], granularity="day")
+    assert daily[0].count == 11
+
+    existing = data_storage.query(assigned_user=1005, types=[PulseDatum], limit=1)[0]
+    assert data_storage.create(data[0]) == existing
+
+
+def test_remove_duplicates(data_storage: DataStorage):
+    # Databases written by earlier versions may hold duplicates and lack
+    # the unique index.
+    PulseDatumModel._schema.drop_indexes()
+    start = datetime(2022, 5, 2)
+    row = (1007, 1007, start, start, 70)
+    PulseDatumModel.insert_many([row, row, row], fields=PulseDatumModel.insert_fields()).execute()
+    assert data_storage.remove_duplicates() == 2
+    assert len(data_storage.query(assigned_user=1007)) == 1
+
+    with pytest.raises(Exception):
+        PulseDatumModel.insert_many([row], fields=PulseDatumModel.insert_fields()).execute()
+
+
+def test_datum_conversion(data_storage: DataStorage):
+    start = datetime(2022, 5, 3)
+    pulse = PulseDatum(device_id=1008, assigned_user=1008, received_time=start, collection_time=start, bpm=61)
+    assert not hasattr(pulse, "__dict__")
+    with pytest.raises(AttributeError):
+        pulse.note = "slotted"
+
+    stored = data_storage.create(pulse)
+    model = PulseDatumModel.get(PulseDatumModel.datum_id == stored.datum_id)
+    row = PulseDatumModel.select().where(PulseDatumModel.datum_id == stored.datum_id).tuples().get()
+    assert PulseDatumModel.converter() is PulseDatumModel.converter()
+    assert PulseDatumModel.converter().from_row(row) == stored
+    assert model.to_dataclass() == stored
+    assert data_storage.query(assigned_user=1008) == [stored]
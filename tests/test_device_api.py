@@ -166,3 +166,193 @@ def test_update_device_invalid(client):
     after = client.get(device_path)
     # Make sure it wasn't updated
     assert before.json == after.json
+
+
+def test_device_assignments(client):
+    _, resp = create_valid_device(client)
+    device_id = resp.json["device_id"]
+    url = f"/devices/{device_id}/assignments"
+
+    resp = client.post(url, json=dict(patient_id=10, assigner_id=1, date_assigned="2022-01-01T00:00:00"))
+    assert resp.status_code == 201
+    assignment = resp.json
+    assert assignment["patient_id"] == 10
+    assert assignment["date_returned"] is None
+
+    # The device is already assigned.
+    resp = client.post(url, json=dict(patient_id=20, assigner_id=1, date_assigned="2022-02-01T00:00:00"))
+    assert resp.status_code == 422
+
+    resp = client.put(f"{url}/{assignment['assignment_id']}", json=dict(date_returned="2022-01-15T00:00:00"))
+    assert resp.status_code == 200
+    assert resp.json["date_returned"] == "2022-01-15T00:00:00"
+
+    resp = client.post(url, json=dict(patient_id=20, assigner_id=1, date_assigned="2022-02-01T00:00:00"))
+    assert resp.status_code == 201
+
+    resp = client.get(url)
+    assert [a["patient_id"] for a in resp.json["assignments"]] == [10, 20]
+
+    resp = client.put(f"{url}/{assignment['assignment_id']}", json=dict(patient_id=30))
+    assert resp.status_code == 422
+
+    resp = client.delete(f"{url}/{assignment['assignment_id']}")
+    assert resp.status_code == 200
+    assert len(client.get(url).json["assignments"]) == 1
+
+
+def test_device_assignment_validation(client):
+    resp = client.post("/devices/1000/assignments", json=dict(patient_id=10, assigner_id=1))
+    assert resp.status_code == 404
+
+    _, resp = create_valid_device(client)
+    url = f"/devices/{resp.json['device_id']}/assignments"
+    resp = client.post(url, json=dict(patient_id=10, date_assigned="yesterday"))
+    assert resp.status_code == 422
+    assert len(resp.json["errors"]) == 2
+
+
+def test_device_cache(client):
+    _, resp = create_valid_device(client)
+    device_path = f"/devices/{resp.json['device_id']}"
+    assert client.get(device_path).status_code == 200
+    assert client.get(device_path).status_code == 200
+    assert len(client.get("/devices").json["devices"]) == 1
+    stats = client.get("/devices/cache").json
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+    # Writes invalidate the cached device and the cached list.
+    data = copy.deepcopy(resp.json)
+    data["name"] = "Thermometer-0002"
+    assert client.put(device_path, json=data).status_code == 200
+    assert client.get(device_path).json["name"] == "Thermometer-0002"
+    assert client.get("/devices").json["devices"][0]["name"] == "Thermometer-0002"
+
+    create_valid_device(client)
+    assert len(client.get("/devices").json["devices"]) == 2
+
+    assert client.delete(device_path).status_code == 200
+    assert client.get(device_path).status_code == 404
+    assert len(client.get("/devices").json["devices"]) == 1
+
+
+def test_device_query_filters(client):
+    for i, (firmware, purchased) in enumerate([("1.0.0", "2021-03-22"),
+                                               ("1.0.0", "2021-06-01T10:00:00"),
+                                               ("2.0.0", "2022-01-15"),
+                                               ("2.0.0", None)]):
+        resp = client.post("/devices", json=dict(name=f"{'Pulse' if i % 2 else 'Thermo'}-{i}",
+                                                 serial_number=f"SN-{i}",
+                                                 mac_address=f"00:00:00:00:00:0{i}",
+                                                 current_firmware_version=firmware,
+                                                 date_of_purchase=purchased))
+        assert resp.status_code == 200
+
+    def names(query):
+        resp = client.get(f"/devices?{query}")
+        assert resp.status_code == 200
+        return [d["name"] for d in resp.json["devices"]]
+
+    assert names("serial_number=SN-2") == ["Thermo-2"]
+    assert names("mac_address=00:00:00:00:00:01") == ["Pulse-1"]
+    assert names("current_firmware_version=1.0.0") == ["Thermo-0", "Pulse-1"]
+    assert names("purchased_since=2021-06-01") == ["Pulse-1", "Thermo-2"]
+    assert names("purchased_since=2021-01-01&purchased_until=2021-12-31") == ["Thermo-0", "Pulse-1"]
+    assert names("name_prefix=Pulse") == ["Pulse-1", "Pulse-3"]
+    # The prefix is case sensitive.
+    assert names("name_prefix=pulse") == []
+    assert names("name_prefix=Thermo&current_firmware_version=2.0.0") == ["Thermo-2"]
+
+    resp = client.get("/devices?limit=3")
+    assert len(resp.json["devices"]) == 3
+    resp = client.get(f"/devices?limit=3&cursor={resp.json['next_cursor']}")
+    assert [d["name"] for d in resp.json["devices"]] == ["Pulse-3"]
+    assert resp.json["next_cursor"] is None
+
+    resp = client.get("/devices?limit=0&purchased_since=yesterday&cursor=abc")
+    assert resp.status_code == 422
+    assert len(resp.json["errors"]) == 3
+
+
+def test_device_lookup_indexes(client):
+    database = models.get_storage("devices").database
+    indexed = {tuple(index.columns) for index in database.get_indexes("devicemodel")}
+    assert ("serial_number",) in indexed
+    assert ("mac_address",) in indexed
+    assert ("current_firmware_version", "device_id") in indexed
+
+
+def test_bulk_create_and_update(client):
+    _, resp = create_valid_device(client)
+    existing = resp.json
+    rows = [
+        dict(name="Pulse-0001", serial_number="SN-1", date_of_purchase="2022-01-01"),
+        dict(device_id=existing["device_id"], name="Thermometer-0002", current_firmware_version="1.1.0"),
+        # The name given up by the renamed device can be taken.
+        dict(name="Thermometer-0001", mac_address="00:00:00:00:00:01"),
+    ]
+    resp = client.post("/devices/bulk", json=rows)
+    assert resp.status_code == 200
+    assert resp.json["created"] == 2
+    assert resp.json["updated"] == 1
+    results = resp.json["results"]
+    assert [r["status"] for r in results] == ["created", "updated", "created"]
+    # Fields the row does not set are kept.
+    assert results[1]["device"]["date_of_purchase"].startswith(existing["date_of_purchase"])
+
+    for result in results:
+        device = client.get(f"/devices/{result['device']['device_id']}").json
+        assert_equal_resp(device, result["device"])
+    assert len(client.get("/devices").json["devices"]) == 3
+
+
+def test_bulk_csv(client):
+    body = ("name,serial_number,date_of_purchase\n"
+            "Scale-1,SN-1,2022-02-01\n"
+            "Scale-2,,\n")
+    resp = client.post("/devices/bulk", data=body, content_type="text/csv")
+    assert resp.status_code == 200
+    devices = [r["device"] for r in resp.json["results"]]
+    assert [d["name"] for d in devices] == ["Scale-1", "Scale-2"]
+    assert devices[1]["serial_number"] is None
+
+    # Empty cells of an update keep the stored fields.
+    body = ("device_id,name,serial_number,date_of_purchase\n"
+            f"{devices[0]['device_id']},,,2022-03-01\n")
+    resp = client.post("/devices/bulk", data=body, content_type="text/csv")
+    assert resp.status_code == 200
+    device = resp.json["results"][0]["device"]
+    assert (device["name"], device["serial_number"]) == ("Scale-1", "SN-1")
+    assert device["date_of_purchase"].startswith("2022-03-01")
+
+    resp = client.post("/devices/bulk", data="name,color\nScale-3,red\n", content_type="text/csv")
+    assert resp.status_code == 422
+    assert resp.json["errors"] == ["'color' is not a device field."]
+
+
+def test_bulk_validation(client):
+    _, resp = create_valid_device(client)
+    rows = [
+        dict(name="Pulse-0001"),
+        dict(name="Thermometer-0001"),
+        dict(name="Pulse-0001"),
+        dict(device_id=1234, name="Scale-0001"),
+        dict(serial_number="SN-1"),
+        dict(name=" ", date_of_purchase="soon", color="red"),
+        "Pulse-0002",
+    ]
+    resp = client.post("/devices/bulk", json=rows)
+    assert resp.status_code == 422
+    results = resp.json["results"]
+    assert [r["status"] for r in results] == ["valid"] + ["invalid"] * 6
+    assert results[1]["errors"] == ["The name Thermometer-0001 is already taken."]
+    assert results[2]["errors"] == ["The name Pulse-0001 is used more than once."]
+    assert results[3]["errors"] == ["Device 1234 does not exist."]
+    assert results[4]["errors"] == ["Missing required field: name"]
+    assert len(results[5]["errors"]) == 3
+    assert resp.json["errors"][0] == "Row 1: The name Thermometer-0001 is already taken."
+
+    # Nothing was written.
+    assert len(client.get("/devices").json["devices"]) == 1
+    assert client.post("/devices/bulk", json={"name": "Pulse-0001"}).status_code == 422
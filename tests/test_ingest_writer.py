@@ -0,0 +1,140 @@
+import threading
+from datetime import datetime
+from unittest import mock
+
+import pytest
+from medops.models.device_models import PulseDatum
+from medops.models.ingest_writer import GroupCommitWriter, QueueFullError, stored_counts
+
+
+def make_data(n):
+    now = datetime.now()
+    return [PulseDatum(device_id=1, assigned_user=1, received_time=now, collection_time=now, bpm=70)
+            for _ in range(n)]
+
+
+class BlockingStorage:
+    """A stand in for DataStorage that records each batch and can hold the
+    writer thread inside a write."""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.writing = threading.Event()
+        self.database = mock.MagicMock()
+
+    def bulk_create(self, data, stored):
+        self.writing.set()
+        self.release.wait(5)
+        self.batches.append(len(data))
+        stored.extend(data)
+        return len(data)
+
+
+def test_group_commit():
+    storage = BlockingStorage()
+    writer = GroupCommitWriter(storage, max_queue_size=100, max_batch_size=10)
+    try:
+        first = writer.submit(make_data(2))
+        assert storage.writing.wait(5)
+
+        # While the first write is in progress, these queue up and should be
+        # written together, split only where they exceed the batch size.
+        futures = [writer.submit(make_data(3)) for _ in range(5)]
+        assert writer.stats()["queue_depth"] == 15
+        storage.release.set()
+
+        assert first.result(5) == 2
+        assert [f.result(5) for f in futures] == [3] * 5
+        assert storage.batches == [2, 9, 6]
+
+        stats = writer.stats()
+        assert stats["queue_depth"] == 0
+        assert stats["batches_written"] == 3
+        assert stats["data_written"] == 17
+        assert stats["last_batch_size"] == 6
+        assert stats["max_flush_latency"] > 0
+    finally:
+        storage.release.set()
+        writer.stop(5)
+
+
+def test_queue_full():
+    storage = BlockingStorage()
+    writer = GroupCommitWriter(storage, max_queue_size=5, max_batch_size=10)
+    try:
+        writer.submit(make_data(1))
+        assert storage.writing.wait(5)
+        writer.submit(make_data(4))
+        with pytest.raises(QueueFullError):
+            writer.submit(make_data(2))
+        assert writer.stats()["rejected"] == 1
+    finally:
+        storage.release.set()
+        writer.stop(5)
+
+
+def test_large_submission_taken_when_queue_empty():
+    storage = BlockingStorage()
+    writer = GroupCommitWriter(storage, max_queue_size=5, max_batch_size=10)
+    try:
+        first = writer.submit(make_data(8))
+        assert storage.writing.wait(5)
+        # The queue is empty while the first submission is written.
+        second = writer.submit(make_data(7))
+        with pytest.raises(QueueFullError):
+            writer.submit(make_data(1))
+        storage.release.set()
+        assert (first.result(5), second.result(5)) == (8, 7)
+        assert storage.batches == [8, 7]
+    finally:
+        storage.release.set()
+        writer.stop(5)
+
+
+def test_write_errors_are_returned():
+    storage = mock.MagicMock()
+    storage.bulk_create.side_effect = ValueError("disk full")
+    writer = GroupCommitWriter(storage)
+    try:
+        future = writer.submit(make_data(1))
+        with pytest.raises(ValueError):
+            future.result(5)
+    finally:
+        writer.stop(5)
+
+
+def test_stop_drains_queue():
+    storage = BlockingStorage()
+    storage.release.set()
+    writer = GroupCommitWriter(storage)
+    futures = [writer.submit(make_data(1)) for _ in range(10)]
+    writer.stop(5)
+    assert all(f.done() for f in futures)
+    assert sum(storage.batches) == 10
+    with pytest.raises(RuntimeError):
+        writer.submit(make_data(1))
+
+
+def test_duplicates_counted():
+    storage = BlockingStorage()
+    # Pretend the first datum of each batch was already stored.
+    storage.bulk_create = lambda data, stored: stored.extend(data[1:]) or len(data) - 1
+    writer = GroupCommitWriter(storage)
+    assert writer.submit(make_data(4)).result(5) == 3
+    writer.stop(5)
+
+    stats = writer.stats()
+    assert stats["data_written"] == 3
+    assert stats["duplicates"] == 1
+
+
+def test_stored_counts():
+    now = datetime(2022, 3, 1)
+    first = PulseDatum(device_id=1, assigned_user=1, received_time=now, collection_time=now, bpm=70)
+    second = PulseDatum(device_id=2, assigned_user=1, received_time=now, collection_time=now, bpm=70)
+    # A reading repeated by a later submission is stored from the first one.
+    submissions = [[first, second], [second, first], [second]]
+    assert stored_counts(submissions, [first, second]) == [2, 0, 0]
+    assert stored_counts(submissions, [second]) == [1, 0, 0]
+    assert stored_counts([[first], [second]], [second]) == [0, 1]
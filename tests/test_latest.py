@@ -0,0 +1,78 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from medops.models import latest
+from medops.models.device_models import (
+    BloodPressureDatum,
+    DataStorage,
+    PulseDatum,
+)
+from medops.models.wide_storage import WideDataStorage
+
+FILENAME = "latest_test.db"
+
+
+@pytest.fixture(params=[DataStorage, WideDataStorage])
+def data_storage(request):
+    if os.path.exists(FILENAME):
+        os.unlink(FILENAME)
+
+    data_storage = request.param(FILENAME)
+    yield data_storage
+    data_storage.deinit()
+    os.unlink(FILENAME)
+
+
+def pulse(user, collected, bpm, device_id=1):
+    return PulseDatum(device_id=device_id,
+                      assigned_user=user,
+                      received_time=collected,
+                      collection_time=collected,
+                      bpm=bpm)
+
+
+def pressure(user, collected, systolic):
+    return BloodPressureDatum(device_id=2,
+                              assigned_user=user,
+                              received_time=collected,
+                              collection_time=collected,
+                              systolic=systolic,
+                              diastolic=80)
+
+
+def test_latest_readings_updated_at_ingest(data_storage):
+    start = datetime(2022, 3, 4, 10)
+    data = [pulse(1, start + timedelta(minutes=i), 60 + i) for i in range(5)]
+    data_storage.bulk_create(data + [pressure(1, start, 120), pulse(2, start, 90, device_id=3)])
+
+    results = latest.latest_readings([1, 2, 3])
+    assert [(type(d), d.collection_time) for d in results[1]] == [
+        (BloodPressureDatum, start), (PulseDatum, start + timedelta(minutes=4))]
+    assert results[1][1].bpm == 64
+    assert results[1][0].systolic == 120
+    assert [d.bpm for d in results[2]] == [90]
+    assert results[3] == []
+
+    assert [type(d) for d in latest.latest_readings([1], types=[PulseDatum])[1]] == [PulseDatum]
+
+
+def test_late_readings_do_not_overwrite(data_storage):
+    start = datetime(2022, 3, 4, 10)
+    data_storage.bulk_create([pulse(1, start, 70)])
+    data_storage.bulk_create([pulse(1, start - timedelta(hours=1), 50)])
+    assert latest.latest_readings([1])[1][0].bpm == 70
+
+    data_storage.create(pulse(1, start + timedelta(seconds=1), 80))
+    assert latest.latest_readings([1])[1][0].bpm == 80
+
+
+def test_rebuild_latest(data_storage):
+    start = datetime(2022, 3, 4, 10)
+    data_storage.bulk_create([pulse(1, start, 70), pressure(2, start, 130)], run_hooks=False)
+    assert latest.latest_readings([1, 2]) == {1: [], 2: []}
+
+    latest.rebuild_latest(data_storage)
+    results = latest.latest_readings([1, 2])
+    assert results[1][0].bpm == 70
+    assert results[2][0].systolic == 130
@@ -0,0 +1,158 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from medops.models import rollups, stats
+from medops.models.device_models import (
+    DataStorage,
+    PulseDatum,
+    PulseDatumModel,
+    TemperatureDatum,
+    TemperatureDatumModel,
+    datum_sort_key,
+)
+from medops.models.partitioned_storage import PartitionedDataStorage, month_key
+from medops.models.wide_storage import migrate
+
+FILENAME = "partitioned_test.db"
+OTHER_FILENAME = "partitioned_test_other.db"
+
+
+def remove_files():
+    for filename in [FILENAME, OTHER_FILENAME]:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+@pytest.fixture
+def storage():
+    remove_files()
+    storage = PartitionedDataStorage(FILENAME)
+    yield storage
+    storage.deinit()
+    remove_files()
+
+
+def make_data(user=1, start=datetime(2022, 1, 20), days=60, step=timedelta(days=3)):
+    data = []
+    # Devices can't report the same reading twice, so offset each patient.
+    collected = start + timedelta(seconds=user)
+    while collected < start + timedelta(days=days):
+        data.append(PulseDatum(device_id=1, assigned_user=user, received_time=collected,
+                               collection_time=collected, bpm=60 + collected.day))
+        data.append(TemperatureDatum(device_id=2, assigned_user=user, received_time=collected,
+                                     collection_time=collected, deg_c=36 + collected.day / 100))
+        collected += step
+    return data
+
+
+def test_month_key():
+    assert month_key(datetime(2022, 3, 31, 23, 59)) == "202203"
+
+
+def test_data_stored_by_month(storage):
+    storage.bulk_create(make_data())
+    assert storage.partitions(PulseDatumModel) == ["202201", "202202", "202203"]
+    assert storage.partitions(TemperatureDatumModel) == ["202201", "202202", "202203"]
+
+    created = storage.create(PulseDatum(device_id=1, assigned_user=1, received_time=datetime(2022, 5, 1),
+                                        collection_time=datetime(2022, 5, 1), bpm=70))
+    assert created.datum_id is not None
+    assert storage.partitions(PulseDatumModel)[-1] == "202205"
+
+
+def test_query_matches_unpartitioned(storage):
+    data = make_data() + make_data(user=2)
+    storage.bulk_create(data)
+
+    expected = DataStorage(OTHER_FILENAME)
+    try:
+        expected.bulk_create(data)
+        for kwargs in [dict(),
+                       dict(assigned_user=2),
+                       dict(since=datetime(2022, 2, 5), until=datetime(2022, 3, 1)),
+                       dict(since=datetime(2022, 2, 5), types=[PulseDatum], limit=3)]:
+            actual = [(type(d), d.assigned_user, d.collection_time) for d in storage.query(**kwargs)]
+            assert actual == [(type(d), d.assigned_user, d.collection_time) for d in expected.query(**kwargs)]
+    finally:
+        expected.deinit()
+
+
+def test_query_prunes_partitions(storage):
+    storage.bulk_create(make_data())
+    pulse = PulseDatumModel
+    assert len(storage._overlapping_partitions(pulse)) == 3
+    assert len(storage._overlapping_partitions(pulse, since=datetime(2022, 2, 10))) == 2
+    assert len(storage._overlapping_partitions(pulse, until=datetime(2022, 2, 1))) == 1
+    assert len(storage._overlapping_partitions(pulse, since=datetime(2022, 2, 1),
+                                               until=datetime(2022, 2, 28))) == 1
+
+    window = storage.query(since=datetime(2022, 2, 1), until=datetime(2022, 3, 1))
+    assert window
+    assert all(d.collection_time.month == 2 for d in window)
+
+
+def test_keyset_pagination(storage):
+    storage.bulk_create(make_data())
+    expected = storage.query()
+
+    pages = []
+    after = None
+    while True:
+        page = storage.query(limit=7, after=after)
+        if not page:
+            break
+        pages.extend(page)
+        after = datum_sort_key(page[-1])
+
+    assert [datum_sort_key(d) for d in pages] == [datum_sort_key(d) for d in expected]
+
+
+def test_drop_partitions(storage):
+    storage.bulk_create(make_data())
+    daily = rollups.query_rollups(1, granularity="day")
+
+    dropped = storage.drop_partitions(datetime(2022, 3, 15))
+    assert sorted(dropped) == ["pulsedatummodel_202201", "pulsedatummodel_202202",
+                               "temperaturedatummodel_202201", "temperaturedatummodel_202202"]
+    assert storage.partitions(PulseDatumModel) == ["202203"]
+    assert all(d.collection_time >= datetime(2022, 3, 1) for d in storage.query())
+
+    # Rollups summarize the dropped data and are kept.
+    assert rollups.query_rollups(1, granularity="day") == daily
+
+    # Dropped months can be written again.
+    storage.bulk_create(make_data(days=10))
+    assert storage.partitions(PulseDatumModel) == ["202201", "202203"]
+
+
+def test_stats_and_rollups_rebuild(storage):
+    data = make_data()
+    storage.bulk_create(data)
+    results = stats.compute_stats(storage, PulseDatum, since=datetime(2022, 2, 1))
+    pulses = [d for d in data if isinstance(d, PulseDatum)]
+    assert results["bpm"]["count"] == len([d for d in pulses if d.collection_time >= datetime(2022, 2, 1)])
+
+    before = rollups.query_rollups(1)
+    rollups.rebuild_rollups(storage)
+    assert rollups.query_rollups(1) == before
+
+
+def test_migrate_to_partitioned(storage):
+    source = DataStorage(OTHER_FILENAME)
+    try:
+        source.bulk_create(make_data())
+        assert migrate(source, storage) == len(make_data())
+    finally:
+        source.deinit()
+
+    assert len(storage.query()) == len(make_data())
+    assert storage.partitions(PulseDatumModel) == ["202201", "202202", "202203"]
+
+
+def test_duplicates_skipped(storage):
+    data = make_data()
+    assert storage.bulk_create(data[:7]) == 7
+    assert storage.bulk_create(data) == len(data) - 7
+    assert len(storage.query()) == len(data)
+    assert storage.create(data[0]).datum_id == storage.query(limit=1)[0].datum_id
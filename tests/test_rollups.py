@@ -0,0 +1,98 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from medops.models import rollups
+from medops.models.device_models import (
+    BloodPressureDatum,
+    DataStorage,
+    PulseDatum,
+)
+
+FILENAME = "rollups_test.db"
+
+
+@pytest.fixture
+def data_storage():
+    if os.path.exists(FILENAME):
+        os.unlink(FILENAME)
+
+    data_storage = DataStorage(FILENAME)
+    yield data_storage
+    data_storage.deinit()
+    os.unlink(FILENAME)
+
+
+def pulse(user, collected, bpm):
+    return PulseDatum(device_id=user,
+                      assigned_user=user,
+                      received_time=collected,
+                      collection_time=collected,
+                      bpm=bpm)
+
+
+def as_tuples(results):
+    return [(r.datum_type, r.field, r.bucket, r.count, r.total, r.minimum, r.maximum) for r in results]
+
+
+def test_bucket_start():
+    timestamp = datetime(2022, 3, 4, 5, 6, 7, 8)
+    assert rollups.bucket_start(timestamp, "hour") == datetime(2022, 3, 4, 5)
+    assert rollups.bucket_start(timestamp, "day") == datetime(2022, 3, 4)
+    with pytest.raises(ValueError):
+        rollups.bucket_start(timestamp, "week")
+
+
+def test_rollups_updated_incrementally(data_storage: DataStorage):
+    start = datetime(2022, 3, 4, 10)
+    data_storage.bulk_create([pulse(1, start + timedelta(minutes=10 * i), 60 + i) for i in range(9)])
+    # A second batch that lands in existing and new buckets.
+    data_storage.bulk_create([pulse(1, start + timedelta(minutes=55), 100),
+                              pulse(1, start + timedelta(hours=3), 40),
+                              pulse(2, start, 80)])
+
+    hourly = rollups.query_rollups(1, granularity="hour")
+    assert as_tuples(hourly) == [
+        ("PulseDatum", "bpm", start, 7, sum(range(60, 66)) + 100, 60, 100),
+        ("PulseDatum", "bpm", start + timedelta(hours=1), 3, 66 + 67 + 68, 66, 68),
+        ("PulseDatum", "bpm", start + timedelta(hours=3), 1, 40, 40, 40),
+    ]
+    assert hourly[1].mean == 67
+
+    daily = rollups.query_rollups(1, granularity="day")
+    assert as_tuples(daily) == [
+        ("PulseDatum", "bpm", datetime(2022, 3, 4), 11, sum(range(60, 69)) + 140, 40, 100)
+    ]
+
+    window = rollups.query_rollups(1, since=start + timedelta(hours=1), until=start + timedelta(hours=2))
+    assert len(window) == 1
+
+
+def test_rollups_multiple_fields(data_storage: DataStorage):
+    collected = datetime(2022, 3, 4, 10)
+    data_storage.bulk_create([
+        BloodPressureDatum(device_id=1,
+                           assigned_user=1,
+                           received_time=collected,
+                           collection_time=collected,
+                           systolic=120,
+                           diastolic=80),
+        pulse(1, collected, 70),
+    ])
+
+    results = rollups.query_rollups(1, types=[BloodPressureDatum], granularity="day")
+    assert [(r.field, r.total) for r in results] == [("diastolic", 80), ("systolic", 120)]
+
+
+def test_rebuild_matches_incremental(data_storage: DataStorage):
+    start = datetime(2022, 3, 4, 10)
+    data_storage.bulk_create([pulse(i % 3, start + timedelta(minutes=17 * i), 50 + i) for i in range(100)])
+
+    expected = {user: as_tuples(rollups.query_rollups(user)) for user in range(3)}
+    rollups.VitalRollupModel.delete().execute()
+    rollups.rebuild_rollups(data_storage)
+    assert {user: as_tuples(rollups.query_rollups(user)) for user in range(3)} == expected
+
+    # Rebuilding part of the range must not double count the rest.
+    rollups.rebuild_rollups(data_storage, since=start + timedelta(days=1))
+    assert {user: as_tuples(rollups.query_rollups(user)) for user in range(3)} == expected
@@ -0,0 +1,77 @@
+import json
+from datetime import date, datetime
+
+import pytest
+
+from medops.apis.users import USER_ENCODER
+from medops.models import chat_model, device_models, serialization
+from medops.models.user_models import User, UserRole
+
+
+def make_user(user_id, **kwargs):
+    return User(user_id=user_id,
+                dob=date(1990, 1, user_id),
+                first_name="First",
+                last_name="Last",
+                email=f"user{user_id}@example.com",
+                password="hash",
+                roles=[UserRole(role_id=1, role_name="patient")],
+                **kwargs)
+
+
+def test_encode_datum_matches_to_json():
+    datum = device_models.BloodPressureDatum(device_id=1,
+                                             assigned_user=2,
+                                             received_time=datetime(2022, 3, 1, 0, 0, 1, 500),
+                                             collection_time=datetime(2022, 3, 1),
+                                             datum_id=3,
+                                             systolic=120.0,
+                                             diastolic=80.0)
+    assert serialization.encode(datum) == datum.to_json()
+
+
+def test_encode_device():
+    device = device_models.Device(device_id=1,
+                                  name="cuff",
+                                  current_firmware_version="1.0",
+                                  date_of_purchase=datetime(2021, 3, 22),
+                                  serial_number=None,
+                                  mac_address=None)
+    assert serialization.encode(device)["date_of_purchase"] == "2021-03-22T00:00:00"
+
+    # Values that are already strings, e.g. as posted, are left unchanged.
+    device.date_of_purchase = "2021-03-22"
+    assert serialization.encode(device)["date_of_purchase"] == "2021-03-22"
+
+
+def test_user_encoder_matches_to_json():
+    user = make_user(1, patients=[make_user(2)], medical_staff=[make_user(3)])
+    assert USER_ENCODER(user) == user.to_json()
+    assert "password" not in USER_ENCODER(user)
+
+
+def test_encode_message():
+    message = chat_model.MessageV1(from_user=1,
+                                   text="hello",
+                                   timestamp=datetime(2022, 3, 1, 12),
+                                   attachments=[chat_model.MessageAttachmentV1(type="image", url="http://x")])
+    assert serialization.encode(message) == dict(from_user=1,
+                                                 text="hello",
+                                                 timestamp="2022-03-01T12:00:00",
+                                                 attachments=[dict(type="image", url="http://x")])
+
+
+def test_encoders_are_cached():
+    assert serialization.encoder_for(device_models.PulseDatum) is serialization.encoder_for(device_models.PulseDatum)
+    assert serialization.encoder_for(User, exclude=("password",)) is not serialization.encoder_for(User)
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_dumps(backend):
+    if backend == "orjson" and serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    payload = dict(count=1, when=datetime(2022, 3, 1), data=[{"a": None}])
+    assert json.loads(serialization.dumps(payload, backend)) == dict(count=1,
+                                                                     when="2022-03-01T00:00:00",
+                                                                     data=[{"a": None}])
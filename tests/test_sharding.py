@@ -0,0 +1,243 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from medops.models import rollups, stats
+from medops.models.device_models import (
+    DataStorage,
+    PulseDatum,
+    PulseDatumModel,
+    TemperatureDatum,
+    datum_sort_key,
+)
+from medops.models.sharding import (
+    ROUTER,
+    ShardedDataStorage,
+    rebalance,
+    shard_filenames,
+    shard_for,
+)
+
+FILENAME = "sharded_test.db"
+
+
+def remove_files():
+    for n_shards in [1, 3, 4]:
+        for filename in shard_filenames(FILENAME, n_shards):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+@pytest.fixture
+def storage():
+    remove_files()
+    storage = ShardedDataStorage(FILENAME, 3)
+    yield storage
+    storage.deinit()
+    remove_files()
+
+
+def make_data(users=range(8), start=datetime(2022, 3, 1), count=5):
+    data = []
+    for user in users:
+        for i in range(count):
+            # Devices can't report the same reading twice, so offset each patient.
+            collected = start + timedelta(minutes=i, seconds=user)
+            data.append(PulseDatum(device_id=user, assigned_user=user, received_time=collected,
+                                   collection_time=collected, bpm=60 + i))
+            data.append(TemperatureDatum(device_id=100 + user, assigned_user=user, received_time=collected,
+                                         collection_time=collected, deg_c=36.5))
+    return data
+
+
+def test_shard_for():
+    assert [shard_for(user, 4) for user in range(1000)] == [shard_for(user, 4) for user in range(1000)]
+    counts = [0] * 4
+    for user in range(1000):
+        counts[shard_for(user, 4)] += 1
+    assert min(counts) > 200
+
+
+def test_shard_filenames():
+    assert shard_filenames("data/medops.db", 1)[0].name == "medops.db"
+    assert [f.name for f in shard_filenames("data/medops.db", 2)] == ["medops.0-of-2.db", "medops.1-of-2.db"]
+
+
+def test_data_stored_by_patient(storage):
+    data = make_data()
+    assert storage.bulk_create(data) == len(data)
+    assert storage.bulk_create(data) == 0
+
+    for index, shard in enumerate(storage.shards):
+        users = {user for user in range(8) if shard_for(user, 3) == index}
+        with ROUTER.use(shard.database):
+            assert {d.assigned_user for d in shard.query()} == users
+
+    created = storage.create(PulseDatum(device_id=1, assigned_user=1, received_time=datetime(2022, 5, 1),
+                                        collection_time=datetime(2022, 5, 1), bpm=70))
+    assert created.datum_id is not None
+
+
+def test_query(storage):
+    data = make_data()
+    storage.bulk_create(data)
+
+    results = storage.query()
+    assert len(results) == len(data)
+    assert [datum_sort_key(d) for d in results] == sorted(datum_sort_key(d) for d in results)
+    assert list(storage.iter_query()) == results
+
+    assert [d.bpm for d in storage.query(assigned_user=3, types=[PulseDatum])] == [60, 61, 62, 63, 64]
+    assert storage.query(limit=4) == results[:4]
+    assert storage.query(since=datetime(2022, 3, 1, 0, 4)) == results[-16:]
+
+    # Keyset pagination across shards.
+    pages = []
+    after = None
+    while True:
+        page = storage.query(limit=7, after=after)
+        if not page:
+            break
+        pages.extend(page)
+        after = storage.sort_key(page[-1])
+    assert pages == results
+
+
+def test_paging_across_shards_with_equal_ids(storage):
+    # Datum ids are only unique within a shard.
+    users = [0, next(user for user in range(1, 100) if shard_for(user, 3) != shard_for(0, 3))]
+    collected = datetime(2022, 3, 1)
+    storage.bulk_create([PulseDatum(device_id=user, assigned_user=user, received_time=collected,
+                                    collection_time=collected, bpm=60) for user in users])
+    results = storage.query()
+    assert [d.datum_id for d in results] == [1, 1]
+
+    for query in [storage.query, lambda **kwargs: list(storage.iter_query(**kwargs))]:
+        pages = []
+        after = None
+        while page := query(limit=1, after=after):
+            pages.extend(page)
+            after = storage.sort_key(page[-1])
+        assert pages == results
+
+
+def test_rollups_and_latest(storage):
+    storage.bulk_create(make_data())
+
+    daily = storage.query_rollups(5, types=[PulseDatum], granularity="day")
+    assert [(r.count, r.minimum, r.maximum) for r in daily] == [(5, 60, 64)]
+
+    results = storage.latest_readings([5, 2, 99])
+    assert list(results) == [5, 2, 99]
+    assert [d.bpm for d in results[5] if isinstance(d, PulseDatum)] == [64]
+    assert results[99] == []
+
+    # Rebuilding each shard gives the same rollups.
+    storage.map_shards(rollups.rebuild_rollups)
+    assert storage.query_rollups(5, types=[PulseDatum], granularity="day") == daily
+
+
+def test_stats(storage):
+    storage.bulk_create(make_data())
+    assert stats.compute_stats(storage, PulseDatum)["bpm"]["count"] == 40
+    assert stats.compute_stats(storage, PulseDatum, assigned_user=2)["bpm"]["count"] == 5
+
+
+def test_models_need_a_shard(storage):
+    errors = []
+
+    def query():
+        try:
+            PulseDatumModel.select().count()
+        except AttributeError as err:
+            errors.append(str(err))
+
+    # Without a DataStorage that is not sharded.
+    default = ROUTER.default
+    ROUTER.default = None
+    try:
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join()
+    finally:
+        ROUTER.default = default
+    assert errors == ["No data shard is selected in this thread."]
+
+
+def test_data_storage_keeps_its_database():
+    filenames = ["plain_before_test.db", "plain_after_test.db"]
+    remove_files()
+    before = DataStorage(filenames[0])
+    sharded = ShardedDataStorage(FILENAME, 3)
+    try:
+        data = make_data(users=[1, 2])
+        assert before.bulk_create(data) == len(data)
+        assert sharded.query() == []
+        assert sharded.bulk_create(data) == len(data)
+        assert len(before.query()) == len(data)
+
+        # One created afterwards takes over the models outside of the shards.
+        after = DataStorage(filenames[1])
+        assert sharded.bulk_create(make_data(users=[3])) == 10
+        assert after.query() == []
+        assert len(sharded.query()) == len(data) + 10
+        after.deinit()
+    finally:
+        before.deinit()
+        sharded.deinit()
+        remove_files()
+        for filename in filenames:
+            os.unlink(filename)
+
+
+def test_deinit_closes_query_thread_connections():
+    remove_files()
+    storage = ShardedDataStorage(FILENAME, 3)
+    # Record the connections opened by the query threads and closed.
+    opened, closed = [], []
+    for shard in storage.shards:
+        def connect(connect=shard.database._connect):
+            opened.append(connect())
+            return opened[-1]
+
+        def close(connection, close=shard.database._close):
+            closed.append(connection)
+            close(connection)
+
+        shard.database._connect = connect
+        shard.database._close = close
+    storage.bulk_create(make_data())
+    assert len(storage.query()) == 80
+
+    storage.deinit()
+    remove_files()
+    assert len(opened) >= 3
+    assert {id(c) for c in opened} <= {id(c) for c in closed}
+
+
+def test_rebalance():
+    remove_files()
+    data = make_data()
+    source = DataStorage(FILENAME)
+    source.bulk_create(data)
+    source.deinit()
+
+    source = ShardedDataStorage(FILENAME, 1)
+    destination = ShardedDataStorage(FILENAME, 4)
+    try:
+        assert rebalance(source, destination, batch_size=7) == len(data)
+        # Copying again skips the data already copied.
+        assert rebalance(source, destination) == 0
+
+        def key(datum):
+            return (datum_sort_key(datum)[:2], datum.assigned_user)
+
+        assert sorted(map(key, destination.query())) == sorted(map(key, source.query()))
+        for user in range(8):
+            assert destination.query_rollups(user) == source.query_rollups(user)
+            assert destination.latest_readings([user]) == source.latest_readings([user])
+    finally:
+        source.deinit()
+        destination.deinit()
+        remove_files()
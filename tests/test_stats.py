@@ -0,0 +1,91 @@
+import os
+import statistics
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from medops.models import stats
+from medops.models.device_models import (
+    BloodPressureDatum,
+    BloodSaturationDatum,
+    DataStorage,
+    GlucometerDatum,
+)
+
+FILENAME = "stats_test.db"
+
+
+@pytest.fixture
+def data_storage():
+    if os.path.exists(FILENAME):
+        os.unlink(FILENAME)
+
+    data_storage = DataStorage(FILENAME)
+    yield data_storage
+    data_storage.deinit()
+    os.unlink(FILENAME)
+
+
+def test_summarize():
+    values = [3.0, 1.0, 4.0, 1.0, 5.0, 9.0, 2.0, 6.0]
+    summary = stats.summarize(np.array(values), percentiles=(50,))
+    assert summary["count"] == 8
+    assert summary["mean"] == pytest.approx(statistics.mean(values))
+    assert summary["std"] == pytest.approx(statistics.pstdev(values))
+    assert summary["min"] == 1
+    assert summary["max"] == 9
+    assert summary["percentiles"]["50"] == pytest.approx(statistics.median(values))
+
+
+def test_summarize_empty():
+    summary = stats.summarize(np.array([]))
+    assert summary["count"] == 0
+    assert summary["mean"] is None
+    assert summary["percentiles"]["95"] is None
+
+
+def test_fractions():
+    values = np.array([60, 70, 100, 180, 200])
+    assert stats.fraction_in_range(values, 70, 180) == 0.6
+    assert stats.fraction_below(values, 70) == 0.2
+    assert stats.fraction_below(np.array([]), 70) is None
+
+
+def test_compute_stats(data_storage: DataStorage):
+    start = datetime(2022, 3, 1)
+    data = []
+    for i, mg_dl in enumerate([50, 80, 120, 150, 190, 250]):
+        data.append(GlucometerDatum(device_id=1,
+                                    assigned_user=1,
+                                    received_time=start,
+                                    collection_time=start + timedelta(minutes=i),
+                                    mg_dl=mg_dl))
+    for i, percentage in enumerate([99, 95, 88, 85]):
+        data.append(BloodSaturationDatum(device_id=1,
+                                         assigned_user=1,
+                                         received_time=start,
+                                         collection_time=start + timedelta(minutes=i),
+                                         percentage=percentage))
+    data.append(BloodPressureDatum(device_id=1,
+                                   assigned_user=2,
+                                   received_time=start,
+                                   collection_time=start,
+                                   systolic=120,
+                                   diastolic=80))
+    data_storage.bulk_create(data)
+
+    glucose = stats.compute_stats(data_storage, GlucometerDatum, assigned_user=1)
+    assert glucose["mg_dl"]["count"] == 6
+    assert glucose["mg_dl"]["time_in_range"] == pytest.approx(0.5)
+
+    glucose = stats.compute_stats(data_storage, GlucometerDatum, assigned_user=1,
+                                  until=start + timedelta(minutes=2))
+    assert glucose["mg_dl"]["count"] == 2
+
+    spo2 = stats.compute_stats(data_storage, BloodSaturationDatum, spo2_threshold=90)
+    assert spo2["percentage"]["fraction_below_threshold"] == 0.5
+
+    bp = stats.compute_stats(data_storage, BloodPressureDatum)
+    assert bp["systolic"]["mean"] == 120
+    assert bp["diastolic"]["mean"] == 80
+    assert "time_in_range" not in bp["systolic"]
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from medops.models import waveforms
+from medops.models.waveforms import WaveformDatum, WaveformStorage
+
+START = datetime(2022, 3, 1)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = WaveformStorage(tmp_path / "waveforms.db", chunk_size=100)
+    yield storage
+    storage.deinit()
+
+
+def ecg_segment(n_samples=1000, start=START, device_id=1, dtype="<i2"):
+    samples = (500 * np.sin(np.arange(n_samples) / 10)).astype(dtype)
+    return WaveformDatum(device_id=device_id,
+                         assigned_user=2,
+                         received_time=start,
+                         collection_time=start,
+                         waveform="ecg",
+                         sample_rate=250.0,
+                         samples=samples)
+
+
+@pytest.mark.parametrize("dtype", waveforms.SAMPLE_DTYPES)
+def test_compression_round_trip(dtype):
+    samples = (1000 * np.sin(np.arange(1050) / 7)).astype(dtype)
+    samples[::97] = np.iinfo(dtype).min if samples.dtype.kind == "i" else -1e9
+    offsets, blob = waveforms.compress_samples(samples, chunk_size=100)
+    assert len(np.frombuffer(offsets, dtype="<u4")) == 12
+
+    for start, stop in [(0, 1050), (150, 151), (99, 201), (1000, 1050), (5, 5)]:
+        read = waveforms.decompress_samples(blob, offsets, dtype, 100, start, stop)
+        assert read.dtype == samples.dtype
+        np.testing.assert_array_equal(read, samples[start:stop])
+
+
+def test_sub_range_only_decompresses_overlapping_chunks():
+    samples = np.arange(1000, dtype="<i2")
+    offsets, blob = waveforms.compress_samples(samples, chunk_size=100)
+    with mock.patch.object(waveforms.zlib, "decompress", wraps=waveforms.zlib.decompress) as decompress:
+        read = waveforms.decompress_samples(blob, offsets, "<i2", 100, 250, 420)
+    np.testing.assert_array_equal(read, samples[250:420])
+    assert decompress.call_count == 3
+
+
+def test_create_and_query(storage):
+    segment = ecg_segment()
+    stored = storage.create(segment)
+    assert stored.datum_id is not None
+    model = waveforms.WaveformDatumModel.get_by_id(stored.datum_id)
+    assert len(model.samples) < segment.samples.nbytes
+    assert model.end_time == START + timedelta(seconds=4)
+
+    fetched = storage.get(stored.datum_id)
+    assert fetched == stored
+    np.testing.assert_array_equal(fetched.samples, segment.samples)
+
+    # A retried upload returns the stored segment.
+    assert storage.create(ecg_segment()).datum_id == stored.datum_id
+
+    # The window cuts the segment, the first sample is at or after since.
+    data = storage.query(assigned_user=2, since=START + timedelta(seconds=1), until=START + timedelta(seconds=1.5))
+    assert len(data) == 1
+    assert data[0].collection_time == START + timedelta(seconds=1)
+    np.testing.assert_array_equal(data[0].samples, segment.samples[250:375])
+
+    assert storage.query(assigned_user=2, since=START + timedelta(seconds=4)) == []
+    assert storage.query(assigned_user=3) == []
+    assert storage.query(device_id=1, waveform="ppg") == []
+
+
+def test_create_rejects_invalid_segments(storage):
+    for changes in [dict(waveform="eeg"), dict(sample_rate=0), dict(samples=np.zeros((2, 2))),
+                    dict(samples=np.zeros(4, dtype="<u2"))]:
+        segment = ecg_segment()
+        for name, value in changes.items():
+            setattr(segment, name, value)
+        with pytest.raises(ValueError):
+            storage.create(segment)
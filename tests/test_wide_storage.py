@@ -0,0 +1,165 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from medops.models import rollups, stats
+from medops.models.device_models import (
+    BloodPressureDatum,
+    DataStorage,
+    PulseDatum,
+    TemperatureDatum,
+    datum_sort_key,
+)
+from medops.models.wide_storage import WideDataStorage, migrate
+
+FILENAME = "wide_test.db"
+OTHER_FILENAME = "wide_test_other.db"
+
+
+def remove_files():
+    for filename in [FILENAME, OTHER_FILENAME]:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+@pytest.fixture
+def wide_storage():
+    remove_files()
+    storage = WideDataStorage(FILENAME)
+    yield storage
+    storage.deinit()
+    remove_files()
+
+
+def make_data(user=1, n=10, start=datetime(2022, 6, 1)):
+    data = []
+    for i in range(n):
+        # Pairs of data share a collection time to exercise ordering by type.
+        # Devices can't report the same reading twice, so offset each patient.
+        collected = start + timedelta(minutes=i // 2, seconds=user)
+        data.append(PulseDatum(device_id=1 + i % 2,
+                               assigned_user=user,
+                               received_time=collected,
+                               collection_time=collected,
+                               bpm=60 + i))
+        data.append(TemperatureDatum(device_id=1 + i % 2,
+                                     assigned_user=user,
+                                     received_time=collected,
+                                     collection_time=collected,
+                                     deg_c=36.5 + i / 10))
+    data.append(BloodPressureDatum(device_id=3,
+                                   assigned_user=user,
+                                   received_time=start + timedelta(seconds=user),
+                                   collection_time=start + timedelta(seconds=user),
+                                   systolic=120,
+                                   diastolic=80))
+    return data
+
+
+def without_ids(data):
+    return [(type(d), d.device_id, d.assigned_user, d.collection_time, d.to_dict().items() - {("datum_id", d.datum_id)})
+            for d in data]
+
+
+def test_create(wide_storage: WideDataStorage):
+    now = datetime.now()
+    pulse = PulseDatum(device_id=1, assigned_user=1, received_time=now, collection_time=now, bpm=75)
+    result = wide_storage.create(pulse)
+    assert result.datum_id is not None
+    pulse.datum_id = result.datum_id
+    assert result == pulse
+    assert wide_storage.query() == [pulse]
+
+
+def test_query(wide_storage: WideDataStorage):
+    data = make_data(user=1) + make_data(user=2)
+    wide_storage.bulk_create(data)
+
+    results = wide_storage.query(assigned_user=1)
+    assert len(results) == 21
+    assert results == sorted(results, key=datum_sort_key)
+    assert all(isinstance(d.bpm, int) for d in results if isinstance(d, PulseDatum))
+
+    results = wide_storage.query(assigned_user=2, types=[PulseDatum], device_id=2)
+    assert [d.bpm for d in results] == [61, 63, 65, 67, 69]
+
+    start = datetime(2022, 6, 1)
+    results = wide_storage.query(since=start + timedelta(minutes=1), until=start + timedelta(minutes=2))
+    assert len(results) == 8
+
+    page = wide_storage.query(assigned_user=1, limit=4)
+    rest = wide_storage.query(assigned_user=1, after=datum_sort_key(page[-1]))
+    assert page + rest == wide_storage.query(assigned_user=1)
+
+
+def test_page_boundaries_match_data_storage(wide_storage: WideDataStorage):
+    # Whole-second and fractional times compare by their stored strings.
+    data = make_data(user=1) + make_data(user=2, start=datetime(2022, 6, 1, microsecond=500000))
+    wide_storage.bulk_create(data)
+    tables_storage = DataStorage(OTHER_FILENAME)
+    tables_storage.bulk_create(data)
+    try:
+        for storage in [wide_storage, tables_storage]:
+            pages = [storage.query(limit=5)]
+            while pages[-1]:
+                pages.append(storage.query(limit=5, after=datum_sort_key(pages[-1][-1])))
+            assert sum(pages, []) == storage.query()
+    finally:
+        tables_storage.deinit()
+
+def test_same_order_as_data_storage(wide_storage: WideDataStorage):
+    data = make_data()
+    wide_storage.bulk_create(data)
+    tables_storage = DataStorage(OTHER_FILENAME)
+    tables_storage.bulk_create(data)
+    try:
+        assert without_ids(wide_storage.query()) == without_ids(tables_storage.query())
+    finally:
+        tables_storage.deinit()
+
+
+def test_stats(wide_storage: WideDataStorage):
+    wide_storage.bulk_create(make_data())
+    results = stats.compute_stats(wide_storage, PulseDatum)
+    assert results["bpm"]["count"] == 10
+    assert results["bpm"]["mean"] == 64.5
+
+    results = stats.compute_stats(wide_storage, BloodPressureDatum)
+    assert results["diastolic"]["mean"] == 80
+
+
+def test_rollups(wide_storage: WideDataStorage):
+    wide_storage.bulk_create(make_data())
+    results = rollups.query_rollups(1, types=[PulseDatum], granularity="day")
+    assert [(r.count, r.minimum, r.maximum) for r in results] == [(10, 60, 69)]
+
+    rollups.rebuild_rollups(wide_storage)
+    assert rollups.query_rollups(1, types=[PulseDatum], granularity="day") == results
+
+
+def test_migrate(wide_storage: WideDataStorage):
+    data = make_data(user=1) + make_data(user=2)
+    wide_storage.bulk_create(data)
+    expected = without_ids(wide_storage.query())
+
+    tables_storage = DataStorage(OTHER_FILENAME)
+    try:
+        assert migrate(wide_storage, tables_storage, batch_size=7) == len(data)
+        assert without_ids(tables_storage.query()) == expected
+        assert rollups.query_rollups(2, types=[PulseDatum], granularity="day")[0].count == 10
+
+        with pytest.raises(ValueError):
+            migrate(tables_storage, tables_storage)
+    finally:
+        tables_storage.deinit()
+
+
+def test_duplicates_skipped(wide_storage: WideDataStorage):
+    data = make_data()
+    assert wide_storage.bulk_create(data[:5]) == 5
+    assert wide_storage.bulk_create(data) == len(data) - 5
+    assert len(wide_storage.query()) == len(data)
+
+    stored = wide_storage.query(types=[PulseDatum], limit=1)[0]
+    assert wide_storage.create(data[0]) == stored
+    assert wide_storage.remove_duplicates() == 0